@@ -16,7 +16,6 @@
 # ##### END GPL LICENSE BLOCK #####
 
 import bpy
-import bmesh
 import os
 import os.path
 import subprocess
@@ -29,10 +28,15 @@ from bpy_extras.io_utils import ExportHelper
 
 from bpy.app.handlers import persistent
 
-from math import radians, degrees
-from mathutils import Euler, Matrix
+from mathutils import Euler
 
 from . import export_dae
+from . import dae_writer
+from . import image_staging
+from . import geometry_ops
+from . import anim_ops
+from . import anim_eval
+from . import anim_cache
 
 bl_info = {
     "name": "Divinity Collada Exporter",
@@ -49,6 +53,18 @@ bl_info = {
 
 if "bpy" in locals():
     import imp
+    if "dae_writer" in locals():
+        imp.reload(dae_writer) # noqa
+    if "image_staging" in locals():
+        imp.reload(image_staging) # noqa
+    if "geometry_ops" in locals():
+        imp.reload(geometry_ops) # noqa
+    if "anim_ops" in locals():
+        imp.reload(anim_ops) # noqa
+    if "anim_eval" in locals():
+        imp.reload(anim_eval) # noqa
+    if "anim_cache" in locals():
+        imp.reload(anim_cache) # noqa
     if "export_dae" in locals():
         imp.reload(export_dae) # noqa
 
@@ -697,14 +713,26 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
         )
     use_limit_total = BoolProperty(
         name="Limit Total",
-        description="Limit total vertex influences to 4 (GR2 requirement)",
+        description="Limit total vertex influences (4 is a GR2 requirement)",
         default=False
         )
+    weight_limit = IntProperty(
+        name="Influences",
+        description="Most bone influences kept per vertex, the strongest are kept",
+        min=1, max=32,
+        default=4
+        )
     use_rest_pose = BoolProperty(
         name="Use Rest Pose",
         description="Revert any armatures to their rest poses when exporting (on the copy only)",
         default=True
         )
+    use_nondestructive = BoolProperty(
+        name="Non-Destructive",
+        description=("Export the objects as they are, without making and "
+                     "modifying copies of them"),
+        default=False
+        )
     use_tangent = BoolProperty(
         name="Export Tangents",
         description="Export Tangent and Binormal arrays (for normalmapping)",
@@ -721,6 +749,46 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
         description="Copy Images (create images/ subfolder)",
         default=False
         )
+    use_static_batching = BoolProperty(
+        name="Static Batching",
+        description=("Merge sibling static meshes that share materials (or are "
+                     "in the same merge list) into one geometry per material"),
+        default=False
+        )
+    chunk_size = FloatProperty(
+        name="Chunk Size",
+        description=("Split static meshes into grid cells of this size, each "
+                     "written as its own node and geometry (0 disables)"),
+        min=0.0, soft_max=100.0,
+        default=0.0
+        )
+    use_material_dedup = BoolProperty(
+        name="Merge Identical Materials",
+        description=("Materials with identical colors, intensities and texture "
+                     "slots (e.g. Mat.001, Mat.002) share a single exported "
+                     "material and effect"),
+        default=True
+        )
+    use_export_cache = BoolProperty(
+        name="Save Export Cache",
+        description=("Save the extracted mesh, skin and animation arrays to a "
+                     "compressed .npz next to the DAE, so the DAE can be "
+                     "regenerated with dae_writer.py without Blender"),
+        default=False
+        )
+    float_precision = IntProperty(
+        name="Float Precision",
+        description="Decimal places written for float arrays (0 writes full precision)",
+        min=0, max=16,
+        default=0
+        )
+    use_image_hardlinks = BoolProperty(
+        name="Hardlink Images",
+        description=("Hardlink copied images instead of copying them when the "
+                     "filesystem allows it (copy-on-write clones are always "
+                     "used when available)"),
+        default=False
+        )
     use_active_layers = BoolProperty(
         name="Active Layers Only",
         description="Export only objects on the active layers",
@@ -750,7 +818,7 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
         )
     use_anim_optimize = BoolProperty(
         name="Optimize Keyframes",
-        description="Remove double keyframes",
+        description="Remove constant and linearly interpolable keyframes",
         default=False
         )
 
@@ -760,10 +828,119 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
         default=False
         )
         
+    use_anim_cache = BoolProperty(
+        name="Skip Unchanged Actions",
+        description=("When exporting all actions, keep the previous DAE/GR2 of "
+                     "actions whose keys, rig and export settings are unchanged"),
+        default=False
+        )
+
+    anim_use_action_range = BoolProperty(
+        name="Use Action Range",
+        description="Sample the action's frame range instead of the scene's start and end frames",
+        default=False
+        )
+
+    anim_frame_step = IntProperty(
+        name="Frame Step",
+        description="Sample every Nth frame. The last frame is always sampled",
+        min=1, soft_max=10,
+        default=1
+        )
+
+    anim_target_fps = IntProperty(
+        name="Target FPS",
+        description="Resample the animation at this rate, overriding Frame Step (0 uses the scene rate)",
+        min=0, soft_max=120,
+        default=0
+        )
+
+    use_anim_fcurve_eval = BoolProperty(
+        name="Direct F-Curve Sampling",
+        description=("Compute bones and shape keys driven only by their "
+                     "action straight from the F-curves instead of stepping "
+                     "through every frame. Constraints, IK, drivers, NLA "
+                     "tracks, animated objects and actions with reduced "
+                     "influence or blending still use frame stepping"),
+        default=False
+        )
+
+    use_anim_clips = BoolProperty(
+        name="Export Actions as Clips",
+        description=("Sample the armature's NLA strips, or all of its actions laid "
+                     "out on one timeline, in a single pass and write one "
+                     "animation clip per strip/action"),
+        default=False
+        )
+
+    use_anim_compact = BoolProperty(
+        name="Shared Animation Sources",
+        description=("Write all channels in one animation that shares its time "
+                     "and interpolation sources, instead of one copy per channel"),
+        default=False
+        )
+
+    use_anim_isolated_scene = BoolProperty(
+        name="Isolated Sampling Scene",
+        description=("Step frames in a temporary scene holding only the "
+                     "animated objects and what they depend on, instead of "
+                     "the whole scene"),
+        default=False
+        )
+
+    anim_bake_workers = IntProperty(
+        name="Bake Processes",
+        description=("Sample frames in this many background Blender processes "
+                     "on a snapshot of the file (0 or 1 samples in this one)"),
+        min=0, max=64,
+        soft_max=16,
+        default=0
+        )
+
+    use_anim_relevant_bones = BoolProperty(
+        name="Relevant Bones Only",
+        description=("Only animate bones with weights in an exported mesh, "
+                     "objects parented to them, or in the keep list, plus "
+                     "their parents. Without an exported skinned mesh, "
+                     "deform bones count as weighted"),
+        default=False
+        )
+
+    anim_keep_bones = StringProperty(
+        name="Keep Bones",
+        description="Comma separated names of bones that are always animated",
+        default=""
+        )
+
+    anim_channel_mode = EnumProperty(
+        name="Channels",
+        description="How sampled bone and object transforms are written",
+        items=(("MATRIX", "Matrix", "One 4x4 matrix track per bone"),
+               ("TRS", "Decomposed", "Separate location, euler rotation and "
+                "scale tracks, only for animated components")),
+        default="MATRIX"
+        )
+
+    anim_curve_fit = BoolProperty(
+        name="Fit Curves",
+        description=("Fit Bezier curves to decomposed channels and write only "
+                     "the keys needed to stay within the curve tolerance"),
+        default=False
+        )
+
+    anim_curve_tolerance = FloatProperty(
+        name="Curve Tolerance",
+        description=("Largest allowed difference between the fitted curve and "
+                     "the sampled values (units, or degrees for rotation)"),
+        min=0.0, soft_max=1.0,
+        precision=4,
+        default=0.001
+        )
+
     anim_optimize_precision = FloatProperty(
         name="Precision",
-        description=("Tolerence for comparing double keyframes "
-                     "(higher for greater accuracy)"),
+        description=("Keyframe tolerance as decimal places, keys within "
+                     "10^-precision are removed (higher for greater accuracy)"),
         min=1, max=16,
         soft_min=1, soft_max=16,
         default=16.0
@@ -965,7 +1142,11 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
         row1col3.prop(self, "use_normalize_vert_groups")
         row2col3.prop(self, "use_limit_total")
         row3col3.prop(self, "use_rest_pose")
-        row4col3.label("")
+        row4col3.prop(self, "use_static_batching")
+
+        if self.use_limit_total:
+            layout.prop(self, "weight_limit")
+        layout.prop(self, "use_nondestructive")
         #if self.use_mesh_modifiers:
         
         #col = layout.column(align=True)
@@ -979,7 +1160,26 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
             box.label("Animation Settings")
             if self.debug_mode:
                 box.prop(self, "anim_export_all_separate")
+                if self.anim_export_all_separate and not self.use_anim_clips:
+                    box.prop(self, "use_anim_cache")
             box.prop(self, "use_anim_skip_noexp")
+            box.prop(self, "use_anim_clips")
+            box.prop(self, "anim_use_action_range")
+            row = box.row(align=True)
+            row.prop(self, "anim_frame_step")
+            row.prop(self, "anim_target_fps")
+            box.prop(self, "use_anim_fcurve_eval")
+            box.prop(self, "use_anim_isolated_scene")
+            box.prop(self, "anim_bake_workers")
+            box.prop(self, "use_anim_relevant_bones")
+            if self.use_anim_relevant_bones:
+                box.prop(self, "anim_keep_bones")
+            box.prop(self, "anim_channel_mode")
+            if self.anim_channel_mode == "TRS":
+                row = box.row(align=True)
+                row.prop(self, "anim_curve_fit")
+                row.prop(self, "anim_curve_tolerance")
+            box.prop(self, "use_anim_compact")
             box.prop(self, "use_anim_optimize")
             box.prop(self, "anim_optimize_precision")
 
@@ -1002,6 +1202,12 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
             box.prop(self, "use_exclude_ctrl_bones")
             box.prop(self, "use_shape_key_export")
             box.prop(self, "use_copy_images")
+            if self.use_copy_images:
+                box.prop(self, "use_image_hardlinks")
+            box.prop(self, "chunk_size")
+            box.prop(self, "use_material_dedup")
+            box.prop(self, "float_precision")
+            box.prop(self, "use_export_cache")
             
     @property
     def check_extension(self):
@@ -1371,10 +1577,18 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
             if self.can_modify_object(context, obj):
                 targetObjects.append(obj)
 
+        nondestructive = self.use_nondestructive
+
         for obj in targetObjects:
             parent_not_exporting = (obj.parent is not None 
                 and not self.can_modify_object(context, obj.parent))
-            if not obj.parent or parent_not_exporting:
+            if nondestructive:
+                # The exporter writes roots whose parent isn't exported in world space
+                if not obj.parent or parent_not_exporting:
+                    modifyObjects.append(obj)
+                    modifyObjects.extend(childobj for childobj in obj.children
+                        if self.can_modify_object(context, childobj))
+            elif not obj.parent or parent_not_exporting:
                 print("[DOS2DE-Exporter] Copying object '{}'.".format(obj.name))
                 copy = self.copy_obj(context, obj)
                 modifyObjects.append(copy)
@@ -1402,6 +1616,11 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
         merging_enabled = hasattr(context.scene, "llexportmerge")
         
         for obj in modifyObjects:
+            if nondestructive:
+                # The exporter reads rest pose, modifiers and export names
+                # without writing to the originals
+                continue
+
             if obj.type == "ARMATURE":
                 if self.use_exclude_armature_modifier:
                     self.pose_apply(context, obj)
@@ -1419,65 +1638,6 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
                         childobj.llexportprops.prepare(context, childobj)
                         childobj.llexportprops.prepare_name(context, childobj)
                 export_props.prepare_name(context, obj)
-            
-            if self.yup_enabled == "ROTATE":
-                    if not obj.parent:
-                        print("  Rotating {} to y-up. | (x={}, y={}, z={})".format(obj.name, degrees(obj.rotation_euler[0]),
-                                    degrees(obj.rotation_euler[1]), degrees(obj.rotation_euler[2]))
-                                )
-                        obj.rotation_euler = (obj.rotation_euler.to_matrix() * Matrix.Rotation(radians(-90), 3, 'X')).to_euler()
-                        print("  Rotated {} to y-up. | (x={}, y={}, z={})".format(obj.name, degrees(obj.rotation_euler[0]),
-                                    degrees(obj.rotation_euler[1]), degrees(obj.rotation_euler[2]))
-                                )
-                        
-                        self.transform_apply(context, obj, rotation=True)
-
-                        for childobj in obj.children:
-                            childobj.select = True
-                            # rot_x = degrees(childobj.rotation_euler[0])
-                            # if rot_x != 0:
-                            #     parent_yup_applied = round(rot_x) == -90
-                            #     print("  Applying rotation transform to child {} | (x={})".format(childobj.name, rot_x))
-                            #     self.transform_apply(context, childobj, rotation=True)
-
-                            #     if parent_yup_applied == False:
-                            #         print("    Rotating child to y-up: (x={}, y={}, z={})".format(degrees(childobj.rotation_euler[0]),
-                            #                 degrees(childobj.rotation_euler[1]), degrees(childobj.rotation_euler[2]))
-                            #             )
-                            #         childobj.rotation_euler = (childobj.rotation_euler.to_matrix() * Matrix.Rotation(radians(-90), 3, 'X')).to_euler()
-                            #         print("      Rotated child {} to y-up. (x={})".format(childobj.name, degrees(childobj.rotation_euler[0])))
-                            #         self.transform_apply(context, childobj, rotation=True)
-
-                        bpy.context.scene.objects.active = obj
-                        obj.select = True
-                        bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
-                        bpy.ops.object.select_all(action='DESELECT')
-                        # print(" {} Final (x={}, y={}, z={})".format(obj.name, degrees(obj.rotation_euler[0]),
-                        #             degrees(obj.rotation_euler[1]), degrees(obj.rotation_euler[2]))
-                        #         )
-            
-            if self.xflip_armature and obj.type == "ARMATURE":
-                obj.scale = (-1.0, 1.0, 1.0)
-                self.transform_apply(context, obj, scale=True)
-                print("Flipped and applied scale transformation for {} ".format(obj.name))
-
-            if self.xflip_mesh and obj.type == "MESH":
-                self.transform_apply(context, obj, scale=True)
-                obj.scale = (-1.0, 1.0, 1.0)
-                self.transform_apply(context, obj, scale=True)
-                #bpy.ops.object.mode_set(mode="EDIT")
-                #bpy.ops.mesh.flip_normals()
-                #bpy.ops.object.mode_set(mode="OBJECT")
-                bm = bmesh.new()
-                bm.from_mesh(obj.data)
-                #bmesh.ops.recalc_face_normals(bm, faces=bm.faces)
-                bmesh.ops.reverse_faces(bm, faces=bm.faces)
-                bm.to_mesh(obj.data)
-                bm.clear()
-                obj.data.update()
-                self.transform_apply(context, obj, scale=True)
-                print("Flipped and applied scale transformation for {} ".format(obj.name))
-                #return {"FINISHED"}
 
             if self.use_mesh_modifiers and obj.type == "MESH":
                 hasArmature = "ARMATURE" in self.object_types
@@ -1523,24 +1683,6 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
                     obj.parent = None
                     obj.matrix_world = matrix_copy
 
-            if obj.type == "MESH" and obj.vertex_groups:
-                if self.use_limit_total:
-                    bpy.context.scene.objects.active = obj
-                    obj.select = True
-                    bpy.ops.object.mode_set(mode="WEIGHT_PAINT")
-                    bpy.ops.object.vertex_group_limit_total(limit=4)
-                    bpy.ops.object.mode_set(mode="OBJECT")
-                    print("Limited total vertex influences to 4 for {}.".format(obj.name))
-                    obj.select = False
-                if self.use_normalize_vert_groups:
-                    bpy.context.scene.objects.active = obj
-                    obj.select = True
-                    bpy.ops.object.mode_set(mode="WEIGHT_PAINT")
-                    bpy.ops.object.vertex_group_normalize_all()
-                    bpy.ops.object.mode_set(mode="OBJECT")
-                    print("Normalized vertex groups for {}.".format(obj.name))
-                    obj.select = False
-
         # Merging
         # if merging_enabled:
         #     print("Merging meshes.")
@@ -1564,29 +1706,64 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
 
         if self.batch_mode:
             if self.use_anim:
-                if self.anim_export_all_separate:
+                if self.anim_export_all_separate and not self.use_anim_clips:
                     print("[DOS2DE-Exporter] Exporting all actions as separate animation files.")
                     
                     armature = next(iter(list(filter(lambda obj: obj.type == "ARMATURE", modifyObjects))), None)
                     if armature is not None:
                         start_progress(len(bpy.data.actions), "Exporting animations to DAE... {}/{}")
 
+                        exports = []
                         for action in bpy.data.actions:
                             export_name = "{}_Anim_{}".format(armature.name, action.name)
                             if self.auto_name == "ACTION":
                                 export_name = action.name
                             
                             export_filepath = bpy.path.ensure_ext("{}\\{}".format(self.directory, export_name), self.filename_ext)
-                            print("[DOS2DE-Exporter] Setting action to '{}' and exporting as '{}'.".format(action.name, export_filepath))
-                            if armature.animation_data is None:
-                                armature.animation_data_create()
-                            armature.animation_data.action = action
-                            if export_dae.save(self, context, [armature], filepath=export_filepath, **keywords) == {"FINISHED"}:
+                            exports.append((action, export_filepath))
+
+                        manifest = None
+                        fingerprints = {}
+                        if self.use_anim_cache:
+                            manifest = anim_cache.AnimationManifest(self.directory)
+                            cache_options = dict(keywords)
+                            if self.convert_gr2:
+                                cache_options["gr2_options"] = self.build_gr2_options()
+                            rebuild = []
+                            for action, export_filepath in exports:
+                                digest = export_dae.action_fingerprint(context.scene, armature, action, cache_options)
+                                fingerprints[export_filepath] = digest
+                                if self.convert_gr2:
+                                    outputs = [str.replace(export_filepath, ".dae", ".gr2")]
+                                else:
+                                    outputs = [export_filepath]
+                                # Actions with drivers or animated constraint targets have no digest
+                                if digest is not None and manifest.is_current(export_filepath, digest, outputs):
+                                    print("[DOS2DE-Exporter] Action '{}' is unchanged, keeping '{}'.".format(action.name, outputs[0]))
+                                    update_progress(1)
+                                else:
+                                    rebuild.append((action, export_filepath))
+                            reused_count = len(exports) - len(rebuild)
+                            exports = rebuild
+
+                        # One session: the skeleton is prepared once, then each action is sampled
+                        results = []
+                        if len(exports) > 0:
+                            results = export_dae.save_actions(self, context, armature, exports, **keywords)
+                        for (action, export_filepath), success in zip(exports, results):
+                            if success:
                                 exported_pathways.append(export_filepath)
+                                if manifest is not None and fingerprints.get(export_filepath) is not None:
+                                    manifest.store(export_filepath, fingerprints[export_filepath])
                             else:
                                 report(self, "[DOS2DE-Exporter] Failed to export '{}'.".format(export_filepath))
 
                             update_progress(1)
+
+                        if manifest is not None:
+                            manifest.save()
+                            report(self, "[DOS2DE-Exporter] Rebuilt {} actions, reused {}.".format(
+                                sum(1 for r in results if r), reused_count), "INFO")
                     result = {"FINISHED"}
                     finish_progress("All files exported.")
                 else:
@@ -1633,28 +1810,29 @@ class DIVINITYEXPORTER_OT_export_collada(Operator, ExportHelper):
             if obj is not None:
                 obj.select = True
 
-        bpy.ops.object.delete(use_global=True)
+        if copies:
+            bpy.ops.object.delete(use_global=True)
 
-        #Cleanup
-        for block in bpy.data.meshes:
-            if block.users == 0:
-                bpy.data.meshes.remove(block)
+            #Cleanup
+            for block in bpy.data.meshes:
+                if block.users == 0:
+                    bpy.data.meshes.remove(block)
 
-        for block in bpy.data.armatures:
-            if block.users == 0:
-                bpy.data.armatures.remove(block)
+            for block in bpy.data.armatures:
+                if block.users == 0:
+                    bpy.data.armatures.remove(block)
 
-        for block in bpy.data.materials:
-            if block.users == 0:
-                bpy.data.materials.remove(block)
+            for block in bpy.data.materials:
+                if block.users == 0:
+                    bpy.data.materials.remove(block)
 
-        for block in bpy.data.textures:
-            if block.users == 0:
-                bpy.data.textures.remove(block)
+            for block in bpy.data.textures:
+                if block.users == 0:
+                    bpy.data.textures.remove(block)
 
-        for block in bpy.data.images:
-            if block.users == 0:
-                bpy.data.images.remove(block)
+            for block in bpy.data.images:
+                if block.users == 0:
+                    bpy.data.images.remove(block)
 
         bpy.ops.object.select_all(action='DESELECT')
         
@@ -0,0 +1,83 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+"""
+Background worker for parallel animation baking.
+
+The exporter saves a snapshot of the file and runs this script in several
+local background Blender processes:
+
+    blender --background snapshot.blend --python anim_bake_worker.py -- job.json
+
+Each job names a scene, a slice of frames and the bones, shape keys and
+objects to sample. Objects are sampled relative to the given parent. The samples are written to the job's output .npz file.
+"""
+
+import sys
+import json
+import math
+
+import bpy
+import numpy as np
+
+
+def run(job):
+    scene = bpy.data.scenes[job["scene"]]
+    frames = job["frames"]
+    count = len(frames)
+
+    armatures = []
+    for name, bone_names in job["armatures"]:
+        pose = bpy.data.objects[name].pose
+        armatures.append([pose.bones[b] for b in bone_names])
+    morphs = [bpy.data.objects[name].data.shape_keys.key_blocks[key]
+              for name, key in job["morphs"]]
+    objects = [(bpy.data.objects[name], bpy.data.objects.get(parent or ""))
+               for name, parent in job["objects"]]
+
+    poses = [np.empty((count, len(b), 4, 4)) for b in armatures]
+    scales = [np.empty((count, len(b), 3)) for b in armatures]
+    morph_values = np.empty((count, len(morphs)))
+    object_matrices = np.empty((count, len(objects), 4, 4))
+
+    for fi, t in enumerate(frames):
+        frame = int(math.floor(t))
+        scene.frame_set(frame, t - frame)
+
+        for a, posebones in enumerate(armatures):
+            for i, posebone in enumerate(posebones):
+                poses[a][fi, i] = posebone.matrix
+                scales[a][fi, i] = posebone.scale
+        for i, key_block in enumerate(morphs):
+            morph_values[fi, i] = key_block.value
+        for i, (obj, parent) in enumerate(objects):
+            mtx = obj.matrix_world.copy()
+            if (parent is not None):
+                mtx = parent.matrix_world.inverted_safe() * mtx
+            object_matrices[fi, i] = mtx
+
+    arrays = {"morphs": morph_values, "objects": object_matrices}
+    for a in range(len(armatures)):
+        arrays["pose{}".format(a)] = poses[a]
+        arrays["scale{}".format(a)] = scales[a]
+    np.savez(job["output"], **arrays)
+
+
+if __name__ == "__main__":
+    with open(sys.argv[sys.argv.index("--") + 1], "r") as f:
+        run(json.load(f))
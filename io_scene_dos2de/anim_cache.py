@@ -0,0 +1,86 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+"""
+Manifest of exported animation files and the fingerprints they were
+built from.
+
+Stored as JSON in the export folder, so re-exporting a batch of actions
+only rebuilds the files whose action, rig or export options changed.
+"""
+
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = ".dos2de_anim_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def fingerprint(data):
+    """Hash a nested structure of tuples, lists and plain values."""
+    return hashlib.sha1(repr(data).encode("utf-8")).hexdigest()
+
+
+def plain_options(options):
+    """The export options that can be compared between sessions."""
+    plain = []
+    for k in sorted(options):
+        v = options[k]
+        if isinstance(v, (set, frozenset)):
+            v = sorted(v)
+        if isinstance(v, (bool, int, float, str, list)):
+            plain.append((k, v))
+    return plain
+
+
+class AnimationManifest:
+    def is_current(self, path, digest, outputs):
+        """True if path was built from digest and every output exists."""
+        entry = self.entries.get(os.path.normcase(os.path.abspath(path)))
+        if entry != digest:
+            return False
+        return all(os.path.isfile(p) for p in outputs)
+
+    def store(self, path, digest):
+        self.entries[os.path.normcase(os.path.abspath(path))] = digest
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get("version") == MANIFEST_VERSION:
+            self.entries = data.get("files", {})
+
+    def save(self):
+        try:
+            with open(self.path, "w") as f:
+                json.dump({"version": MANIFEST_VERSION, "files": self.entries},
+                          f, indent=1, sort_keys=True)
+        except (IOError, OSError) as e:
+            print("[DOS2DE-Exporter] Failed to save animation manifest "
+                  "'{}': {}".format(self.path, e))
+
+    __slots__ = ("path", "entries")
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.entries = {}
+        self.load()
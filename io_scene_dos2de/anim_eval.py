@@ -0,0 +1,211 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+"""
+Pose evaluation straight from an armature's action F-curves.
+
+scene.frame_set re-evaluates the whole scene for every frame. Bones and
+shape keys that are only moved by their action can instead be computed
+from the F-curves, and the rest pose, for every frame at once. Anything
+that needs the dependency graph (constraints, IK, drivers, NLA, action
+influence or blending, non-default inheritance) is left to frame
+stepping.
+"""
+
+import re
+
+from mathutils import Euler, Matrix, Quaternion, Vector
+
+BONE_PATH = re.compile(r'^pose\.bones\["(.+)"\]\.(\w+)$')
+
+SHAPE_KEY_PATH = re.compile(r'^key_blocks\["(.+)"\]\.value$')
+
+TRANSFORM_CHANNELS = ("location", "rotation_quaternion", "rotation_euler",
+                      "rotation_axis_angle", "scale")
+
+IK_CONSTRAINTS = ("IK", "SPLINE_IK")
+
+
+def plays_action_as_is(animation_data):
+    """True if the active action is all that animates the data block,
+    applied with full influence and without blending or extrapolation
+    changes, so its F-curves give the animated values directly."""
+    return (animation_data.action is not None and
+            len(animation_data.nla_tracks) == 0 and
+            animation_data.action_influence == 1.0 and
+            animation_data.action_blend_type == "REPLACE" and
+            animation_data.action_extrapolation == "HOLD")
+
+
+def shape_key_values(key_block, frames):
+    """Values of a shape key at every frame, or None if they need the
+    dependency graph because of drivers, NLA or action blending."""
+    key = key_block.id_data
+    animation_data = key.animation_data
+    if (animation_data is None):
+        return [key_block.value] * len(frames)
+
+    for d in animation_data.drivers:
+        match = SHAPE_KEY_PATH.match(d.data_path)
+        if (match and match.group(1) == key_block.name):
+            return None
+
+    fcurve = None
+    if (animation_data.action is not None):
+        for fc in animation_data.action.fcurves:
+            match = SHAPE_KEY_PATH.match(fc.data_path)
+            if (match and match.group(1) == key_block.name and not fc.mute):
+                fcurve = fc
+                break
+    if (fcurve is None):
+        if (len(animation_data.nla_tracks) > 0):
+            return None
+        return [key_block.value] * len(frames)
+    if (not plays_action_as_is(animation_data)):
+        return None
+
+    # The value is clamped to the slider range like any animated write
+    low = key_block.slider_min
+    high = key_block.slider_max
+    return [min(max(fcurve.evaluate(frame), low), high) for frame in frames]
+
+
+class FCurvePoseEvaluator:
+    """Classifies an armature's bones and evaluates the pure ones."""
+
+    def classify(self):
+        node = self.node
+        animation_data = node.animation_data
+        if (animation_data is None or
+                not plays_action_as_is(animation_data)):
+            return set()
+
+        for posebone in node.pose.bones:
+            for c in posebone.constraints:
+                if c.type in IK_CONSTRAINTS:
+                    # IK moves the whole chain, not just the owner
+                    return set()
+
+        driven = set()
+        for d in animation_data.drivers:
+            match = BONE_PATH.match(d.data_path)
+            if match:
+                driven.add(match.group(1))
+
+        pure = set()
+        # Parents come before children in armature.bones
+        for bone in node.data.bones:
+            posebone = node.pose.bones[bone.name]
+            if (bone.parent is not None and bone.parent.name not in pure):
+                continue
+            if (len(posebone.constraints) > 0 or bone.name in driven):
+                continue
+            if (not bone.use_inherit_rotation or not bone.use_inherit_scale or
+                    not bone.use_local_location):
+                continue
+            if (bone.use_connect and
+                    (bone.name, "location") in self.channels):
+                continue
+            pure.add(bone.name)
+        return pure
+
+    def read_channels(self):
+        channels = {}
+        for fcurve in self.node.animation_data.action.fcurves:
+            match = BONE_PATH.match(fcurve.data_path)
+            if (not match or match.group(2) not in TRANSFORM_CHANNELS or
+                    fcurve.mute):
+                continue
+            key = (match.group(1), match.group(2))
+            if key not in channels:
+                channels[key] = {}
+            channels[key][fcurve.array_index] = fcurve
+        return channels
+
+    def channel_values(self, name, channel, default, frame):
+        values = list(default)
+        fcurves = self.channels.get((name, channel))
+        if fcurves:
+            for i, fcurve in fcurves.items():
+                values[i] = fcurve.evaluate(frame)
+        return values
+
+    def basis_matrix(self, posebone, frame):
+        name = posebone.name
+        location = self.channel_values(name, "location", posebone.location,
+                                       frame)
+        scale = self.channel_values(name, "scale", posebone.scale, frame)
+        mode = posebone.rotation_mode
+        if mode == "QUATERNION":
+            rotation = Quaternion(self.channel_values(
+                name, "rotation_quaternion", posebone.rotation_quaternion,
+                frame)).normalized().to_matrix().to_4x4()
+        elif mode == "AXIS_ANGLE":
+            angle, x, y, z = self.channel_values(
+                name, "rotation_axis_angle", posebone.rotation_axis_angle,
+                frame)
+            rotation = Matrix.Rotation(angle, 4, Vector((x, y, z)))
+        else:
+            rotation = Euler(self.channel_values(
+                name, "rotation_euler", posebone.rotation_euler, frame),
+                mode).to_matrix().to_4x4()
+
+        scale_matrix = Matrix.Identity(4)
+        for i in range(3):
+            scale_matrix[i][i] = scale[i]
+        return Matrix.Translation(location) * rotation * scale_matrix, scale
+
+    def evaluate(self, frames):
+        """Return {bone name: ([pose matrix], [scale])} for the pure bones.
+
+        Pose matrices are in armature space, like PoseBone.matrix.
+        """
+        result = {}
+        node = self.node
+        for bone in node.data.bones:
+            if bone.name not in self.pure:
+                continue
+            posebone = node.pose.bones[bone.name]
+            if bone.parent is not None:
+                rest = bone.parent.matrix_local.inverted_safe() * bone.matrix_local
+                parent_matrices = result[bone.parent.name][0]
+            else:
+                rest = bone.matrix_local
+                parent_matrices = None
+
+            matrices = []
+            scales = []
+            for i, frame in enumerate(frames):
+                basis, scale = self.basis_matrix(posebone, frame)
+                mtx = rest * basis
+                if parent_matrices is not None:
+                    mtx = parent_matrices[i] * mtx
+                matrices.append(mtx)
+                scales.append(scale)
+            result[bone.name] = (matrices, scales)
+        return result
+
+    __slots__ = ("node", "channels", "pure")
+
+    def __init__(self, node):
+        self.node = node
+        self.channels = {}
+        if (node.animation_data is not None and
+                node.animation_data.action is not None):
+            self.channels = self.read_channels()
+        self.pure = self.classify()
@@ -0,0 +1,271 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+"""
+Array operations on sampled animation tracks.
+
+A track is a list of key times and a (keys, width) array of values, with
+width 16 for flattened 4x4 matrices and 1 for morph weights.
+"""
+
+import numpy as np
+
+# Parent matrices with a smaller determinant can't be inverted
+SINGULAR_EPSILON = 1e-12
+
+
+def reduce_keys(times, values, tolerance):
+    """Return the indices of the keys needed to reproduce a track.
+
+    Constant tracks collapse to their first key. Interior keys are dropped
+    while linear interpolation between the surrounding kept keys stays
+    within tolerance of every dropped sample.
+    """
+    times = np.asarray(times, dtype=np.float64).ravel()
+    values = np.asarray(values, dtype=np.float64).reshape(len(times), -1)
+    count = len(times)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    if np.all(np.abs(values - values[0]) <= tolerance):
+        return np.zeros(1, dtype=np.int64)
+    if count <= 2:
+        return np.arange(count)
+
+    keep = [0]
+    anchor = 0
+    for i in range(2, count):
+        span = slice(anchor + 1, i)
+        t = (times[span] - times[anchor]) / (times[i] - times[anchor])
+        interp = values[anchor] + t[:, None] * (values[i] - values[anchor])
+        if np.any(np.abs(interp - values[span]) > tolerance):
+            keep.append(i - 1)
+            anchor = i - 1
+    keep.append(count - 1)
+    return np.array(keep, dtype=np.int64)
+
+
+def hermite_segment(times, values, slopes, start, end):
+    """Evaluate the cubic between two keys at every sample in between."""
+    dt = times[end] - times[start]
+    s = (times[start + 1:end] - times[start]) / dt
+    s2 = s * s
+    s3 = s2 * s
+    return ((2 * s3 - 3 * s2 + 1) * values[start] +
+            (s3 - 2 * s2 + s) * dt * slopes[start] +
+            (-2 * s3 + 3 * s2) * values[end] +
+            (s3 - s2) * dt * slopes[end])
+
+
+def sample_slopes(times, values):
+    """Finite-difference slope at every sample of a track.
+
+    Interior slopes average the neighbouring secants weighted by the
+    opposite spacing, the second order estimate for uneven times. The end
+    slopes are the one-sided secants. Needs at least two samples.
+    """
+    spacing = np.diff(times)
+    secants = np.diff(values) / spacing
+    slopes = np.empty(len(times))
+    slopes[0] = secants[0]
+    slopes[-1] = secants[-1]
+    slopes[1:-1] = ((spacing[1:] * secants[:-1] + spacing[:-1] * secants[1:])
+                    / (spacing[:-1] + spacing[1:]))
+    return slopes
+
+
+def fit_bezier(times, values, tolerance):
+    """Fit a scalar track with cubic Bezier segments.
+
+    Slopes are taken from the samples, then interior keys are dropped while
+    the curve between the surrounding kept keys stays within tolerance of
+    every dropped sample. Control points sit a third of the segment away
+    from each key, so time stays linear along every segment. Returns the
+    kept indices and the (time, value) in and out tangents of those keys.
+    """
+    times = np.asarray(times, dtype=np.float64).ravel()
+    values = np.asarray(values, dtype=np.float64).ravel()
+    count = len(times)
+    if count == 0:
+        empty = np.zeros((0, 2))
+        return np.zeros(0, dtype=np.int64), empty, empty
+    if count == 1 or np.all(np.abs(values - values[0]) <= tolerance):
+        point = np.array([[times[0], values[0]]])
+        return np.zeros(1, dtype=np.int64), point, point.copy()
+
+    slopes = sample_slopes(times, values)
+
+    keep = [0]
+    anchor = 0
+    for i in range(2, count):
+        curve = hermite_segment(times, values, slopes, anchor, i)
+        if np.any(np.abs(curve - values[anchor + 1:i]) > tolerance):
+            keep.append(i - 1)
+            anchor = i - 1
+    keep.append(count - 1)
+    keep = np.array(keep, dtype=np.int64)
+
+    kt = times[keep]
+    kv = values[keep]
+    ks = slopes[keep]
+    gaps = np.diff(kt) / 3.0
+    before = np.concatenate((gaps[:1], gaps))
+    after = np.concatenate((gaps, gaps[-1:]))
+    in_tangents = np.stack((kt - before, kv - ks * before), axis=1)
+    out_tangents = np.stack((kt + after, kv + ks * after), axis=1)
+    return keep, in_tangents, out_tangents
+
+
+def decompose_matrices(matrices):
+    """Split 4x4 matrices into translation, XYZ euler degrees and scale.
+
+    The euler order matches Blender's XYZ mode and the Collada element
+    order translate, rotateZ, rotateY, rotateX, scale. Angles are unwrapped
+    over the keys so interpolation never takes the long way round.
+    """
+    m = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    translation = m[:, :3, 3].copy()
+    basis = m[:, :3, :3]
+    scale = np.sqrt((basis * basis).sum(axis=1))
+    scale[np.linalg.det(basis) < 0.0, 0] *= -1.0
+    rot = basis / np.where(scale == 0.0, 1.0, scale)[:, None, :]
+
+    y = np.arcsin(np.clip(-rot[:, 2, 0], -1.0, 1.0))
+    gimbal = np.abs(np.cos(y)) < 1e-6
+    x = np.where(gimbal, 0.0, np.arctan2(rot[:, 2, 1], rot[:, 2, 2]))
+    z = np.where(gimbal, np.arctan2(-rot[:, 0, 1], rot[:, 1, 1]),
+                 np.arctan2(rot[:, 1, 0], rot[:, 0, 0]))
+    euler = np.unwrap(np.stack((x, y, z), axis=1), axis=0)
+    return translation, np.degrees(euler), scale
+
+
+def decompose_matrix(matrix):
+    """Decompose one 4x4 matrix, see decompose_matrices."""
+    translation, rotation, scale = decompose_matrices([matrix])
+    return translation[0], rotation[0], scale[0]
+
+
+def local_basis_correction(world, basis):
+    """World space matrix that turns an object's rotation by basis on its
+    local side.
+
+    For world = T * R * S this is T * R * basis * R^-1 * T^-1. The
+    rotation comes from the polar decomposition, so it needs no inverse of
+    world and also works for objects with a zero scale axis.
+    """
+    world = np.asarray(world, dtype=np.float64)
+    u, sigma, vt = np.linalg.svd(world[:3, :3])
+    rotation = u.dot(vt)
+    linear = rotation.dot(np.asarray(basis, dtype=np.float64)[:3, :3]).dot(
+        rotation.T)
+    correction = np.eye(4)
+    correction[:3, :3] = linear
+    correction[:3, 3] = world[:3, 3] - linear.dot(world[:3, 3])
+    return correction
+
+
+def local_basis_change(world, basis):
+    """Apply a basis change on the local side of a world matrix's rotation.
+
+    For world = T * R * S the result is T * R * basis * S, what rotating
+    an object by basis in its own rotation and applying its transform
+    gives. Assumes world has no shear.
+    """
+    return local_basis_correction(world, basis).dot(world)
+
+
+def yup_data_matrix(correction, world, mirror=None):
+    """World transform baked into an object's data under y-up conversion.
+
+    correction is the object's root local_basis_correction. The mirror is
+    applied last, on the world side, as the old operator passes mirrored
+    objects after turning and applying them.
+    """
+    matrix = np.asarray(correction, dtype=np.float64).dot(world)
+    if mirror is not None:
+        matrix = np.asarray(mirror, dtype=np.float64).dot(matrix)
+    return matrix
+
+
+def trs_tracks(matrices, rest=None, tolerance=1e-6):
+    """Return the animated (component, values) tracks of matrix keys.
+
+    rest is the decomposed (translation, rotation, scale) written on the
+    node. Components that stay at their rest value are left out; without a
+    rest value every component is returned.
+    """
+    translation, rotation, scale = decompose_matrices(matrices)
+    tracks = [
+        ("location", translation, 0, slice(0, 3)),
+        ("rotationZ", rotation[:, 2:3], 1, slice(2, 3)),
+        ("rotationY", rotation[:, 1:2], 1, slice(1, 2)),
+        ("rotationX", rotation[:, 0:1], 1, slice(0, 1)),
+        ("scale", scale, 2, slice(0, 3)),
+    ]
+    animated = []
+    for component, values, part, columns in tracks:
+        if rest is not None:
+            rest_value = np.asarray(rest[part], dtype=np.float64)[columns]
+            if np.all(np.abs(values - rest_value) <= tolerance):
+                continue
+        animated.append((component, values))
+    return animated
+
+
+def local_bone_matrices(pose, scales, indices, parent_indices):
+    """Compute parent-relative bone matrices for every frame at once.
+
+    pose is (frames, pose bones, 4, 4) in armature space and scales the
+    matching (frames, pose bones, 3) pose scales. indices and
+    parent_indices select each exported bone and its parent, with -1 for
+    no parent. A parent with a zero scale component is ignored for that
+    frame, the bone keeps its armature space matrix. Other singular parents,
+    such as bones below a zero scaled one, use a pseudo-inverse.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    parent_indices = np.asarray(parent_indices, dtype=np.int64)
+    child = pose[:, indices]
+    result = child.copy()
+    has_parent = parent_indices >= 0
+    if not np.any(has_parent):
+        return result
+
+    parents = parent_indices[has_parent]
+    visible = np.all(scales[:, parents] != 0.0, axis=2)[..., None, None]
+    parent = np.where(visible, pose[:, parents], np.eye(4))
+    singular = np.abs(np.linalg.det(parent)) < SINGULAR_EPSILON
+    inverse = np.empty_like(parent)
+    inverse[~singular] = np.linalg.inv(parent[~singular])
+    for i in zip(*np.nonzero(singular)):
+        inverse[i] = np.linalg.pinv(parent[i])
+    local = np.matmul(inverse, child[:, has_parent])
+    result[:, has_parent] = np.where(visible, local, child[:, has_parent])
+    return result
+
+
+def relevant_bone_names(parents, seeds):
+    """Names of the seed bones and all of their ancestors.
+
+    parents maps every bone name to its parent's name or None. Seeds that
+    aren't in parents are ignored.
+    """
+    relevant = set()
+    for name in seeds:
+        while name in parents and name not in relevant:
+            relevant.add(name)
+            name = parents[name]
+    return relevant
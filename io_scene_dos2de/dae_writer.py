@@ -0,0 +1,962 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""
+Collada section writer shared by the Blender exporter and the standalone
+export cache.
+
+Nothing in this module may import bpy. Geometry, skin controllers and
+animation channels are kept as array blocks until the file is written, so
+the same blocks can be saved to a compressed .npz next to the DAE and
+re-serialized later with different output options:
+
+    python dae_writer.py model.npz -o model.dae --precision 6 --no-tangents
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+# According to collada spec, order matters
+S_ASSET = 0
+S_IMGS = 1
+S_FX = 2
+S_MATS = 3
+S_GEOM = 4
+S_MORPH = 5
+S_SKIN = 6
+S_CONT = 7
+S_CAMS = 8
+S_LAMPS = 9
+S_ANIM_CLIPS = 10
+S_NODES = 11
+S_ANIM = 12
+
+CACHE_VERSION = 1
+
+# Config keys that change how blocks are written. These are stored in the
+# export cache and can be overridden when re-serializing.
+RENDER_OPTIONS = ("float_precision", "use_tangent", "use_triangles",
+                  "extra_data_disabled", "extras", "use_anim_compact")
+
+MODEL_TYPE_TAGS = {
+    "rigid": "<DivModelType>Rigid</DivModelType>",
+    "cloth": "<DivModelType>Cloth</DivModelType>",
+    "meshproxy": "<DivModelType>MeshProxy</DivModelType>",
+    "rigidcloth": "<DivModelType>Rigid</DivModelType>"
+                  "<DivModelType>Cloth</DivModelType>",
+}
+
+
+def format_floats(values, precision=0):
+    """Return a flat float sequence as " a b c", rounded if precision > 0."""
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if precision:
+        values = np.round(values, precision)
+    if len(values) == 0:
+        return ""
+    return " " + " ".join(map(repr, values.tolist()))
+
+
+def format_ints(values):
+    values = np.asarray(values, dtype=np.int64).ravel()
+    if len(values) == 0:
+        return ""
+    return " " + " ".join(map(str, values.tolist()))
+
+
+def format_matrices(matrices, precision=0):
+    """Format 4x4 matrices the same way export_dae.strmtx joins them."""
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 16)
+    if precision:
+        matrices = np.round(matrices, precision)
+    s = ""
+    for m in matrices.tolist():
+        s += "  {}  ".format(" ".join(map(repr, m)))
+    return s
+
+
+def triangulate_polygons(counts, indices):
+    """Fan-triangulate a flat polygon index buffer."""
+    counts = np.asarray(counts, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(counts) == 0 or np.all(counts == 3):
+        return counts, indices
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    tris = np.maximum(counts - 2, 0)
+    first = np.repeat(starts, tris)
+    # Offset of each fan triangle inside its polygon (0, 1, 2...)
+    offsets = np.arange(tris.sum()) - np.repeat(np.cumsum(tris) - tris, tris)
+    fan = np.stack((indices[first], indices[first + offsets + 1],
+                    indices[first + offsets + 2]), axis=1)
+    return np.full(len(fan), 3, dtype=np.int64), fan.ravel()
+
+
+class GeometryBlock:
+    """Mesh arrays written as a <geometry> element."""
+
+    block_type = "geometry"
+
+    def __init__(self, geometry_id, name, positions, normals, tangents=None,
+                 binormals=None, bitangents=None, uvs=None, colors=None,
+                 surfaces=None, model_type=""):
+        self.geometry_id = geometry_id
+        self.name = name
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        self.normals = np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+        self.tangents = self.optional(tangents, 3)
+        self.binormals = self.optional(binormals, 3)
+        self.bitangents = self.optional(bitangents, 3)
+        self.uvs = self.optional(uvs, 2)
+        self.colors = self.optional(colors, 3)
+        # (material symbol or None, polygon sizes, flat vertex indices)
+        self.surfaces = []
+        for symbol, counts, indices in (surfaces or []):
+            self.surfaces.append((
+                symbol,
+                np.asarray(counts, dtype=np.int64).ravel(),
+                np.asarray(indices, dtype=np.int64).ravel()))
+        self.model_type = model_type
+
+    @staticmethod
+    def optional(values, width):
+        if values is None:
+            return None
+        return np.asarray(values, dtype=np.float64).reshape(-1, width)
+
+    def source(self, out, suffix, values, params, precision):
+        gid = self.geometry_id
+        count = len(values)
+        out.append((3, "<source id=\"{}-{}\">".format(gid, suffix)))
+        out.append((
+            4, "<float_array id=\"{}-{}-array\" count=\"{}\">{}</float_array>"
+            .format(gid, suffix, values.size,
+                    format_floats(values, precision))))
+        out.append((4, "<technique_common>"))
+        out.append((
+            4, "<accessor source=\"#{}-{}-array\" count=\"{}\" stride=\"{}\">"
+            .format(gid, suffix, count, len(params))))
+        for p in params:
+            out.append((5, "<param name=\"{}\" type=\"float\"/>".format(p)))
+        out.append((4, "</accessor>"))
+        out.append((4, "</technique_common>"))
+        out.append((3, "</source>"))
+
+    def render(self, options):
+        precision = options.get("float_precision", 0)
+        triangulate = options.get("use_triangles", True)
+        has_tangents = (self.tangents is not None and
+                        options.get("use_tangent", True))
+        gid = self.geometry_id
+        xyz = ("X", "Y", "Z")
+
+        out = []
+        out.append((1, "<geometry id=\"{}\" name=\"{}\">".format(
+            gid, self.name)))
+        out.append((2, "<mesh>"))
+
+        self.source(out, "positions", self.positions, xyz, precision)
+        self.source(out, "normals", self.normals, xyz, precision)
+        if has_tangents:
+            self.source(out, "tangents", self.tangents, xyz, precision)
+            self.source(out, "binormals", self.binormals, xyz, precision)
+            self.source(out, "bitangents", self.bitangents, xyz, precision)
+        if self.uvs is not None:
+            self.source(out, "uvs0", self.uvs, ("S", "T"), precision)
+        if self.colors is not None:
+            self.source(out, "colors", self.colors, xyz, precision)
+
+        out.append((3, "<vertices id=\"{}-vertices\">".format(gid)))
+        out.append((
+            4, "<input semantic=\"POSITION\" source=\"#{}-positions\"/>"
+            .format(gid)))
+        out.append((3, "</vertices>"))
+
+        prim_type = "triangles" if triangulate else "polygons"
+
+        for symbol, counts, indices in self.surfaces:
+            if triangulate:
+                counts, indices = triangulate_polygons(counts, indices)
+            if symbol is not None:
+                out.append((3, "<{} count=\"{}\" material=\"{}\">".format(
+                    prim_type, len(counts), symbol)))
+            else:
+                out.append((3, "<{} count=\"{}\">".format(
+                    prim_type, len(counts))))
+
+            out.append((
+                4, "<input semantic=\"VERTEX\" source=\"#{}-vertices\" "
+                "offset=\"0\"/>".format(gid)))
+            out.append((
+                4, "<input semantic=\"NORMAL\" source=\"#{}-normals\" "
+                "offset=\"0\"/>".format(gid)))
+            if self.uvs is not None:
+                out.append((
+                    4, "<input semantic=\"TEXCOORD\" source=\"#{}-uvs0\" "
+                    "offset=\"0\" set=\"0\"/>".format(gid)))
+            if self.colors is not None:
+                out.append((
+                    4, "<input semantic=\"COLOR\" source=\"#{}-colors\" "
+                    "offset=\"0\"/>".format(gid)))
+            if has_tangents:
+                out.append((
+                    4, "<input semantic=\"TANGENT\" source=\"#{}-tangents\" "
+                    "offset=\"0\"/>".format(gid)))
+                out.append((
+                    4, "<input semantic=\"BINORMAL\" source=\"#{}-binormals\" "
+                    "offset=\"0\"/>".format(gid)))
+
+            if triangulate:
+                out.append((4, "<p>{} </p>".format(format_ints(indices))))
+            else:
+                start = 0
+                for c in counts.tolist():
+                    out.append((4, "<p>{} </p>".format(
+                        format_ints(indices[start:start + c]))))
+                    start += c
+
+            out.append((3, "</{}>".format(prim_type)))
+
+        # LSLib model type / extra data
+        if not options.get("extra_data_disabled", False):
+            model_type = self.model_type
+            extras = options.get("extras")
+            if extras and extras != "DISABLED":
+                model_type = extras.lower()
+            out.append((3, "<extra>"))
+            out.append((4, "<technique profile=\"LSTools\">"))
+            out.append((5, MODEL_TYPE_TAGS.get(
+                model_type, "<DivModelType>Normal</DivModelType>")))
+            out.append((4, "</technique>"))
+            out.append((3, "</extra>"))
+
+        out.append((2, "</mesh>"))
+        out.append((1, "</geometry>"))
+        return out
+
+    def meta(self):
+        return {
+            "geometry_id": self.geometry_id,
+            "name": self.name,
+            "symbols": [s[0] for s in self.surfaces],
+            "model_type": self.model_type,
+        }
+
+    def arrays(self):
+        arrays = {"positions": self.positions, "normals": self.normals}
+        for name in ("tangents", "binormals", "bitangents", "uvs", "colors"):
+            values = getattr(self, name)
+            if values is not None:
+                arrays[name] = values
+        for i, (symbol, counts, indices) in enumerate(self.surfaces):
+            arrays["counts{}".format(i)] = counts
+            arrays["indices{}".format(i)] = indices
+        return arrays
+
+    @classmethod
+    def from_cache(cls, meta, arrays):
+        surfaces = []
+        for i, symbol in enumerate(meta["symbols"]):
+            surfaces.append((symbol, arrays["counts{}".format(i)],
+                             arrays["indices{}".format(i)]))
+        return cls(meta["geometry_id"], meta["name"], arrays["positions"],
+                   arrays["normals"], tangents=arrays.get("tangents"),
+                   binormals=arrays.get("binormals"),
+                   bitangents=arrays.get("bitangents"),
+                   uvs=arrays.get("uvs"), colors=arrays.get("colors"),
+                   surfaces=surfaces, model_type=meta["model_type"])
+
+
+class SkinBlock:
+    """Skin influence tables written as a <controller><skin> element."""
+
+    block_type = "skin"
+
+    def __init__(self, controller_id, source, bind_shape_matrix, joint_names,
+                 bind_poses, counts, bones, weights):
+        self.controller_id = controller_id
+        self.source = source
+        self.bind_shape_matrix = np.asarray(
+            bind_shape_matrix, dtype=np.float64).reshape(4, 4)
+        self.joint_names = list(joint_names)
+        self.bind_poses = np.asarray(
+            bind_poses, dtype=np.float64).reshape(-1, 4, 4)
+        # Variable-length influences per vertex: counts[i] entries of
+        # bones/weights belong to vertex i.
+        self.counts = np.asarray(counts, dtype=np.int64).ravel()
+        self.bones = np.asarray(bones, dtype=np.int64).ravel()
+        self.weights = np.asarray(weights, dtype=np.float64).ravel()
+
+    def render(self, options):
+        precision = options.get("float_precision", 0)
+        cid = self.controller_id
+        joint_count = len(self.joint_names)
+        weight_count = len(self.weights)
+
+        out = []
+        out.append((1, "<controller id=\"{}\">".format(cid)))
+        out.append((2, "<skin source=\"#{}\">".format(self.source)))
+        out.append((3, "<bind_shape_matrix>{}</bind_shape_matrix>".format(
+            format_matrices(self.bind_shape_matrix, precision)[1:])))
+
+        # Joint Names
+        out.append((3, "<source id=\"{}-joints\">".format(cid)))
+        out.append((
+            4, "<Name_array id=\"{}-joints-array\" count=\"{}\">{}</Name_array>"
+            .format(cid, joint_count,
+                    "".join(" {}".format(n) for n in self.joint_names))))
+        out.append((4, "<technique_common>"))
+        out.append((
+            4, "<accessor source=\"#{}-joints-array\" count=\"{}\" "
+            "stride=\"1\">".format(cid, joint_count)))
+        out.append((5, "<param name=\"JOINT\" type=\"Name\"/>"))
+        out.append((4, "</accessor>"))
+        out.append((4, "</technique_common>"))
+        out.append((3, "</source>"))
+
+        # Pose Matrices!
+        out.append((3, "<source id=\"{}-bind_poses\">".format(cid)))
+        out.append((
+            4, "<float_array id=\"{}-bind_poses-array\" count=\"{}\">{}"
+            "</float_array>".format(
+                cid, len(self.bind_poses) * 16,
+                format_matrices(self.bind_poses, precision))))
+        out.append((4, "<technique_common>"))
+        out.append((
+            4, "<accessor source=\"#{}-bind_poses-array\" count=\"{}\" "
+            "stride=\"16\">".format(cid, len(self.bind_poses))))
+        out.append((5, "<param name=\"TRANSFORM\" type=\"float4x4\"/>"))
+        out.append((4, "</accessor>"))
+        out.append((4, "</technique_common>"))
+        out.append((3, "</source>"))
+
+        # Skin Weights!
+        out.append((3, "<source id=\"{}-skin_weights\">".format(cid)))
+        out.append((
+            4, "<float_array id=\"{}-skin_weights-array\" count=\"{}\">{}"
+            "</float_array>".format(
+                cid, weight_count, format_floats(self.weights, precision))))
+        out.append((4, "<technique_common>"))
+        out.append((
+            4, "<accessor source=\"#{}-skin_weights-array\" count=\"{}\" "
+            "stride=\"1\">".format(cid, weight_count)))
+        out.append((5, "<param name=\"WEIGHT\" type=\"float\"/>"))
+        out.append((4, "</accessor>"))
+        out.append((4, "</technique_common>"))
+        out.append((3, "</source>"))
+
+        out.append((3, "<joints>"))
+        out.append((
+            4, "<input semantic=\"JOINT\" source=\"#{}-joints\"/>".format(cid)))
+        out.append((
+            4, "<input semantic=\"INV_BIND_MATRIX\" "
+            "source=\"#{}-bind_poses\"/>".format(cid)))
+        out.append((3, "</joints>"))
+        out.append((3, "<vertex_weights count=\"{}\">".format(
+            len(self.counts))))
+        out.append((
+            4, "<input semantic=\"JOINT\" source=\"#{}-joints\" "
+            "offset=\"0\"/>".format(cid)))
+        out.append((
+            4, "<input semantic=\"WEIGHT\" source=\"#{}-skin_weights\" "
+            "offset=\"1\"/>".format(cid)))
+        pairs = np.stack((self.bones, np.arange(weight_count)), axis=1)
+        out.append((4, "<vcount>{}</vcount>".format(format_ints(self.counts))))
+        out.append((4, "<v>{}</v>".format(format_ints(pairs))))
+        out.append((3, "</vertex_weights>"))
+
+        out.append((2, "</skin>"))
+        out.append((1, "</controller>"))
+        return out
+
+    def meta(self):
+        return {
+            "controller_id": self.controller_id,
+            "source": self.source,
+            "joint_names": self.joint_names,
+        }
+
+    def arrays(self):
+        return {
+            "bind_shape_matrix": self.bind_shape_matrix,
+            "bind_poses": self.bind_poses,
+            "counts": self.counts,
+            "bones": self.bones,
+            "weights": self.weights,
+        }
+
+    @classmethod
+    def from_cache(cls, meta, arrays):
+        return cls(meta["controller_id"], meta["source"],
+                   arrays["bind_shape_matrix"], meta["joint_names"],
+                   arrays["bind_poses"], arrays["counts"], arrays["bones"],
+                   arrays["weights"])
+
+
+# Decomposed transform channels: target sid and output params. Node
+# elements written with these sids are animated instead of the matrix.
+TRS_CHANNELS = {
+    "location": ("location", ("X", "Y", "Z")),
+    "rotationZ": ("rotationZ.ANGLE", ("ANGLE",)),
+    "rotationY": ("rotationY.ANGLE", ("ANGLE",)),
+    "rotationX": ("rotationX.ANGLE", ("ANGLE",)),
+    "scale": ("scale", ("X", "Y", "Z")),
+    "location.X": ("location.X", ("X",)),
+    "location.Y": ("location.Y", ("Y",)),
+    "location.Z": ("location.Z", ("Z",)),
+    "scale.X": ("scale.X", ("X",)),
+    "scale.Y": ("scale.Y", ("Y",)),
+    "scale.Z": ("scale.Z", ("Z",)),
+}
+
+
+def time_source(out, i, source_id, times, precision):
+    count = len(times)
+    out.append((i, "<source id=\"{}\">".format(source_id)))
+    out.append((
+        i + 1, "<float_array id=\"{}-array\" count=\"{}\">{}"
+        "</float_array>".format(
+            source_id, count, format_floats(times, precision))))
+    out.append((i + 1, "<technique_common>"))
+    out.append((
+        i + 2, "<accessor source=\"#{}-array\" count=\"{}\" "
+        "stride=\"1\">".format(source_id, count)))
+    out.append((i + 3, "<param name=\"TIME\" type=\"float\"/>"))
+    out.append((i + 2, "</accessor>"))
+    out.append((i + 1, "</technique_common>"))
+    out.append((i, "</source>"))
+
+
+def interpolation_source(out, i, source_id, count, interpolation="LINEAR"):
+    out.append((i, "<source id=\"{}\">".format(source_id)))
+    out.append((
+        i + 1, "<Name_array id=\"{}-array\" "
+        "count=\"{}\">{}</Name_array>".format(
+            source_id, count, (" " + interpolation) * count)))
+    out.append((i + 1, "<technique_common>"))
+    out.append((
+        i + 2, "<accessor source=\"#{}-array\" "
+        "count=\"{}\" stride=\"1\">".format(source_id, count)))
+    out.append((i + 3, "<param name=\"INTERPOLATION\" type=\"Name\"/>"))
+    out.append((i + 2, "</accessor>"))
+    out.append((i + 1, "</technique_common>"))
+    out.append((i, "</source>"))
+
+
+def tangent_source(out, i, source_id, tangents, precision):
+    """Bezier control points as (time, value) pairs."""
+    count = len(tangents)
+    out.append((i, "<source id=\"{}\">".format(source_id)))
+    out.append((
+        i + 1, "<float_array id=\"{}-array\" count=\"{}\">{}"
+        "</float_array>".format(
+            source_id, count * 2, format_floats(tangents, precision))))
+    out.append((i + 1, "<technique_common>"))
+    out.append((
+        i + 2, "<accessor source=\"#{}-array\" count=\"{}\" "
+        "stride=\"2\">".format(source_id, count)))
+    out.append((i + 3, "<param name=\"X\" type=\"float\"/>"))
+    out.append((i + 3, "<param name=\"Y\" type=\"float\"/>"))
+    out.append((i + 2, "</accessor>"))
+    out.append((i + 1, "</technique_common>"))
+    out.append((i, "</source>"))
+
+
+def compact_group_id(anim_id):
+    """Id of the compact <animation> that starts with anim_id."""
+    return "{}-shared".format(anim_id)
+
+
+def render_compact_animations(blocks, options):
+    """Write animation channels as one <animation> with shared sources.
+
+    Channels sampled at the same times share one time source, and one
+    interpolation source is written per key count.
+    """
+    precision = options.get("float_precision", 0)
+    group_id = compact_group_id(blocks[0].anim_id)
+    time_ids = {}
+    interpolation_ids = {}
+    out = []
+    out.append((1, "<animation id=\"{}\">".format(group_id)))
+    for block in blocks:
+        key = block.times.tobytes()
+        if key not in time_ids:
+            time_ids[key] = "{}-input{}".format(group_id, len(time_ids))
+            time_source(out, 2, time_ids[key], block.times, precision)
+        key = (len(block.times), block.interpolation())
+        if key not in interpolation_ids:
+            interpolation_ids[key] = "{}-interpolation{}".format(
+                group_id, len(interpolation_ids))
+            interpolation_source(out, 2, interpolation_ids[key], key[0],
+                                 key[1])
+
+    for block in blocks:
+        block.output_source(out, 2, precision)
+    for block in blocks:
+        block.sampler(out, 2, time_ids[block.times.tobytes()],
+                      interpolation_ids[(len(block.times),
+                                         block.interpolation())])
+    # Collada wants every sampler before the channels
+    for block in blocks:
+        block.channel(out, 2)
+    out.append((1, "</animation>"))
+    return out
+
+
+class AnimationBlock:
+    """A sampled animation channel written as an <animation> element.
+
+    component selects one of TRS_CHANNELS instead of the whole matrix.
+    Scalar channels with in and out tangents are written as BEZIER.
+    """
+
+    block_type = "animation"
+
+    def __init__(self, anim_id, target, times, values, matrices=True,
+                 component=None, in_tangents=None, out_tangents=None):
+        self.anim_id = anim_id
+        self.target = target
+        self.times = np.asarray(times, dtype=np.float64).ravel()
+        if component is not None:
+            matrices = False
+            width = len(TRS_CHANNELS[component][1])
+        else:
+            width = 16 if matrices else 1
+        self.values = np.asarray(values, dtype=np.float64).reshape(-1, width)
+        self.matrices = matrices
+        self.component = component
+        self.in_tangents = None
+        self.out_tangents = None
+        if in_tangents is not None:
+            self.in_tangents = np.asarray(
+                in_tangents, dtype=np.float64).reshape(-1, 2)
+            self.out_tangents = np.asarray(
+                out_tangents, dtype=np.float64).reshape(-1, 2)
+
+    def interpolation(self):
+        return "LINEAR" if self.in_tangents is None else "BEZIER"
+
+    def output_source(self, out, i, precision):
+        anim_id = self.anim_id
+        frame_total = len(self.times)
+        if self.matrices:
+            # Transform Source
+            out.append((i, "<source id=\"{}-transform-output\">".format(
+                anim_id)))
+            out.append((
+                i + 1, "<float_array id=\"{}-transform-output-array\" "
+                "count=\"{}\">{}</float_array>".format(
+                    anim_id, frame_total * 16,
+                    format_matrices(self.values, precision))))
+            out.append((i + 1, "<technique_common>"))
+            out.append((
+                i + 2, "<accessor source=\"#{}-transform-output-array\" "
+                "count=\"{}\" stride=\"16\">".format(anim_id, frame_total)))
+            out.append((i + 3, "<param name=\"TRANSFORM\" type=\"float4x4\"/>"))
+            out.append((i + 2, "</accessor>"))
+            out.append((i + 1, "</technique_common>"))
+            out.append((i, "</source>"))
+        else:
+            # Value Source
+            out.append((i, "<source id=\"{}-transform-output\">".format(
+                anim_id)))
+            params = ("X",)
+            if self.component is not None:
+                params = TRS_CHANNELS[self.component][1]
+            out.append((
+                i + 1, "<float_array id=\"{}-transform-output-array\" "
+                "count=\"{}\">{}</float_array>".format(
+                    anim_id, self.values.size,
+                    format_floats(self.values, precision))))
+            out.append((i + 1, "<technique_common>"))
+            out.append((
+                i + 2, "<accessor source=\"#{}-transform-output-array\" "
+                "count=\"{}\" stride=\"{}\">".format(
+                    anim_id, frame_total, len(params))))
+            for p in params:
+                out.append((i + 3, "<param name=\"{}\" type=\"float\"/>".format(p)))
+            out.append((i + 2, "</accessor>"))
+            out.append((i + 1, "</technique_common>"))
+            out.append((i, "</source>"))
+
+        if self.in_tangents is not None:
+            tangent_source(out, i, "{}-intangent".format(anim_id),
+                           self.in_tangents, precision)
+            tangent_source(out, i, "{}-outtangent".format(anim_id),
+                           self.out_tangents, precision)
+
+    def sampler(self, out, i, input_id, interpolation_id):
+        anim_id = self.anim_id
+        out.append((i, "<sampler id=\"{}-sampler\">".format(anim_id)))
+        out.append((
+            i + 1, "<input semantic=\"INPUT\" source=\"#{}\"/>".format(
+                input_id)))
+        out.append((
+            i + 1, "<input semantic=\"OUTPUT\" source=\"#{}-transform-output\"/>"
+            .format(anim_id)))
+        out.append((
+            i + 1, "<input semantic=\"INTERPOLATION\" "
+            "source=\"#{}\"/>".format(interpolation_id)))
+        if self.in_tangents is not None:
+            out.append((
+                i + 1, "<input semantic=\"IN_TANGENT\" "
+                "source=\"#{}-intangent\"/>".format(anim_id)))
+            out.append((
+                i + 1, "<input semantic=\"OUT_TANGENT\" "
+                "source=\"#{}-outtangent\"/>".format(anim_id)))
+        out.append((i, "</sampler>"))
+
+    def channel(self, out, i):
+        anim_id = self.anim_id
+        if self.matrices:
+            out.append((
+                i, "<channel source=\"#{}-sampler\" target=\"{}/transform\"/>"
+                .format(anim_id, self.target)))
+        elif self.component is not None:
+            out.append((
+                i, "<channel source=\"#{}-sampler\" target=\"{}/{}\"/>".format(
+                    anim_id, self.target, TRS_CHANNELS[self.component][0])))
+        else:
+            out.append((
+                i, "<channel source=\"#{}-sampler\" target=\"{}\"/>".format(
+                    anim_id, self.target)))
+
+    def render(self, options):
+        precision = options.get("float_precision", 0)
+        anim_id = self.anim_id
+
+        out = []
+        out.append((1, "<animation id=\"{}\">".format(anim_id)))
+        time_source(out, 2, "{}-input".format(anim_id), self.times, precision)
+        self.output_source(out, 2, precision)
+        interpolation_source(out, 2, "{}-interpolation-output".format(anim_id),
+                             len(self.times), self.interpolation())
+        self.sampler(out, 2, "{}-input".format(anim_id),
+                     "{}-interpolation-output".format(anim_id))
+        self.channel(out, 2)
+        out.append((1, "</animation>"))
+        return out
+
+    def meta(self):
+        return {
+            "anim_id": self.anim_id,
+            "target": self.target,
+            "matrices": self.matrices,
+            "component": self.component,
+        }
+
+    def arrays(self):
+        arrays = {"times": self.times, "values": self.values}
+        if self.in_tangents is not None:
+            arrays["in_tangents"] = self.in_tangents
+            arrays["out_tangents"] = self.out_tangents
+        return arrays
+
+    @classmethod
+    def from_cache(cls, meta, arrays):
+        return cls(meta["anim_id"], meta["target"], arrays["times"],
+                   arrays["values"], meta["matrices"], meta.get("component"),
+                   arrays.get("in_tangents"), arrays.get("out_tangents"))
+
+
+class AnimationClipBlock:
+    """An <animation_clip> playing a time window of the animations.
+
+    In the compact layout the animations are written as one <animation>,
+    which the clip instances instead.
+    """
+
+    block_type = "animation_clip"
+
+    def __init__(self, clip_id, name, start, end, anim_ids):
+        self.clip_id = clip_id
+        self.name = name
+        self.start = float(start)
+        self.end = float(end)
+        self.anim_ids = list(anim_ids)
+
+    def render(self, options):
+        anim_ids = self.anim_ids
+        if options.get("use_anim_compact", False) and anim_ids:
+            anim_ids = [compact_group_id(anim_ids[0])]
+
+        out = []
+        out.append((1, "<animation_clip id=\"{}\" name=\"{}\" start=\"{}\" "
+                    "end=\"{}\">".format(self.clip_id, self.name,
+                                         repr(self.start), repr(self.end))))
+        for anim_id in anim_ids:
+            out.append((2, "<instance_animation url=\"#{}\"/>".format(anim_id)))
+        out.append((1, "</animation_clip>"))
+        return out
+
+    def meta(self):
+        return {
+            "clip_id": self.clip_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "anim_ids": self.anim_ids,
+        }
+
+    def arrays(self):
+        return {}
+
+    @classmethod
+    def from_cache(cls, meta, arrays):
+        return cls(meta["clip_id"], meta["name"], meta["start"], meta["end"],
+                   meta["anim_ids"])
+
+
+BLOCK_TYPES = {
+    GeometryBlock.block_type: GeometryBlock,
+    SkinBlock.block_type: SkinBlock,
+    AnimationBlock.block_type: AnimationBlock,
+    AnimationClipBlock.block_type: AnimationClipBlock,
+}
+
+
+class DaeWriter:
+    """Collects Collada sections as lines and array blocks."""
+
+    def new_id(self, t, extra=""):
+        self.last_id += 1
+        return "{}{}-id-{}".format(t, extra, self.last_id)
+
+    def writel(self, section, indent, text):
+        if (not (section in self.sections)):
+            self.sections[section] = []
+        line = "{}{}".format(indent * "\t", text)
+        self.sections[section].append(line)
+
+    def write_block(self, section, block):
+        if (not (section in self.sections)):
+            self.sections[section] = []
+        self.sections[section].append(block)
+        return block
+
+    def purge_empty_nodes(self):
+        sections = {}
+        for k, v in self.sections.items():
+            if not (len(v) == 2 and v[0][1:] == v[1][2:]):
+                sections[k] = v
+        self.sections = sections
+
+    def render_lines(self, section):
+        items = self.sections[section]
+        if self.config.get("use_anim_compact", False):
+            items = self.group_animations(items, self.clip_group_starts())
+        for item in items:
+            if isinstance(item, str):
+                yield item
+            elif isinstance(item, list):
+                for indent, text in render_compact_animations(
+                        item, self.config):
+                    yield "{}{}".format(indent * "\t", text)
+            else:
+                for indent, text in item.render(self.config):
+                    yield "{}{}".format(indent * "\t", text)
+
+    def clip_group_starts(self):
+        """First animation of every clip, each starts its own group."""
+        return set(item.anim_ids[0] for items in self.sections.values()
+                   for item in items
+                   if isinstance(item, AnimationClipBlock) and item.anim_ids)
+
+    @staticmethod
+    def group_animations(items, starts=()):
+        """Collect runs of animation blocks into lists, starting a new list
+        at every animation id in starts."""
+        grouped = []
+        for item in items:
+            if isinstance(item, AnimationBlock):
+                if (not grouped or not isinstance(grouped[-1], list)
+                        or (grouped[-1] and item.anim_id in starts)):
+                    grouped.append([])
+                grouped[-1].append(item)
+            else:
+                grouped.append(item)
+        return grouped
+
+    def write(self, path):
+        try:
+            f = open(path, "wb")
+        except:
+            return False
+
+        with f:
+            f.write(bytes("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n",
+                          "UTF-8"))
+            f.write(bytes(
+                "<COLLADA xmlns=\"http://www.collada.org/2005/11/"
+                "COLLADASchema\" version=\"1.4.1\">\n", "UTF-8"))
+
+            for x in sorted(self.sections.keys()):
+                for l in self.render_lines(x):
+                    f.write(bytes(l + "\n", "UTF-8"))
+
+            f.write(bytes("<scene>\n", "UTF-8"))
+            f.write(bytes(
+                "\t<instance_visual_scene url=\"#{}\" />\n".format(
+                    self.scene_name), "UTF-8"))
+            f.write(bytes("</scene>\n", "UTF-8"))
+            f.write(bytes("</COLLADA>\n", "UTF-8"))
+        return True
+
+    def save_cache(self, path):
+        """Save sections and array blocks to a compressed .npz file."""
+        arrays = {}
+        blocks = []
+        sections = {}
+        for section, items in self.sections.items():
+            lines = []
+            for item in items:
+                if isinstance(item, str):
+                    lines.append(item)
+                    continue
+                index = len(blocks)
+                blocks.append({"type": item.block_type, "meta": item.meta()})
+                for name, values in item.arrays().items():
+                    arrays["b{}_{}".format(index, name)] = values
+                # An integer line is a slot for the block at that index
+                lines.append(index)
+            sections[str(section)] = lines
+
+        header = {
+            "version": CACHE_VERSION,
+            "scene_name": self.scene_name,
+            "last_id": self.last_id,
+            "options": {k: self.config.get(k) for k in RENDER_OPTIONS},
+            "sections": sections,
+            "blocks": blocks,
+        }
+        arrays["header"] = np.array(json.dumps(header))
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load_cache(cls, path, **options):
+        """Load a writer from a .npz cache, overriding stored options."""
+        with np.load(path, allow_pickle=False) as data:
+            header = json.loads(data["header"].item())
+            if header.get("version") != CACHE_VERSION:
+                raise ValueError("Unsupported export cache version {} in '{}'."
+                                 .format(header.get("version"), path))
+
+            config = header["options"]
+            check_cache_options(config, options, path)
+            config.update(options)
+
+            blocks = []
+            for index, entry in enumerate(header["blocks"]):
+                prefix = "b{}_".format(index)
+                arrays = {k[len(prefix):]: data[k] for k in data.files
+                          if k.startswith(prefix)}
+                block_type = BLOCK_TYPES[entry["type"]]
+                blocks.append(block_type.from_cache(entry["meta"], arrays))
+
+        writer = DaeWriter(config)
+        writer.scene_name = header["scene_name"]
+        writer.last_id = header["last_id"]
+        for section, lines in header["sections"].items():
+            writer.sections[int(section)] = [
+                blocks[l] if isinstance(l, int) else l for l in lines]
+        return writer
+
+    __slots__ = ("sections", "last_id", "scene_name", "config")
+
+    def __init__(self, config):
+        self.sections = {}
+        self.last_id = 0
+        self.scene_name = ""
+        self.config = config
+
+
+def check_cache_options(stored, options, path):
+    """Reject overrides that need data the cached export doesn't hold.
+
+    Tangents that were never exported can't be added, and meshes that were
+    triangulated on export can't be restored to polygons.
+    """
+    if options.get("use_tangent") and not stored.get("use_tangent"):
+        raise ValueError("'{}' was exported without tangents, they can't be "
+                         "added from the cache.".format(path))
+    if (options.get("use_triangles") is False and
+            stored.get("use_triangles")):
+        raise ValueError("'{}' was triangulated on export, the polygons can't "
+                         "be restored from the cache.".format(path))
+
+
+def export_dae(cache_path, filepath="", **options):
+    """Re-serialize a DAE from an export cache without Blender.
+
+    Keyword options override the ones stored in the cache, see RENDER_OPTIONS.
+    """
+    if filepath == "":
+        filepath = os.path.splitext(cache_path)[0] + ".dae"
+    writer = DaeWriter.load_cache(cache_path, **options)
+    return writer.write(filepath)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Regenerate a Divinity DAE from an export cache (.npz).")
+    parser.add_argument("cache", help="Path to the .npz export cache")
+    parser.add_argument("-o", "--output", default="",
+                        help="Output .dae path (defaults to the cache path)")
+    parser.add_argument("--precision", type=int, dest="float_precision",
+                        help="Decimal places for floats (0 for full)")
+    parser.add_argument("--tangents", dest="use_tangent", default=None,
+                        action="store_true",
+                        help="Write tangents, only if they were exported")
+    parser.add_argument("--no-tangents", dest="use_tangent",
+                        action="store_false", help="Leave tangents out")
+    parser.add_argument("--triangulate", dest="use_triangles", default=None,
+                        action="store_true", help="Write triangles")
+    parser.add_argument("--no-triangulate", dest="use_triangles",
+                        action="store_false",
+                        help="Write polygons, only if the export wasn't "
+                             "triangulated")
+    parser.add_argument("--extra-data", dest="extra_data_disabled",
+                        default=None, action="store_false")
+    parser.add_argument("--no-extra-data", dest="extra_data_disabled",
+                        action="store_true")
+    parser.add_argument("--compact-animations", dest="use_anim_compact",
+                        default=None, action="store_true")
+    parser.add_argument("--no-compact-animations", dest="use_anim_compact",
+                        action="store_false")
+    parser.add_argument("--extras",
+                        choices=("DISABLED", "MESHPROXY", "CLOTH", "RIGID",
+                                 "RIGIDCLOTH"),
+                        help="Flag every mesh with this DivModelType")
+    args = parser.parse_args(argv)
+
+    options = {k: getattr(args, k) for k in RENDER_OPTIONS
+               if getattr(args, k, None) is not None}
+    try:
+        written = export_dae(args.cache, args.output, **options)
+    except ValueError as e:
+        parser.error(str(e))
+    if not written:
+        print("Failed to write DAE for '{}'.".format(args.cache))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -25,27 +25,26 @@ http://www.khronos.org/collada/
 """
 
 import os
+import json
 import time
 import math
 import shutil
+import tempfile
+import subprocess
 import bpy
 import bmesh
+import numpy as np
 from mathutils import Vector, Matrix
 
-# According to collada spec, order matters
-S_ASSET = 0
-S_IMGS = 1
-S_FX = 2
-S_MATS = 3
-S_GEOM = 4
-S_MORPH = 5
-S_SKIN = 6
-S_CONT = 7
-S_CAMS = 8
-S_LAMPS = 9
-S_ANIM_CLIPS = 10
-S_NODES = 11
-S_ANIM = 12
+from . import image_staging
+from . import geometry_ops
+from . import anim_ops
+from . import anim_eval
+from . import anim_cache
+from .dae_writer import (
+    DaeWriter, GeometryBlock, SkinBlock, AnimationBlock, AnimationClipBlock,
+    S_ASSET, S_IMGS, S_FX, S_MATS, S_GEOM, S_MORPH, S_SKIN, S_CONT,
+    S_ANIM_CLIPS, S_NODES, S_ANIM, TRS_CHANNELS)
 
 CMP_EPSILON = 0.0001
 
@@ -95,18 +94,13 @@ def strarr(arr):
     return s
 
 
-class DaeExporter:
+class DaeExporter(DaeWriter):
 
     def validate_id(self, d):
         if (d.find("id-") == 0):
             return "z{}".format(d)
         return d
 
-    def new_id(self, t, extra=""):
-        self.last_id += 1
-        return "{}{}-id-{}".format(t, extra, self.last_id)
-        #return t
-
     class Vertex:
 
         def close_to(self, v):
@@ -154,19 +148,6 @@ class DaeExporter:
             self.bones = []
             self.weights = []
 
-    def writel(self, section, indent, text):
-        if (not (section in self.sections)):
-            self.sections[section] = []
-        line = "{}{}".format(indent * "\t", text)
-        self.sections[section].append(line)
-
-    def purge_empty_nodes(self):
-        sections = {}
-        for k, v in self.sections.items():
-            if not (len(v) == 2 and v[0][1:] == v[1][2:]):
-                sections[k] = v
-        self.sections = sections
-
     def mesh_has_property(self, obj, mesh, property):
         if mesh.get(property, None) is not None or mesh.get(property.capitalize(), None) is not None:
             return True
@@ -174,149 +155,55 @@ class DaeExporter:
             return True
         return False
 
-    def export_mesh(self, node, armature=None, skeyindex=-1, skel_source=None,
-                    export_name=None):
-        mesh = node.data
+    def model_type(self, obj, mesh):
+        """LSLib model type of a mesh object, from its custom properties
+        or the global GR2 extras setting."""
+        mesh_extra = ""
+        if self.config["extra_data_disabled"] == False:
+            obj_check = bpy.data.objects[obj.name]
+            mesh_check = bpy.data.meshes[mesh.name]
 
-        if (node.data in self.mesh_cache):
-            print("    [DOS2DE-Exporter] Using mesh cache for '{}'.".format(mesh.name))
-            return self.mesh_cache[mesh]
+            #Animations don't use custom flags
+            if self.config["use_anim"] == False:
+                # Custom Property
+                if self.mesh_has_property(obj_check, mesh_check, "rigid"):
+                    mesh_extra = "rigid"
+                if self.mesh_has_property(obj_check, mesh_check, "cloth"):
+                    mesh_extra = "cloth"
+                if self.mesh_has_property(obj_check, mesh_check, "meshproxy"):
+                    mesh_extra = "meshproxy"
+                if self.mesh_has_property(obj_check, mesh_check, "rigidcloth"):
+                    mesh_extra = "rigidcloth"
+                # Global
+                if self.config["convert_gr2"] == True:
+                    extra_settings = self.config["divine_settings"].gr2_settings.extras
+                    if extra_settings == "RIGID":
+                        mesh_extra = "rigid"
+                    if extra_settings == "CLOTH":
+                        mesh_extra = "cloth"
+                    if extra_settings == "MESHPROXY":
+                        mesh_extra = "meshproxy"   
+                    if extra_settings == "RIGIDCLOTH":
+                        mesh_extra = "rigidcloth"
+        return mesh_extra
+
+    def extract_geometry(self, node, armature=None, skeyindex=-1,
+                         export_name=None):
+        """Read a mesh object into a GeometryBlock without writing it.
 
+        Returns the block, the deduplicated vertices, the material
+        assignments and the Blender material of each surface.
+        """
+        mesh = node.data
         if export_name is None or export_name == "":
             export_name = mesh.name
 
-        if (skeyindex == -1 and mesh.shape_keys is not None and len(
-                mesh.shape_keys.key_blocks) and self.config["use_shape_key_export"]):
-            print("    [DOS2DE-Exporter] Exporting with shape keys for '{}'.".format(mesh.name))
-            values = []
-            morph_targets = []
-            md = None
-            for k in range(0, len(mesh.shape_keys.key_blocks)):
-                shape = node.data.shape_keys.key_blocks[k]
-                values += [shape.value]
-                shape.value = 0
-
-            mid = self.new_id("morph")
-
-            for k in range(0, len(mesh.shape_keys.key_blocks)):
-                shape = node.data.shape_keys.key_blocks[k]
-                node.show_only_shape_key = True
-                node.active_shape_key_index = k
-                shape.value = 1.0
-                mesh.update()
-                p = node.data
-                v = node.to_mesh(bpy.context.scene, True, "RENDER")
-                self.temp_meshes.add(v)
-                node.data = v
-                node.data.update()
-                if (armature and k == 0):
-                    md = self.export_mesh(node, armature, k, mid, shape.name, export_name)
-                else:
-                    md = self.export_mesh(node, None, k, None, shape.name, export_name)
-
-                node.data = p
-                node.data.update()
-                shape.value = 0.0
-                morph_targets.append(md)
-
-            node.show_only_shape_key = False
-            node.active_shape_key_index = 0
-
-            print("[DOS2DE-Exporter] Writing mesh xml for '{}'.".format(mesh.name))
-
-            self.writel(
-                S_MORPH, 1, "<controller id=\"{}\" name=\"\">".format(mid))
-            self.writel(
-                S_MORPH, 2,
-                "<morph source=\"#{}\" method=\"NORMALIZED\">".format(
-                    morph_targets[0]["id"]))
-
-            self.writel(
-                S_MORPH, 3, "<source id=\"{}-morph-targets\">".format(mid))
-            self.writel(
-                S_MORPH, 4,
-                "<IDREF_array id=\"{}-morph-targets-array\" "
-                "count=\"{}\">".format(mid, len(morph_targets) - 1))
-            marr = ""
-            warr = ""
-            for i in range(len(morph_targets)):
-                if (i == 0):
-                    continue
-                elif (i > 1):
-                    marr += " "
-
-                if ("skin_id" in morph_targets[i]):
-                    marr += morph_targets[i]["skin_id"]
-                else:
-                    marr += morph_targets[i]["id"]
-
-                warr += " 0"
-
-            self.writel(S_MORPH, 5, marr)
-            self.writel(S_MORPH, 4, "</IDREF_array>")
-            self.writel(S_MORPH, 4, "<technique_common>")
-            self.writel(
-                S_MORPH, 5, "<accessor source=\"#{}-morph-targets-array\" "
-                "count=\"{}\" stride=\"1\">".format(
-                    mid, len(morph_targets) - 1))
-            self.writel(
-                S_MORPH, 6, "<param name=\"MORPH_TARGET\" type=\"IDREF\"/>")
-            self.writel(S_MORPH, 5, "</accessor>")
-            self.writel(S_MORPH, 4, "</technique_common>")
-            self.writel(S_MORPH, 3, "</source>")
-
-            self.writel(
-                S_MORPH, 3, "<source id=\"{}-morph-weights\">".format(mid))
-            self.writel(
-                S_MORPH, 4,
-                "<float_array id=\"{}-morph-weights-array\" count=\"{}\" >"
-                .format(mid, len(morph_targets) - 1))
-            self.writel(S_MORPH, 5, warr)
-            self.writel(S_MORPH, 4, "</float_array>")
-            self.writel(S_MORPH, 4, "<technique_common>")
-            self.writel(
-                S_MORPH, 5,
-                "<accessor source=\"#{}-morph-weights-array\" "
-                "count=\"{}\" stride=\"1\">".format(
-                    mid, len(morph_targets) - 1))
-            self.writel(
-                S_MORPH, 6, "<param name=\"MORPH_WEIGHT\" type=\"float\"/>")
-            self.writel(S_MORPH, 5, "</accessor>")
-            self.writel(S_MORPH, 4, "</technique_common>")
-            self.writel(S_MORPH, 3, "</source>")
-
-            self.writel(S_MORPH, 3, "<targets>")
-            self.writel(
-                S_MORPH, 4, "<input semantic=\"MORPH_TARGET\" "
-                "source=\"#{}-morph-targets\"/>".format(mid))
-            self.writel(
-                S_MORPH, 4, "<input semantic=\"MORPH_WEIGHT\" "
-                "source=\"#{}-morph-weights\"/>".format(mid))
-            self.writel(S_MORPH, 3, "</targets>")
-            self.writel(S_MORPH, 2, "</morph>")
-            self.writel(S_MORPH, 1, "</controller>")
-            if armature is not None:
-
-                self.armature_for_morph[node] = armature
-
-            meshdata = {}
-            if (armature):
-                meshdata = morph_targets[0]
-                meshdata["morph_id"] = mid
-            else:
-                meshdata["id"] = morph_targets[0]["id"]
-                meshdata["morph_id"] = mid
-                meshdata["material_assign"] = morph_targets[
-                    0]["material_assign"]
-
-            self.mesh_cache[node.data] = meshdata
-            return meshdata
-
-
         armature_modifier = None
         armature_poses = None
 
-        if(self.config["use_exclude_armature_modifier"]):
+        if(self.config["use_exclude_armature_modifier"] or (
+                self.config["use_nondestructive"] and
+                self.config["use_rest_pose"])):
             armature_modifier = node.modifiers.get("Armature")
 
         if(armature_modifier):
@@ -328,11 +215,13 @@ class DaeExporter:
         apply_modifiers = len(node.modifiers) and self.config[
             "use_mesh_modifiers"]
 
-        mesh = node.to_mesh(self.scene, apply_modifiers,
-                            "RENDER")  # TODO: Review
-        if(armature_modifier):
-            for i, arm in enumerate(bpy.data.armatures):
-                arm.pose_position = armature_poses[i]
+        try:
+            mesh = node.to_mesh(self.scene, apply_modifiers,
+                                "RENDER")  # TODO: Review
+        finally:
+            if(armature_modifier):
+                for i, arm in enumerate(bpy.data.armatures):
+                    arm.pose_position = armature_poses[i]
 
         self.temp_meshes.add(mesh)
         print("    [DOS2DE-Exporter] Triangulating mesh '{}'.".format(mesh.name))
@@ -348,6 +237,7 @@ class DaeExporter:
         vertices = []
         vertex_map = {}
         surface_indices = {}
+        surface_materials = {}
         materials = {}
 
         si = None
@@ -380,6 +270,11 @@ class DaeExporter:
 
             if not (f.material_index in surface_indices):
                 surface_indices[f.material_index] = []
+                try:
+                    surface_materials[f.material_index] = mesh.materials[
+                        f.material_index]
+                except:
+                    surface_materials[f.material_index] = None
 
             if self.can_export_type("MATERIAL"):
                 try:
@@ -465,302 +360,218 @@ class DaeExporter:
 
         #meshid = self.new_id("mesh")
         meshid = self.new_id(export_name)
-        self.writel(
-            S_GEOM, 1, "<geometry id=\"{}\" name=\"{}\">".format(
-                meshid, export_name))
-
-        self.writel(S_GEOM, 2, "<mesh>")
 
-        # Vertex Array
-        self.writel(S_GEOM, 3, "<source id=\"{}-positions\">".format(meshid))
-        float_values = ""
-        for v in vertices:
-            float_values += " {} {} {}".format(
-                v.vertex.x, v.vertex.y, v.vertex.z)
-        self.writel(
-            S_GEOM, 4, "<float_array id=\"{}-positions-array\" "
-            "count=\"{}\">{}</float_array>".format(
-                meshid, len(vertices) * 3, float_values))
-        self.writel(S_GEOM, 4, "<technique_common>")
-        self.writel(
-            S_GEOM, 4, "<accessor source=\"#{}-positions-array\" "
-            "count=\"{}\" stride=\"3\">".format(meshid, len(vertices)))
-        self.writel(S_GEOM, 5, "<param name=\"X\" type=\"float\"/>")
-        self.writel(S_GEOM, 5, "<param name=\"Y\" type=\"float\"/>")
-        self.writel(S_GEOM, 5, "<param name=\"Z\" type=\"float\"/>")
-        self.writel(S_GEOM, 4, "</accessor>")
-        self.writel(S_GEOM, 4, "</technique_common>")
-        self.writel(S_GEOM, 3, "</source>")
-
-        # Normals Array
-        self.writel(S_GEOM, 3, "<source id=\"{}-normals\">".format(meshid))
-        float_values = ""
-        for v in vertices:
-            float_values += " {} {} {}".format(
-                v.normal.x, v.normal.y, v.normal.z)
-        self.writel(
-            S_GEOM, 4, "<float_array id=\"{}-normals-array\" "
-            "count=\"{}\">{}</float_array>".format(
-                meshid, len(vertices) * 3, float_values))
-        self.writel(S_GEOM, 4, "<technique_common>")
-        self.writel(
-            S_GEOM, 4, "<accessor source=\"#{}-normals-array\" count=\"{}\" "
-            "stride=\"3\">".format(meshid, len(vertices)))
-        self.writel(S_GEOM, 5, "<param name=\"X\" type=\"float\"/>")
-        self.writel(S_GEOM, 5, "<param name=\"Y\" type=\"float\"/>")
-        self.writel(S_GEOM, 5, "<param name=\"Z\" type=\"float\"/>")
-        self.writel(S_GEOM, 4, "</accessor>")
-        self.writel(S_GEOM, 4, "</technique_common>")
-        self.writel(S_GEOM, 3, "</source>")
+        surfaces = []
+        for m in surface_indices:
+            indices = surface_indices[m]
+            mat = None
+            if m in materials:
+                mat = materials[m]
+            matref = None
+            if (mat is not None):
+                matref = self.new_id("trimat")
+                mat_assign.append((mat, matref))
+            surfaces.append((
+                matref, [len(p) for p in indices], [i for p in indices for i in p]))
 
+        tangents = None
+        binormals = None
+        bitangents = None
         if (has_tangents):
-            # Tangents
-            self.writel(
-                S_GEOM, 3, "<source id=\"{}-tangents\">".format(meshid))
-            float_values = ""
+            tangents = [c for v in vertices for c in v.tangent]
+            binormals = []
             for v in vertices:
-                float_values += " {} {} {}".format(
-                    v.tangent.x, v.tangent.y, v.tangent.z)
-            self.writel(
-                S_GEOM, 4, "<float_array id=\"{}-tangents-array\" "
-                "count=\"{}\">{}</float_array>".format(
-                    meshid, len(vertices) * 3, float_values))
-            self.writel(S_GEOM, 4, "<technique_common>")
-            self.writel(
-                S_GEOM, 4, "<accessor source=\"#{}-tangents-array\" "
-                "count=\"{}\" stride=\"3\">".format(meshid, len(vertices)))
-            self.writel(S_GEOM, 5, "<param name=\"X\" type=\"float\"/>")
-            self.writel(S_GEOM, 5, "<param name=\"Y\" type=\"float\"/>")
-            self.writel(S_GEOM, 5, "<param name=\"Z\" type=\"float\"/>")
-            self.writel(S_GEOM, 4, "</accessor>")
-            self.writel(S_GEOM, 4, "</technique_common>")
-            self.writel(S_GEOM, 3, "</source>")
-
-            # Binormals
-            self.writel(
-                S_GEOM, 3, "<source id=\"{}-binormals\">".format(meshid))
-            float_values = ""
-            for v in vertices:
-                tangent = v.tangent
-                normal = v.normal
-                binormal = normal.cross(tangent)
+                binormal = v.normal.cross(v.tangent)
                 binormal.normalize()
-                float_values += " {} {} {}".format(
-                    binormal.x, binormal.y, binormal.z)
-            self.writel(
-                S_GEOM, 4, "<float_array id=\"{}-binormals-array\" "
-                "count=\"{}\">{}</float_array>".format(
-                    meshid, len(vertices) * 3, float_values))
-            self.writel(S_GEOM, 4, "<technique_common>")
-            self.writel(
-                S_GEOM, 4, "<accessor source=\"#{}-binormals-array\" "
-                "count=\"{}\" stride=\"3\">".format(meshid, len(vertices)))
-            self.writel(S_GEOM, 5, "<param name=\"X\" type=\"float\"/>")
-            self.writel(S_GEOM, 5, "<param name=\"Y\" type=\"float\"/>")
-            self.writel(S_GEOM, 5, "<param name=\"Z\" type=\"float\"/>")
-            self.writel(S_GEOM, 4, "</accessor>")
-            self.writel(S_GEOM, 4, "</technique_common>")
-            self.writel(S_GEOM, 3, "</source>")
-
-            #Bitangents
-            self.writel(S_GEOM, 3, "<source id=\"{}-bitangents\">".format(
-                meshid))
-            float_values = ""
-            for v in vertices:
-                float_values += " {} {} {}".format(
-                    v.bitangent.x, v.bitangent.y, v.bitangent.z)
-            self.writel(
-                S_GEOM, 4, "<float_array id=\"{}-bitangents-array\" "
-                "count=\"{}\">{}</float_array>".format(
-                    meshid, len(vertices) * 3, float_values))
-            self.writel(S_GEOM, 4, "<technique_common>")
-            self.writel(
-                S_GEOM, 4, "<accessor source=\"#{}-bitangents-array\" "
-                "count=\"{}\" stride=\"3\">".format(meshid, len(vertices)))
-            self.writel(S_GEOM, 5, "<param name=\"X\" type=\"float\"/>")
-            self.writel(S_GEOM, 5, "<param name=\"Y\" type=\"float\"/>")
-            self.writel(S_GEOM, 5, "<param name=\"Z\" type=\"float\"/>")
-            self.writel(S_GEOM, 4, "</accessor>")
-            self.writel(S_GEOM, 4, "</technique_common>")
-            self.writel(S_GEOM, 3, "</source>")
-
-        # UV Arrays
+                binormals.extend(binormal)
+            bitangents = [c for v in vertices for c in v.bitangent]
+
+        uvs = None
         if uv_layer_count > 0:
-            uvi = 0
-            self.writel(S_GEOM, 3, "<source id=\"{}-uvs0\">".format(
-                meshid))
-            float_values = ""
+            uvs = []
             for v in vertices:
                 try:
-                    float_values += " {} {}".format(v.uv[uvi].x, v.uv[uvi].y)
+                    uvs.extend((v.uv[0].x, v.uv[0].y))
                 except:
                     # TODO: Review, understand better the multi-uv-layer API
-                    float_values += " 0 0 "
+                    uvs.extend((0.0, 0.0))
+
+        colors = None
+        if (has_colors):
+            colors = [c for v in vertices for c in v.color[:3]]
+
+        # LSLib model type / extra data
+        mesh_extra = self.model_type(node, mesh)
+
+        geometry = GeometryBlock(
+            meshid, export_name,
+            positions=[c for v in vertices for c in v.vertex],
+            normals=[c for v in vertices for c in v.normal],
+            tangents=tangents, binormals=binormals, bitangents=bitangents,
+            uvs=uvs, colors=colors, surfaces=surfaces,
+            model_type=mesh_extra)
+        data_matrix = self.data_matrix(node)
+        if (data_matrix is not None):
+            geometry_ops.transform_geometry(geometry, data_matrix)
+        return geometry, vertices, mat_assign, [
+            surface_materials[m] for m in surface_indices]
+
+    def export_mesh(self, node, armature=None, skeyindex=-1, skel_source=None,
+                    export_name=None):
+        mesh = node.data
+
+        # Baked data belongs to one object only
+        if (node.data in self.mesh_cache and self.data_matrix(node) is None):
+            print("    [DOS2DE-Exporter] Using mesh cache for '{}'.".format(mesh.name))
+            return self.mesh_cache[mesh]
+
+        if export_name is None or export_name == "":
+            export_name = mesh.name
+
+        if (skeyindex == -1 and mesh.shape_keys is not None and len(
+                mesh.shape_keys.key_blocks) and self.config["use_shape_key_export"]):
+            print("    [DOS2DE-Exporter] Exporting with shape keys for '{}'.".format(mesh.name))
+            values = []
+            morph_targets = []
+            md = None
+            show_only_shape_key = node.show_only_shape_key
+            active_shape_key_index = node.active_shape_key_index
+            for k in range(0, len(mesh.shape_keys.key_blocks)):
+                shape = node.data.shape_keys.key_blocks[k]
+                values += [shape.value]
+                shape.value = 0
+
+            mid = self.new_id("morph")
+
+            p = node.data
+            try:
+                for k in range(0, len(mesh.shape_keys.key_blocks)):
+                    shape = p.shape_keys.key_blocks[k]
+                    node.show_only_shape_key = True
+                    node.active_shape_key_index = k
+                    shape.value = 1.0
+                    mesh.update()
+                    v = node.to_mesh(bpy.context.scene, True, "RENDER")
+                    self.temp_meshes.add(v)
+                    node.data = v
+                    node.data.update()
+                    if (armature and k == 0):
+                        md = self.export_mesh(node, armature, k, mid, shape.name, export_name)
+                    else:
+                        md = self.export_mesh(node, None, k, None, shape.name, export_name)
+
+                    node.data = p
+                    node.data.update()
+                    shape.value = 0.0
+                    morph_targets.append(md)
+            finally:
+                # Leave the object's shape keys as they were
+                node.data = p
+                for shape, value in zip(p.shape_keys.key_blocks, values):
+                    shape.value = value
+                node.show_only_shape_key = show_only_shape_key
+                node.active_shape_key_index = active_shape_key_index
+                mesh.update()
+
+            print("[DOS2DE-Exporter] Writing mesh xml for '{}'.".format(mesh.name))
 
             self.writel(
-                S_GEOM, 4, "<float_array id=\"{}-uvs0-array\" "
-                "count=\"{}\">{}</float_array>".format(
-                    meshid, len(vertices) * 2, float_values))
-            self.writel(S_GEOM, 4, "<technique_common>")
+                S_MORPH, 1, "<controller id=\"{}\" name=\"\">".format(mid))
             self.writel(
-                S_GEOM, 4, "<accessor source=\"#{}-uvs0-array\" "
-                "count=\"{}\" stride=\"2\">".format(
-                    meshid, len(vertices)))
-            self.writel(S_GEOM, 5, "<param name=\"S\" type=\"float\"/>")
-            self.writel(S_GEOM, 5, "<param name=\"T\" type=\"float\"/>")
-            self.writel(S_GEOM, 4, "</accessor>")
-            self.writel(S_GEOM, 4, "</technique_common>")
-            self.writel(S_GEOM, 3, "</source>")
-
-        # Color Arrays
-        if (has_colors):
-            self.writel(S_GEOM, 3, "<source id=\"{}-colors\">".format(meshid))
-            float_values = ""
-            for v in vertices:
-                float_values += " {} {} {}".format(
-                    v.color.x, v.color.y, v.color.z)
+                S_MORPH, 2,
+                "<morph source=\"#{}\" method=\"NORMALIZED\">".format(
+                    morph_targets[0]["id"]))
+
             self.writel(
-                S_GEOM, 4, "<float_array id=\"{}-colors-array\" "
-                "count=\"{}\">{}</float_array>".format(
-                    meshid, len(vertices) * 3, float_values))
-            self.writel(S_GEOM, 4, "<technique_common>")
+                S_MORPH, 3, "<source id=\"{}-morph-targets\">".format(mid))
             self.writel(
-                S_GEOM, 4, "<accessor source=\"#{}-colors-array\" "
-                "count=\"{}\" stride=\"3\">".format(meshid, len(vertices)))
-            self.writel(S_GEOM, 5, "<param name=\"X\" type=\"float\"/>")
-            self.writel(S_GEOM, 5, "<param name=\"Y\" type=\"float\"/>")
-            self.writel(S_GEOM, 5, "<param name=\"Z\" type=\"float\"/>")
-            self.writel(S_GEOM, 4, "</accessor>")
-            self.writel(S_GEOM, 4, "</technique_common>")
-            self.writel(S_GEOM, 3, "</source>")
-
-        # Triangle Lists
-        self.writel(S_GEOM, 3, "<vertices id=\"{}-vertices\">".format(meshid))
-        self.writel(
-            S_GEOM, 4,
-            "<input semantic=\"POSITION\" source=\"#{}-positions\"/>".format(
-                meshid))
-        self.writel(S_GEOM, 3, "</vertices>")
+                S_MORPH, 4,
+                "<IDREF_array id=\"{}-morph-targets-array\" "
+                "count=\"{}\">".format(mid, len(morph_targets) - 1))
+            marr = ""
+            warr = ""
+            for i in range(len(morph_targets)):
+                if (i == 0):
+                    continue
+                elif (i > 1):
+                    marr += " "
 
-        prim_type = ""
-        if (triangulate):
-            prim_type = "triangles"
-        else:
-            prim_type = "polygons"
+                if ("skin_id" in morph_targets[i]):
+                    marr += morph_targets[i]["skin_id"]
+                else:
+                    marr += morph_targets[i]["id"]
+
+                warr += " 0"
+
+            self.writel(S_MORPH, 5, marr)
+            self.writel(S_MORPH, 4, "</IDREF_array>")
+            self.writel(S_MORPH, 4, "<technique_common>")
+            self.writel(
+                S_MORPH, 5, "<accessor source=\"#{}-morph-targets-array\" "
+                "count=\"{}\" stride=\"1\">".format(
+                    mid, len(morph_targets) - 1))
+            self.writel(
+                S_MORPH, 6, "<param name=\"MORPH_TARGET\" type=\"IDREF\"/>")
+            self.writel(S_MORPH, 5, "</accessor>")
+            self.writel(S_MORPH, 4, "</technique_common>")
+            self.writel(S_MORPH, 3, "</source>")
+
+            self.writel(
+                S_MORPH, 3, "<source id=\"{}-morph-weights\">".format(mid))
+            self.writel(
+                S_MORPH, 4,
+                "<float_array id=\"{}-morph-weights-array\" count=\"{}\" >"
+                .format(mid, len(morph_targets) - 1))
+            self.writel(S_MORPH, 5, warr)
+            self.writel(S_MORPH, 4, "</float_array>")
+            self.writel(S_MORPH, 4, "<technique_common>")
+            self.writel(
+                S_MORPH, 5,
+                "<accessor source=\"#{}-morph-weights-array\" "
+                "count=\"{}\" stride=\"1\">".format(
+                    mid, len(morph_targets) - 1))
+            self.writel(
+                S_MORPH, 6, "<param name=\"MORPH_WEIGHT\" type=\"float\"/>")
+            self.writel(S_MORPH, 5, "</accessor>")
+            self.writel(S_MORPH, 4, "</technique_common>")
+            self.writel(S_MORPH, 3, "</source>")
 
-        for m in surface_indices:
-            indices = surface_indices[m]
-            mat = None
-            if m in materials:
-                mat = materials[m]
-            if (mat is not None):
-                matref = self.new_id("trimat")
-                self.writel(
-                    S_GEOM, 3, "<{} count=\"{}\" material=\"{}\">".format(
-                        prim_type,
-                        int(len(indices)), matref))  # TODO: Implement material
-                mat_assign.append((mat, matref))
-            else:
-                self.writel(S_GEOM, 3, "<{} count=\"{}\">".format(
-                    prim_type, int(len(indices))))
-            
+            self.writel(S_MORPH, 3, "<targets>")
             self.writel(
-                S_GEOM, 4, "<input semantic=\"VERTEX\" "
-                "source=\"#{}-vertices\" offset=\"0\"/>".format(meshid))
+                S_MORPH, 4, "<input semantic=\"MORPH_TARGET\" "
+                "source=\"#{}-morph-targets\"/>".format(mid))
             self.writel(
-                S_GEOM, 4, "<input semantic=\"NORMAL\" "
-                "source=\"#{}-normals\" offset=\"0\"/>".format(meshid))
+                S_MORPH, 4, "<input semantic=\"MORPH_WEIGHT\" "
+                "source=\"#{}-morph-weights\"/>".format(mid))
+            self.writel(S_MORPH, 3, "</targets>")
+            self.writel(S_MORPH, 2, "</morph>")
+            self.writel(S_MORPH, 1, "</controller>")
+            if armature is not None:
 
-            if uv_layer_count > 0:
-                uvi = 0
-                self.writel(
-                    S_GEOM, 4,
-                    "<input semantic=\"TEXCOORD\" source=\"#{}-uvs0\" "
-                    "offset=\"0\" set=\"{}\"/>".format(meshid, uvi))
+                self.armature_for_morph[node] = armature
 
-            if (has_colors):
-                self.writel(
-                    S_GEOM, 4, "<input semantic=\"COLOR\" "
-                    "source=\"#{}-colors\" offset=\"0\"/>".format(meshid))
-            if (has_tangents):
-                self.writel(
-                    S_GEOM, 4, "<input semantic=\"TANGENT\" "
-                    "source=\"#{}-tangents\" offset=\"0\"/>".format(meshid))
-                self.writel(
-                    S_GEOM, 4, "<input semantic=\"BINORMAL\" "
-                    "source=\"#{}-binormals\" offset=\"0\"/>".format(meshid))
-                """ self.writel(
-                    S_GEOM, 4, "<input semantic=\"TEXTANGENT\" "
-                    "source=\"#{}-tangents\" offset=\"0\"/>".format(meshid)) """
-                """ self.writel(
-                    S_GEOM, 4, "<input semantic=\"TEXBINORMAL\" "
-                    "source=\"#{}-bitangents\" offset=\"0\"/>".format(meshid)) """
-
-            if (triangulate):
-                int_values = "<p>"
-                for p in indices:
-                    for i in p:
-                        int_values += " {}".format(i)
-                int_values += " </p>"
-                self.writel(S_GEOM, 4, int_values)
+            meshdata = {}
+            if (armature):
+                meshdata = morph_targets[0]
+                meshdata["morph_id"] = mid
             else:
-                for p in indices:
-                    int_values = "<p>"
-                    for i in p:
-                        int_values += " {}".format(i)
-                    int_values += " </p>"
-                    self.writel(S_GEOM, 4, int_values)
-
-            self.writel(S_GEOM, 3, "</{}>".format(prim_type))
-
-        # LSLib model type / extra data
-        if self.config["extra_data_disabled"] == False:
-            self.writel(S_GEOM, 3, "<extra>")
-            self.writel(S_GEOM, 4, "<technique profile=\"LSTools\">")
-            
-            mesh_extra = ""
-            obj_check = bpy.data.objects[node.name]
-            mesh_check = bpy.data.meshes[mesh.name]
+                meshdata["id"] = morph_targets[0]["id"]
+                meshdata["morph_id"] = mid
+                meshdata["material_assign"] = morph_targets[
+                    0]["material_assign"]
 
-            #Animations don't use custom flags
-            if self.config["use_anim"] == False:
-                # Custom Property
-                if self.mesh_has_property(obj_check, mesh_check, "rigid"):
-                    mesh_extra = "rigid"
-                if self.mesh_has_property(obj_check, mesh_check, "cloth"):
-                    mesh_extra = "cloth"
-                if self.mesh_has_property(obj_check, mesh_check, "meshproxy"):
-                    mesh_extra = "meshproxy"
-                if self.mesh_has_property(obj_check, mesh_check, "rigidcloth"):
-                    mesh_extra = "rigidcloth"
-                # Global
-                if self.config["convert_gr2"] == True:
-                    extra_settings = self.config["divine_settings"].gr2_settings.extras
-                    if extra_settings == "RIGID":
-                        mesh_extra = "rigid"
-                    if extra_settings == "CLOTH":
-                        mesh_extra = "cloth"
-                    if extra_settings == "MESHPROXY":
-                        mesh_extra = "meshproxy"   
-                    if extra_settings == "RIGIDCLOTH":
-                        mesh_extra = "rigidcloth"
-            if mesh_extra == "rigid":
-                self.writel(S_GEOM, 5, "<DivModelType>Rigid</DivModelType>")
-            elif mesh_extra == "cloth":
-                self.writel(S_GEOM, 5, "<DivModelType>Cloth</DivModelType>")
-            elif mesh_extra == "meshproxy":
-                self.writel(S_GEOM, 5, "<DivModelType>MeshProxy</DivModelType>")
-            elif mesh_extra == "rigidcloth":
-                self.writel(S_GEOM, 5, "<DivModelType>Rigid</DivModelType><DivModelType>Cloth</DivModelType>")
-            else:
-                self.writel(S_GEOM, 5, "<DivModelType>Normal</DivModelType>")
+            self.mesh_cache[node.data] = meshdata
+            return meshdata
 
 
-            self.writel(S_GEOM, 4, "</technique>")
-            self.writel(S_GEOM, 3, "</extra>")
+        geometry, vertices, mat_assign, surface_materials = (
+            self.extract_geometry(node, armature, skeyindex, export_name))
+        meshid = geometry.geometry_id
+        self.write_block(S_GEOM, geometry)
 
-        self.writel(S_GEOM, 2, "</mesh>")
-        self.writel(S_GEOM, 1, "</geometry>")
+        si = None
+        if armature is not None:
+            si = self.skeleton_info[armature]
 
         meshdata = {}
         meshdata["id"] = meshid
@@ -772,116 +583,31 @@ class DaeExporter:
         if (armature is not None and (
                 skel_source is not None or skeyindex == -1)):
             #contid = self.new_id("controller")
-            armature_name = armature.get("export_name", armature.name)
+            armature_name = self.export_name(armature)
             contid = self.new_id(armature_name)
 
-            self.writel(S_SKIN, 1, "<controller id=\"{}\">".format(contid))
-            if (skel_source is not None):
-                self.writel(S_SKIN, 2, "<skin source=\"#{}\">".format(
-                    skel_source))
-            else:
-                self.writel(S_SKIN, 2, "<skin source=\"#{}\">".format(meshid))
-
-            self.writel(
-                S_SKIN, 3, "<bind_shape_matrix>{}</bind_shape_matrix>".format(
-                    strmtx(node.matrix_world)))
-            # Joint Names
-            self.writel(S_SKIN, 3, "<source id=\"{}-joints\">".format(contid))
-            name_values = ""
-            for v in si["bone_names"]:
-                name_values += " {}".format(v)
-
-            self.writel(
-                S_SKIN, 4, "<Name_array id=\"{}-joints-array\" "
-                "count=\"{}\">{}</Name_array>".format(
-                    contid, len(si["bone_names"]), name_values))
-            self.writel(S_SKIN, 4, "<technique_common>")
-            self.writel(
-                S_SKIN, 4, "<accessor source=\"#{}-joints-array\" "
-                "count=\"{}\" stride=\"1\">".format(
-                    contid, len(si["bone_names"])))
-            self.writel(S_SKIN, 5, "<param name=\"JOINT\" type=\"Name\"/>")
-            self.writel(S_SKIN, 4, "</accessor>")
-            self.writel(S_SKIN, 4, "</technique_common>")
-            self.writel(S_SKIN, 3, "</source>")
-            # Pose Matrices!
-            self.writel(S_SKIN, 3, "<source id=\"{}-bind_poses\">".format(
-                contid))
-            pose_values = ""
-            for v in si["bone_bind_poses"]:
-                pose_values += " {}".format(strmtx(v))
-
-            self.writel(
-                S_SKIN, 4, "<float_array id=\"{}-bind_poses-array\" "
-                "count=\"{}\">{}</float_array>".format(
-                    contid, len(si["bone_bind_poses"]) * 16, pose_values))
-            self.writel(S_SKIN, 4, "<technique_common>")
-            self.writel(
-                S_SKIN, 4, "<accessor source=\"#{}-bind_poses-array\" "
-                "count=\"{}\" stride=\"16\">".format(
-                    contid, len(si["bone_bind_poses"])))
-            self.writel(
-                S_SKIN, 5, "<param name=\"TRANSFORM\" type=\"float4x4\"/>")
-            self.writel(S_SKIN, 4, "</accessor>")
-            self.writel(S_SKIN, 4, "</technique_common>")
-            self.writel(S_SKIN, 3, "</source>")
-            # Skin Weights!
-            self.writel(S_SKIN, 3, "<source id=\"{}-skin_weights\">".format(
-                contid))
-            skin_weights = ""
-            skin_weights_total = 0
-            for v in vertices:
-                skin_weights_total += len(v.weights)
-                for w in v.weights:
-                    skin_weights += " {}".format(w)
-
-            self.writel(
-                S_SKIN, 4, "<float_array id=\"{}-skin_weights-array\" "
-                "count=\"{}\">{}</float_array>".format(
-                    contid, skin_weights_total, skin_weights))
-            self.writel(S_SKIN, 4, "<technique_common>")
-            self.writel(
-                S_SKIN, 4, "<accessor source=\"#{}-skin_weights-array\" "
-                "count=\"{}\" stride=\"1\">".format(
-                    contid, skin_weights_total))
-            self.writel(S_SKIN, 5, "<param name=\"WEIGHT\" type=\"float\"/>")
-            self.writel(S_SKIN, 4, "</accessor>")
-            self.writel(S_SKIN, 4, "</technique_common>")
-            self.writel(S_SKIN, 3, "</source>")
-
-            self.writel(S_SKIN, 3, "<joints>")
-            self.writel(
-                S_SKIN, 4,
-                "<input semantic=\"JOINT\" source=\"#{}-joints\"/>".format(
-                    contid))
-            self.writel(
-                S_SKIN, 4, "<input semantic=\"INV_BIND_MATRIX\" "
-                "source=\"#{}-bind_poses\"/>".format(contid))
-            self.writel(S_SKIN, 3, "</joints>")
-            self.writel(
-                S_SKIN, 3, "<vertex_weights count=\"{}\">".format(
-                    len(vertices)))
-            self.writel(
-                S_SKIN, 4, "<input semantic=\"JOINT\" "
-                "source=\"#{}-joints\" offset=\"0\"/>".format(contid))
-            self.writel(
-                S_SKIN, 4, "<input semantic=\"WEIGHT\" "
-                "source=\"#{}-skin_weights\" offset=\"1\"/>".format(contid))
-            vcounts = ""
-            vs = ""
-            vcount = 0
-            for v in vertices:
-                vcounts += " {}".format(len(v.weights))
-                for b in v.bones:
-                    vs += " {} {}".format(b, vcount)
-                    vcount += 1
-            self.writel(S_SKIN, 4, "<vcount>{}</vcount>".format(vcounts))
-            self.writel(S_SKIN, 4, "<v>{}</v>".format(vs))
-            self.writel(S_SKIN, 3, "</vertex_weights>")
-
-            self.writel(S_SKIN, 2, "</skin>")
-            self.writel(S_SKIN, 1, "</controller>")
+            counts = [len(v.weights) for v in vertices]
+            bones = [b for v in vertices for b in v.bones]
+            weights = [w for v in vertices for w in v.weights]
+            if (self.config["use_limit_total"] or
+                    self.config["use_normalize_vert_groups"]):
+                limit = 0
+                if (self.config["use_limit_total"]):
+                    limit = self.config["weight_limit"]
+                counts, bones, weights = geometry_ops.limit_weights(
+                    counts, bones, weights, limit,
+                    self.config["use_normalize_vert_groups"])
+
+            skin = SkinBlock(
+                contid, skel_source if skel_source is not None else meshid,
+                bind_shape_matrix=[list(r) for r in self.node_world(node)],
+                joint_names=si["bone_names"],
+                bind_poses=[[list(r) for r in v] for v in si["bone_bind_poses"]],
+                counts=counts, bones=bones, weights=weights)
+            self.write_block(S_SKIN, skin)
             meshdata["skin_id"] = contid
+            si["weighted_bones"].update(
+                skin.bones[skin.weights > 0.0].tolist())
 
         return meshdata
 
@@ -896,7 +622,7 @@ class DaeExporter:
             if (n.type == "ARMATURE"):
                 armcount += 1
 
-        if (node.parent is not None):
+        if (node.parent is not None and not self.is_unparented(node)):
             if (node.parent.type == "ARMATURE"):
                 armature = node.parent
                 if (armcount > 1):
@@ -928,6 +654,10 @@ class DaeExporter:
                                     self.armature_for_morph[
                                         node] = self.objects[t.id.name]
 
+        if (self.config["chunk_size"] > 0 and self.is_static_mesh(node)):
+            self.export_mesh_chunks(node, il, export_name or node.name)
+            return
+
         print("  [DOS2DE-Exporter] Preparing meshdata for '{}'.".format(node.name))
         meshdata = self.export_mesh(node, armature, export_name=export_name)
         close_controller = False
@@ -997,20 +727,18 @@ class DaeExporter:
         if (is_ctrl_bone is False):
             il += 1
 
-        xform = bone.matrix_local
+        xform = si["rest_matrices"][bone.name]
         if (is_ctrl_bone is False):
             si["bone_bind_poses"].append(
                     (si["armature_xform"] * xform).inverted_safe())
 
         if (bone.parent is not None):
-            xform = bone.parent.matrix_local.inverted_safe() * xform
+            xform = si["rest_matrices"][bone.parent.name].inverted_safe() * xform
         else:
             si["skeleton_nodes"].append(boneid)
 
         if (is_ctrl_bone is False):
-            self.writel(
-                S_NODES, il, "<matrix sid=\"transform\">{}</matrix>".format(
-                    strmtx(xform)))
+            self.write_node_transform(il, boneid, xform)
 
         for c in bone.children:
             self.export_armature_bone(c, il, si)
@@ -1019,6 +747,73 @@ class DaeExporter:
             il -= 1
             self.writel(S_NODES, il, "</node>")
 
+    def applied_pose(self, node):
+        """Armature space pose matrices that stand in for the rest pose.
+
+        Copies get their current pose applied as rest pose when the
+        armature modifier is excluded, the non-destructive export reads
+        that pose instead. None when the rest pose is used as is.
+        """
+        if (self.config["use_nondestructive"] and
+                self.config["use_exclude_armature_modifier"] and node.pose):
+            return dict((b.name, b.matrix.copy()) for b in node.pose.bones)
+        return None
+
+    def bone_track_corrections(self, node):
+        """Left factor per sampled bone that moves its local samples onto
+        the rest pose the bone is exported with.
+
+        Actions play relative to the rest pose, so a bone's local matrix
+        becomes its exported local rest pose times its basis. On a copy
+        with its pose applied that rest is the applied pose, and a flipped
+        armature's rest is mirrored on both sides, with the mirror in
+        front applied along with the data matrix.
+        """
+        applied = self.skeleton_info[node]["applied_pose"]
+        flip = self.flip_matrix(node)
+        if (applied is None and flip is None):
+            return None
+
+        plan = self.sampling_plans[node]
+        names = [pb.name for pb in plan["posebones"]]
+        bones = node.data.bones
+        corrections = []
+        for bone_id, index, parent_index in plan["bones"]:
+            name = names[index]
+            rest_local = bones[name].matrix_local
+            if (parent_index != -1):
+                parent = names[parent_index]
+                rest_local = (bones[parent].matrix_local.inverted_safe() *
+                              rest_local)
+            target = rest_local
+            if (applied is not None):
+                target = applied[name]
+                if (parent_index != -1):
+                    target = applied[parent].inverted_safe() * target
+            if (flip is not None):
+                target = target * flip
+            corrections.append(
+                np.array(target * rest_local.inverted_safe()))
+        return corrections
+
+    def bone_rest_matrices(self, node, applied=None):
+        """Armature space rest matrix of every bone, from the applied pose
+        if there is one."""
+        if (applied is not None):
+            rest = dict(applied)
+        else:
+            rest = dict((b.name, b.matrix_local) for b in node.data.bones)
+
+        # Mirrored bones are mirrored on both sides to stay rotations
+        data_matrix = self.data_matrix(node)
+        flip = self.flip_matrix(node)
+        if (data_matrix is not None):
+            for name in rest:
+                rest[name] = data_matrix * rest[name]
+                if (flip is not None):
+                    rest[name] = rest[name] * flip
+        return rest
+
     def export_armature_node(self, node, il, export_name=""):
         if (node.data is None):
             return
@@ -1026,6 +821,7 @@ class DaeExporter:
         self.skeletons.append(node)
 
         armature = node.data
+        applied = self.applied_pose(node)
         self.skeleton_info[node] = {
             "bone_count": 0,
             "id": self.new_id(export_name),
@@ -1035,7 +831,10 @@ class DaeExporter:
             "bone_names": [],
             "bone_bind_poses": [],
             "skeleton_nodes": [],
-            "armature_xform": node.matrix_world
+            "weighted_bones": set(),
+            "applied_pose": applied,
+            "rest_matrices": self.bone_rest_matrices(node, applied),
+            "armature_xform": self.node_world(node)
         }
 
         for b in armature.bones:
@@ -1244,18 +1043,29 @@ class DaeExporter:
         if imgpath.startswith("//"):
             imgpath = bpy.path.abspath(imgpath)
 
+        # Different datablocks pointing at the same file share one image
+        source_key = None
+        if os.path.isfile(imgpath):
+            source_key = image_staging.source_key(imgpath)
+            img_id = self.image_source_cache.get(source_key)
+            if img_id:
+                self.image_cache[image] = img_id
+                return img_id
+
         if (self.config["use_copy_images"]):
             basedir = os.path.join(os.path.dirname(self.path), "images")
             if (not os.path.isdir(basedir)):
                 os.makedirs(basedir)
 
-            if os.path.isfile(imgpath):
-                dstfile = os.path.join(basedir, os.path.basename(imgpath))
-
-                if not os.path.isfile(dstfile):
-                    shutil.copy(imgpath, dstfile)
-                imgpath = os.path.join("images", os.path.basename(imgpath))
+            if source_key is not None:
+                if self.image_stager is None:
+                    self.image_stager = image_staging.ImageStager(
+                        basedir, self.config["use_image_hardlinks"])
+                imgpath = os.path.join(
+                    "images", self.image_stager.stage(imgpath))
             else:
+                # Packed and generated images have to be saved from the
+                # main thread
                 img_tmp_path = image.filepath
                 if img_tmp_path.lower().endswith(
                     tuple(bpy.path.extensions_image)):
@@ -1291,13 +1101,75 @@ class DaeExporter:
         self.writel(S_IMGS, 2, "<init_from>{}</init_from>".format(imgpath))
         self.writel(S_IMGS, 1, "</image>")
         self.image_cache[image] = imgid
+        if source_key is not None:
+            self.image_source_cache[source_key] = imgid
         return imgid
 
+    def finish_image_staging(self):
+        if self.image_stager is None:
+            return
+        counts, errors = self.image_stager.finish()
+        self.image_stager = None
+        print("[DOS2DE-Exporter] Staged images: {}".format(", ".join(
+            "{} {}".format(v, k) for k, v in sorted(counts.items()))))
+        for e in errors:
+            self.operator.report({"WARNING"}, e)
+
+    def material_fingerprint(self, material, double_sided_hint):
+        """Key over every material field export_material writes."""
+        slots = []
+        for i in range(len(material.texture_slots)):
+            ts = material.texture_slots[i]
+            if not ts:
+                continue
+            if not ts.use:
+                continue
+            if not ts.texture:
+                continue
+            if ts.texture.type != "IMAGE":
+                continue
+            if ts.texture.image is None:
+                continue
+
+            image = ts.texture.image
+            imgpath = image.filepath
+            if imgpath.startswith("//"):
+                imgpath = bpy.path.abspath(imgpath)
+            if os.path.isfile(imgpath):
+                image_key = image_staging.source_key(imgpath)
+            else:
+                image_key = image.name
+
+            slots.append((i, image_key, ts.use_map_color_diffuse,
+                          ts.use_map_color_spec, ts.use_map_emit,
+                          ts.use_map_normal))
+
+        return (
+            tuple(slots),
+            tuple(material.diffuse_color), material.diffuse_intensity,
+            material.emit, material.ambient,
+            tuple(material.specular_color), material.specular_intensity,
+            material.specular_hardness, tuple(material.mirror_color),
+            material.use_transparency, material.alpha, material.specular_ior,
+            material.use_shadeless, bool(double_sided_hint))
+
     def export_material(self, material, double_sided_hint=True, export_name=""):
         material_id = self.material_cache.get(material)
         if material_id:
             return material_id
 
+        # Copies such as Mat.001 with identical settings share one material
+        fingerprint = None
+        if self.config["use_material_dedup"]:
+            fingerprint = self.material_fingerprint(material, double_sided_hint)
+            material_id = self.material_fingerprints.get(fingerprint)
+            if material_id:
+                print("    [DOS2DE-Exporter] Material '{}' is identical to an "
+                      "exported material, reusing '{}'.".format(
+                          material.name, material_id))
+                self.material_cache[material] = material_id
+                return material_id
+
         fxid = self.new_id("fx")
         self.writel(S_FX, 1, "<effect id=\"{}\" name=\"{}-fx\">".format(
             fxid, material.name))
@@ -1450,6 +1322,8 @@ class DaeExporter:
         self.writel(S_MATS, 1, "</material>")
 
         self.material_cache[material] = matid
+        if fingerprint is not None:
+            self.material_fingerprints[fingerprint] = matid
         return matid
 
     def escape(self, data):
@@ -1465,10 +1339,7 @@ class DaeExporter:
         prev_node = self.active_object
         self.active_object = node
 
-        try:
-            export_name = self.escape(node["export_name"])
-        except:
-            export_name = node.name
+        export_name = self.escape(self.export_name(node))
         
         exportid = self.new_id(export_name)
 
@@ -1482,9 +1353,8 @@ class DaeExporter:
             il += 1
 
         if node.type != "ARMATURE" or export_armature_enabled == True:
-            self.writel(
-                S_NODES, il, "<matrix sid=\"transform\">{}</matrix>".format(
-                    strmtx(node.matrix_local)))
+            self.write_node_transform(
+                il, self.validate_id(exportid), self.node_matrix(node))
         if (node.type == "MESH"):
             self.export_mesh_node(node, il, export_name=export_name)
         elif (node.type == "CURVE"):
@@ -1494,14 +1364,275 @@ class DaeExporter:
         elif (node.type == "EMPTY"):
             self.export_empty_node(node, il, export_name=export_name)
 
-        for x in sorted(node.children, key=lambda x: x.name):
-            self.export_node(x, il)
+        self.export_nodes(node.children, il)
 
         il -= 1
         if node.type != "ARMATURE" or export_armature_enabled == True:
             self.writel(S_NODES, il, "</node>")
         self.active_object = prev_node
 
+    def node_matrix(self, node):
+        """Transform of a node relative to its exported parent. Nodes whose
+        parent is not exported are written in world space."""
+        if (self.up_matrix is not None):
+            return Matrix.Identity(4)
+        if (node.parent is None or node.parent not in self.valid_nodes):
+            return node.matrix_world
+        return node.matrix_local
+
+    def node_world(self, node):
+        """World transform written for a node."""
+        if (self.up_matrix is not None):
+            return Matrix.Identity(4)
+        return node.matrix_world
+
+    def data_matrix(self, node):
+        """Matrix baked into a node's mesh or bone data, or None.
+
+        Y-up conversion bakes every node's world transform, with its root's
+        conversion, into its data and writes the nodes with identity
+        transforms. X-flips then mirror the data in world space, without
+        y-up they mirror it in the node's local space.
+        """
+        flip = self.flip_matrix(node)
+        if (self.up_matrix is None):
+            return flip
+        return Matrix(anim_ops.yup_data_matrix(
+            np.array(self.up_corrections[node]),
+            np.array(self.export_worlds[node]),
+            None if flip is None else np.array(flip)).tolist())
+
+    def root_up_corrections(self, exported):
+        """Y-up conversion of every object, in world space.
+
+        Each root is rotated on its local side, as if its own rotation had
+        been turned to y-up and its transform applied, and its descendants
+        follow it. Returns the world space change for every object.
+        """
+        up = np.array(self.up_matrix)
+        corrections = {}
+        for obj in self.objects:
+            root = obj
+            while (root.parent in exported):
+                root = root.parent
+            if (root not in corrections):
+                corrections[root] = Matrix(anim_ops.local_basis_correction(
+                    np.array(self.export_worlds[root]), up).tolist())
+            corrections[obj] = corrections[root]
+        return corrections
+
+    def flip_matrix(self, node):
+        """The x mirror for flipped meshes and armatures, or None."""
+        if ((node.type == "MESH" and self.config["xflip_mesh"]) or
+                (node.type == "ARMATURE" and self.config["xflip_armature"])):
+            return Matrix.Scale(-1.0, 4, Vector((1.0, 0.0, 0.0)))
+        return None
+
+    def convert_object_tracks(self, plan, xform_cache):
+        """Turn sampled object transforms into changes from the transform
+        baked into each node's data, in y-up space."""
+        for node, name in plan["objects"]:
+            pre = self.up_corrections[node]
+            if (node.parent in self.valid_nodes):
+                pre = pre * self.export_worlds[node.parent]
+            flip = self.flip_matrix(node)
+            if (flip is not None):
+                pre = flip * pre
+            post = self.data_matrix(node).inverted_safe()
+            xform_cache[name] = [
+                (key, pre * Matrix(np.asarray(mtx).tolist()) * post)
+                for key, mtx in xform_cache[name]]
+
+    def export_nodes(self, nodes, il):
+        """Export sibling nodes, writing static batches in place of their
+        members."""
+        nodes = [n for n in sorted(nodes, key=lambda x: x.name)
+                 if n in self.valid_nodes]
+        batch_of = {}
+        if self.config["use_static_batching"]:
+            for batch in self.collect_static_batches(nodes):
+                for n in batch:
+                    batch_of[n] = batch
+
+        for n in nodes:
+            batch = batch_of.get(n)
+            if batch is None:
+                self.export_node(n, il)
+            elif batch[0] == n:
+                self.export_static_batch(batch, il)
+
+    def is_static_mesh(self, node):
+        if node.type != "MESH" or node.data is None:
+            return False
+        if node.parent is not None and node.parent.type == "ARMATURE":
+            return False
+        if any(m.type == "ARMATURE" for m in node.modifiers):
+            return False
+        if node.data.shape_keys is not None and self.config[
+                "use_shape_key_export"]:
+            return False
+        if node.animation_data is not None:
+            return False
+        return True
+
+    def collect_static_batches(self, nodes):
+        """Group sibling static meshes that can share geometry.
+
+        Meshes listed in the scene's llexportmerge meshes are batched
+        together, the rest are batched when they use the same materials.
+        Only meshes of the same model type share a batch.
+        """
+        merge_names = set()
+        if hasattr(self.scene, "llexportmerge"):
+            merge_names = set(m.name for m in self.scene.llexportmerge.meshes)
+
+        groups = {}
+        order = []
+        for node in nodes:
+            if not self.is_static_mesh(node):
+                continue
+            if any(c in self.valid_nodes for c in node.children):
+                continue
+            props = getattr(node, "llexportprops", None)
+            original_name = getattr(props, "original_name", "") or node.name
+            # Merged geometry is written with a single model type
+            model_type = self.model_type(node, node.data)
+            if original_name in merge_names:
+                key = ("llexportmerge", model_type)
+            else:
+                names = sorted(set(s.material.name for s in node.material_slots
+                                   if s.material is not None))
+                if not names:
+                    continue
+                key = ("material", model_type) + tuple(names)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(node)
+
+        return [groups[key] for key in order if len(groups[key]) > 1]
+
+    def export_static_batch(self, nodes, il):
+        """Write several static meshes as one node and geometry per material.
+
+        Vertices are moved into the parent's space, so the batch node uses
+        an identity transform.
+        """
+        batch_name = self.escape(self.export_name(nodes[0]))
+
+        merged = {}
+        order = []
+        model_type = ""
+        for node in nodes:
+            geometry, vertices, mat_assign, surface_materials = (
+                self.extract_geometry(node, export_name=node.name))
+            geometry_ops.transform_geometry(geometry, self.node_matrix(node))
+            if not model_type:
+                model_type = geometry.model_type
+            symbol_material = dict((sym, mat) for mat, sym in mat_assign)
+            for part, material in zip(
+                    geometry_ops.split_surfaces(geometry), surface_materials):
+                matid = symbol_material.get(part.surfaces[0][0])
+                if matid not in merged:
+                    label = material.name if material is not None else "None"
+                    merged[matid] = (label, [])
+                    order.append(matid)
+                merged[matid][1].append(part)
+
+        print("  [DOS2DE-Exporter] Batching {} static meshes into {} "
+              "geometries for '{}'.".format(len(nodes), len(order), batch_name))
+
+        for matid in order:
+            label, parts = merged[matid]
+            export_name = "{}_{}".format(batch_name, self.escape(label))
+            geometry = geometry_ops.merge_geometries(
+                self.new_id(export_name), export_name, parts,
+                symbol=self.new_id("trimat") if matid is not None else None,
+                model_type=model_type)
+            self.write_block(S_GEOM, geometry)
+
+            node_id = self.validate_id(self.new_id(export_name))
+            self.writel(
+                S_NODES, il, "<node id=\"{}\" name=\"{}\" type=\"NODE\">".format(
+                    node_id, export_name))
+            self.write_node_transform(il + 1, node_id, Matrix.Identity(4))
+            material_assign = []
+            if matid is not None:
+                material_assign.append((matid, geometry.surfaces[0][0]))
+            self.write_instance_geometry(
+                il + 1, geometry.geometry_id, material_assign)
+            self.writel(S_NODES, il, "</node>")
+
+    def write_instance_geometry(self, il, geometry_id, material_assign):
+        self.writel(S_NODES, il, "<instance_geometry url=\"#{}\">".format(
+            geometry_id))
+        if (len(material_assign) > 0):
+            self.writel(S_NODES, il + 1, "<bind_material>")
+            self.writel(S_NODES, il + 2, "<technique_common>")
+            for m in material_assign:
+                self.writel(
+                    S_NODES, il + 3,
+                    "<instance_material symbol=\"{}\" target=\"#{}\"/>".format(
+                        m[1], m[0]))
+            self.writel(S_NODES, il + 2, "</technique_common>")
+            self.writel(S_NODES, il + 1, "</bind_material>")
+        self.writel(S_NODES, il, "</instance_geometry>")
+
+    def export_mesh_chunks(self, node, il, export_name):
+        """Split a static mesh into grid cells, one child node and geometry
+        per cell, so each part can be culled on its own."""
+        cell_size = self.config["chunk_size"]
+        geometry, vertices, mat_assign, surface_materials = (
+            self.extract_geometry(node, export_name=export_name))
+        chunks = geometry_ops.partition_geometry(geometry, cell_size)
+
+        print("  [DOS2DE-Exporter] Splitting '{}' into {} chunks of size {}.".format(
+            export_name, len(chunks), cell_size))
+
+        for i, (cell, chunk) in enumerate(chunks):
+            chunk_name = "{}_chunk{}".format(export_name, i)
+            chunk.geometry_id = self.new_id(chunk_name)
+            chunk.name = chunk_name
+            self.write_block(S_GEOM, chunk)
+
+            bmin, bmax = geometry_ops.geometry_bounds(chunk)
+            print("    [DOS2DE-Exporter] Chunk {} {}: {} triangles, bounds "
+                  "({:.3f}, {:.3f}, {:.3f}) - ({:.3f}, {:.3f}, {:.3f}).".format(
+                      i, cell, geometry_ops.triangle_count(chunk),
+                      *(bmin.tolist() + bmax.tolist())))
+
+            symbols = set(s[0] for s in chunk.surfaces)
+            self.writel(
+                S_NODES, il, "<node id=\"{}\" name=\"{}\" type=\"NODE\">".format(
+                    self.validate_id(self.new_id(chunk_name)), chunk_name))
+            self.writel(
+                S_NODES, il + 1, "<matrix sid=\"transform\">{}</matrix>".format(
+                    strmtx(Matrix.Identity(4))))
+            self.write_instance_geometry(
+                il + 1, chunk.geometry_id,
+                [m for m in mat_assign if m[1] in symbols])
+            self.writel(S_NODES, il, "</node>")
+
+    def export_name(self, node):
+        """Name a node is written with.
+
+        Copies carry the name their export properties prepared. The
+        non-destructive export reads those properties instead of preparing
+        the originals.
+        """
+        if (self.config["use_nondestructive"]):
+            props = getattr(node, "llexportprops", None)
+            return getattr(props, "export_name", "") or node.name
+        return node.get("export_name", node.name)
+
+    def is_unparented(self, node):
+        """Whether copy mode would unparent this mesh from an armature that
+        doesn't export, keeping its world transform."""
+        return (self.config["use_nondestructive"] and
+                self.config["use_mesh_modifiers"] and node.type == "MESH" and
+                node.parent is not None and node.parent.type == "ARMATURE" and
+                not self.can_export_type("ARMATURE"))
+
     def can_export_type(self, objtype):
         if (objtype not in self.config["object_types"]):
             return False
@@ -1529,19 +1660,22 @@ class DaeExporter:
             S_NODES, 1, "<visual_scene id=\"{}\" name=\"scene\">".format(
                 self.scene_name))
 
+        exported = set(self.objects)
+        self.export_worlds = dict(
+            (obj, obj.matrix_world.copy()) for obj in self.objects)
+        if (self.up_matrix is not None):
+            self.up_corrections = self.root_up_corrections(exported)
         for obj in self.objects:
             if (obj in self.valid_nodes):
                 continue
             if (self.can_export_type(obj.type)):
                 n = obj
-                while (n is not None):
-                    if (n not in self.valid_nodes):
-                        self.valid_nodes.append(n)
-                    n = n.parent
+                while (n is not None and n in exported):
+                    self.valid_nodes.add(n)
+                    n = None if self.is_unparented(n) else n.parent
 
-        for obj in sorted(self.objects, key=lambda x: x.name):
-            if (obj in self.valid_nodes and obj.parent is None):
-                self.export_node(obj, 2)
+        self.export_nodes([obj for obj in self.objects
+                           if obj.parent not in self.valid_nodes], 2)
 
         self.writel(S_NODES, 1, "</visual_scene>")
         self.writel(S_NODES, 0, "</library_visual_scenes>")
@@ -1565,113 +1699,90 @@ class DaeExporter:
             self.writel(S_ASSET, 1, "<up_axis>Z_UP</up_axis>")
         self.writel(S_ASSET, 0, "</asset>")
 
-    def export_animation_transform_channel(self, target, keys, matrices=True):
-        frame_total = len(keys)
-        anim_id = self.new_id("anim")
-        #anim_id = self.new_id(target)
-        self.writel(S_ANIM, 1, "<animation id=\"{}\">".format(anim_id))
-        source_frames = ""
-        source_transforms = ""
-        source_interps = ""
-
-        for k in keys:
-            source_frames += " {}".format(k[0])
-            if (matrices):
-                source_transforms += " {}".format(strmtx(k[1]))
-            else:
-                source_transforms += " {}".format(k[1])
+    def use_trs_channels(self):
+        return (self.config["use_anim"] and
+                self.config["anim_channel_mode"] == "TRS")
 
-            source_interps += " LINEAR"
+    def write_node_transform(self, il, target, matrix):
+        if (not self.use_trs_channels()):
+            self.writel(
+                S_NODES, il, "<matrix sid=\"transform\">{}</matrix>".format(
+                    strmtx(matrix)))
+            return
 
-        # Time Source
-        self.writel(S_ANIM, 2, "<source id=\"{}-input\">".format(anim_id))
-        self.writel(
-            S_ANIM, 3, "<float_array id=\"{}-input-array\" "
-            "count=\"{}\">{}</float_array>".format(
-                anim_id, frame_total, source_frames))
-        self.writel(S_ANIM, 3, "<technique_common>")
-        self.writel(
-            S_ANIM, 4, "<accessor source=\"#{}-input-array\" "
-            "count=\"{}\" stride=\"1\">".format(anim_id, frame_total))
-        self.writel(S_ANIM, 5, "<param name=\"TIME\" type=\"float\"/>")
-        self.writel(S_ANIM, 4, "</accessor>")
-        self.writel(S_ANIM, 3, "</technique_common>")
-        self.writel(S_ANIM, 2, "</source>")
+        # Separate elements, so each component can have its own channel
+        rest = anim_ops.decompose_matrix([list(r) for r in matrix])
+        self.node_rest_trs[target] = rest
+        translation, rotation, scale = [v.tolist() for v in rest]
+        self.writel(S_NODES, il, "<translate sid=\"location\">{}</translate>".format(
+            " ".join(map(repr, translation))))
+        for axis, i in (("Z", 2), ("Y", 1), ("X", 0)):
+            vector = ["0", "0", "0"]
+            vector[i] = "1"
+            self.writel(S_NODES, il, "<rotate sid=\"rotation{}\">{} {}</rotate>".format(
+                axis, " ".join(vector), repr(rotation[i])))
+        self.writel(S_NODES, il, "<scale sid=\"scale\">{}</scale>".format(
+            " ".join(map(repr, scale))))
+
+    def export_animation_trs_channels(self, target, keys):
+        """Write only the animated translation, rotation and scale
+        components of a matrix track."""
+        times = [k[0] for k in keys]
+        tracks = anim_ops.trs_tracks(
+            [[list(r) for r in k[1]] for k in keys],
+            self.node_rest_trs.get(target))
+        tolerance = 10.0 ** -self.config["anim_optimize_precision"]
+
+        if (self.config["anim_curve_fit"]):
+            return self.export_animation_bezier_channels(target, times, tracks)
+
+        anim_ids = []
+        for component, values in tracks:
+            track_times = times
+            if (self.config["use_anim_optimize"]):
+                keep = anim_ops.reduce_keys(times, values, tolerance)
+                track_times = [times[i] for i in keep.tolist()]
+                values = values[keep]
+            anim_id = self.new_id("anim")
+            self.write_block(S_ANIM, AnimationBlock(
+                anim_id, target, track_times, values, component=component))
+            anim_ids.append(anim_id)
+        return anim_ids
+
+    def export_animation_bezier_channels(self, target, times, tracks):
+        """Fit every scalar TRS track with Bezier curves. Location and
+        scale are split per axis so each channel carries its own keys."""
+        tolerance = self.config["anim_curve_tolerance"]
+        anim_ids = []
+        for component, values in tracks:
+            if (values.shape[1] == 1):
+                axes = [(component, values[:, 0])]
+            else:
+                axes = [("{}.{}".format(component, axis), values[:, j])
+                        for j, axis in enumerate(TRS_CHANNELS[component][1])]
+            for channel, axis_values in axes:
+                keep, in_tangents, out_tangents = anim_ops.fit_bezier(
+                    times, axis_values, tolerance)
+                anim_id = self.new_id("anim")
+                self.write_block(S_ANIM, AnimationBlock(
+                    anim_id, target, [times[i] for i in keep.tolist()],
+                    axis_values[keep], component=channel,
+                    in_tangents=in_tangents, out_tangents=out_tangents))
+                anim_ids.append(anim_id)
+        return anim_ids
 
+    def export_animation_transform_channel(self, target, keys, matrices=True):
+        if (matrices and self.use_trs_channels()):
+            return self.export_animation_trs_channels(target, keys)
+
+        anim_id = self.new_id("anim")
+        #anim_id = self.new_id(target)
         if (matrices):
-            # Transform Source
-            self.writel(
-                S_ANIM, 2, "<source id=\"{}-transform-output\">".format(
-                    anim_id))
-            self.writel(
-                S_ANIM, 3, "<float_array id=\"{}-transform-output-array\" "
-                "count=\"{}\">{}</float_array>".format(
-                    anim_id, frame_total * 16, source_transforms))
-            self.writel(S_ANIM, 3, "<technique_common>")
-            self.writel(
-                S_ANIM, 4,
-                "<accessor source=\"#{}-transform-output-array\" count=\"{}\" "
-                "stride=\"16\">".format(anim_id, frame_total))
-            self.writel(
-                S_ANIM, 5, "<param name=\"TRANSFORM\" type=\"float4x4\"/>")
-            self.writel(S_ANIM, 4, "</accessor>")
-            self.writel(S_ANIM, 3, "</technique_common>")
-            self.writel(S_ANIM, 2, "</source>")
-        else:
-            # Value Source
-            self.writel(
-                S_ANIM, 2,
-                "<source id=\"{}-transform-output\">".format(anim_id))
-            self.writel(
-                S_ANIM, 3, "<float_array id=\"{}-transform-output-array\" "
-                "count=\"{}\">{}</float_array>".format(
-                    anim_id, frame_total, source_transforms))
-            self.writel(S_ANIM, 3, "<technique_common>")
-            self.writel(
-                S_ANIM, 4, "<accessor source=\"#{}-transform-output-array\" "
-                "count=\"{}\" stride=\"1\">".format(anim_id, frame_total))
-            self.writel(S_ANIM, 5, "<param name=\"X\" type=\"float\"/>")
-            self.writel(S_ANIM, 4, "</accessor>")
-            self.writel(S_ANIM, 3, "</technique_common>")
-            self.writel(S_ANIM, 2, "</source>")
-
-        # Interpolation Source
-        self.writel(
-            S_ANIM, 2, "<source id=\"{}-interpolation-output\">".format(
-                anim_id))
-        self.writel(
-            S_ANIM, 3, "<Name_array id=\"{}-interpolation-output-array\" "
-            "count=\"{}\">{}</Name_array>".format(
-                anim_id, frame_total, source_interps))
-        self.writel(S_ANIM, 3, "<technique_common>")
-        self.writel(
-            S_ANIM, 4, "<accessor source=\"#{}-interpolation-output-array\" "
-            "count=\"{}\" stride=\"1\">".format(anim_id, frame_total))
-        self.writel(S_ANIM, 5, "<param name=\"INTERPOLATION\" type=\"Name\"/>")
-        self.writel(S_ANIM, 4, "</accessor>")
-        self.writel(S_ANIM, 3, "</technique_common>")
-        self.writel(S_ANIM, 2, "</source>")
-
-        self.writel(S_ANIM, 2, "<sampler id=\"{}-sampler\">".format(anim_id))
-        self.writel(
-            S_ANIM, 3,
-            "<input semantic=\"INPUT\" source=\"#{}-input\"/>".format(anim_id))
-        self.writel(
-            S_ANIM, 3, "<input semantic=\"OUTPUT\" "
-            "source=\"#{}-transform-output\"/>".format(anim_id))
-        self.writel(
-            S_ANIM, 3, "<input semantic=\"INTERPOLATION\" "
-            "source=\"#{}-interpolation-output\"/>".format(anim_id))
-        self.writel(S_ANIM, 2, "</sampler>")
-        if (matrices):
-            self.writel(
-                S_ANIM, 2, "<channel source=\"#{}-sampler\" "
-                "target=\"{}/transform\"/>".format(anim_id, target))
+            values = [[list(r) for r in k[1]] for k in keys]
         else:
-            self.writel(
-                S_ANIM, 2, "<channel source=\"#{}-sampler\" "
-                "target=\"{}\"/>".format(anim_id, target))
-        self.writel(S_ANIM, 1, "</animation>")
+            values = [k[1] for k in keys]
+        self.write_block(S_ANIM, AnimationBlock(
+            anim_id, target, [k[0] for k in keys], values, matrices))
 
         return [anim_id]
 
@@ -1691,104 +1802,108 @@ class DaeExporter:
         xform_cache = {}
         blend_cache = {}
 
-        # Change frames first, export objects last, boosts performance
-        for t in range(start, end + 1):
-            self.scene.frame_set(t)
-            key = t * frame_len - frame_sub
-
-            for node in self.objects:
-                if (node not in self.valid_nodes):
-                    continue
-                if (allowed is not None and not (node in allowed)):
-                    if (node.type == "MESH" and node.data is not None and
-                        (node in self.armature_for_morph) and (
-                            self.armature_for_morph[node] in allowed)):
-                        pass
+        frames = self.sample_frames(start, end)
+        plan = self.animation_plan(allowed)
+
+        pose_cache = {}
+        morph_cache = {}
+        use_frame_set = True
+        if (self.config["use_anim_fcurve_eval"]):
+            pose_cache, morph_cache, use_frame_set = (
+                self.evaluate_fcurve_poses(frames, plan))
+
+        frame_count = len(frames)
+        frame_keys = [t * frame_len - frame_sub for t in frames]
+        for name, node, key_block in plan["morphs"]:
+            blend_cache[name] = []
+        for node, name in plan["objects"]:
+            xform_cache[name] = []
+        pose_buffers = {}
+        for node in plan["armatures"]:
+            count = len(self.skeleton_sampling_plan(node)["posebones"])
+            pose_buffers[node] = (np.empty((frame_count, count, 4, 4)),
+                                  np.empty((frame_count, count, 3)))
+
+        workers = min(self.config["anim_bake_workers"], frame_count)
+        if (use_frame_set and workers > 1):
+            baked = self.bake_parallel(plan, frames, pose_buffers, workers)
+            if (baked is not None):
+                morph_values, object_matrices = baked
+                for i, morph in enumerate(plan["morphs"]):
+                    blend_cache[morph[0]] = list(zip(
+                        frame_keys, morph_values[:, i].tolist()))
+                for i, obj in enumerate(plan["objects"]):
+                    xform_cache[obj[1]] = list(zip(
+                        frame_keys, object_matrices[:, i]))
+                # Every sample came from the workers, skip the frame loop
+                use_frame_set = False
+                frames = []
+
+        sample_scene = self.scene
+        try:
+            if (use_frame_set and self.config["use_anim_isolated_scene"]):
+                sample_scene = self.create_sampling_scene(plan["nodes"])
+
+            # Change frames first, export objects last, boosts performance
+            for fi, t in enumerate(frames):
+                if (use_frame_set):
+                    frame = int(math.floor(t))
+                    sample_scene.frame_set(frame, t - frame)
+                key = frame_keys[fi]
+
+                for name, node, key_block in plan["morphs"]:
+                    if (name in morph_cache):
+                        value = morph_cache[name][fi]
                     else:
-                        continue
-                if (node.type == "MESH" and node.data is not None and
-                    node.data.shape_keys is not None and (
-                        node.data in self.mesh_cache) and len(
-                            node.data.shape_keys.key_blocks)):
-                    target = self.mesh_cache[node.data]["morph_id"]
-                    for i in range(len(node.data.shape_keys.key_blocks)):
-
-                        if (i == 0):
-                            continue
-
-                        name = "{}-morph-weights({})".format(target, i - 1)
-                        if (not (name in blend_cache)):
-                            blend_cache[name] = []
-
-                        blend_cache[name].append(
-                            (key, node.data.shape_keys.key_blocks[i].value))
-
-                if (node.type == "MESH" and node.parent and
-                        node.parent.type == "ARMATURE"):
-                    # In Collada, nodes that have skin modifier must not export
-                    # animation, animate the skin instead
-                    continue
-
-                if (len(node.constraints) > 0 or
-                        node.animation_data is not None and node.type != "ARMATURE"):
-                    # If the node has constraints, or animation data, then
-                    # export a sampled animation track
-                    name = self.validate_id(node.name)
-                    if (not (name in xform_cache)):
-                        xform_cache[name] = []
+                        value = key_block.value
+                    blend_cache[name].append((key, value))
 
+                for node, name in plan["objects"]:
                     mtx = node.matrix_world.copy()
-                    if (node.parent):
+                    if (node.parent in self.valid_nodes):
                         mtx = node.parent.matrix_world.inverted_safe() * mtx
-
                     xform_cache[name].append((key, mtx))
 
-                if (node.type == "ARMATURE"):
-                    # All bones exported for now
-                    for bone in node.data.bones:
-                        if((bone.name.startswith("ctrl") or
-                            bone.use_deform == False) and
-                                self.config["use_exclude_ctrl_bones"]):
-                            continue
-
-                        bone_name = self.skeleton_info[node]["bone_ids"][bone]
-
-                        if (not (bone_name in xform_cache)):
-                            xform_cache[bone_name] = []
-
-                        posebone = node.pose.bones[bone.name]
-                        parent_posebone = None
-
-                        mtx = posebone.matrix.copy()
-                        if (bone.parent):
-                            if (self.config["use_exclude_ctrl_bones"]):
-                                current_parent_posebone = bone.parent
-                                while ((current_parent_posebone.name
-                                        .startswith("ctrl") or
-                                        current_parent_posebone.use_deform
-                                        == False) and
-                                        current_parent_posebone.parent):
-                                    current_parent_posebone = (
-                                        current_parent_posebone.parent)
-                                parent_posebone = node.pose.bones[
-                                    current_parent_posebone.name]
-                            else:
-                                parent_posebone = node.pose.bones[
-                                    bone.parent.name]
-                            parent_invisible = False
-
-                            for i in range(3):
-                                if (parent_posebone.scale[i] == 0.0):
-                                    parent_invisible = True
-
-                            if (not parent_invisible):
-                                mtx = (
-                                    parent_posebone.matrix
-                                    .inverted_safe() * mtx)
-
-                        xform_cache[bone_name].append((key, mtx))
-
-        self.scene.frame_set(frame_orig)
+                for node in plan["armatures"]:
+                    # Only sample here, local matrices are computed in bulk
+                    pose, scales = pose_buffers[node]
+                    for i, posebone in enumerate(
+                            self.sampling_plans[node]["posebones"]):
+                        pose[fi, i], scales[fi, i] = self.pose_sample(
+                            node, posebone, fi, pose_cache)
+        finally:
+            if (sample_scene != self.scene):
+                bpy.data.scenes.remove(sample_scene, do_unlink=True)
+            if (use_frame_set):
+                self.scene.frame_set(frame_orig)
+
+        for node in pose_buffers:
+            pose, scales = pose_buffers[node]
+            bones = self.sampling_plans[node]["bones"]
+            local = anim_ops.local_bone_matrices(
+                pose, scales, [b[1] for b in bones], [b[2] for b in bones])
+            corrections = self.bone_track_corrections(node)
+            data_matrix = self.data_matrix(node)
+            flip = self.flip_matrix(node)
+            for i, bone in enumerate(bones):
+                track = local[:, i]
+                if (corrections is not None):
+                    track = np.matmul(corrections[i], track)
+                if (data_matrix is not None and bone[2] == -1):
+                    # Root bones are in the space of the baked armature data
+                    track = np.matmul(np.array(data_matrix), track)
+                elif (flip is not None):
+                    track = np.matmul(np.array(flip), track)
+                xform_cache[bone[0]] = list(zip(frame_keys, track))
+
+        if (self.up_matrix is not None):
+            self.convert_object_tracks(plan, xform_cache)
+
+        if (self.config["use_anim_optimize"]):
+            # Decomposed channels are reduced once, per component, when
+            # they are written
+            self.optimize_animation(
+                {} if self.use_trs_channels() else xform_cache, blend_cache)
 
         # Export animation XML
         for nid in xform_cache:
@@ -1803,20 +1918,500 @@ class DaeExporter:
 
         return tcn
 
+    def sample_frames(self, start, end):
+        """Frames to sample from start to end, both included.
+
+        anim_target_fps resamples to that rate, otherwise every
+        anim_frame_step-th frame is used. Frames may be fractional.
+        """
+        step = self.config["anim_frame_step"]
+        if (self.config["anim_target_fps"] > 0):
+            step = self.scene.render.fps / self.config["anim_target_fps"]
+
+        frames = []
+        i = 0
+        t = start
+        while (t < end - 1e-6):
+            frames.append(t)
+            i += 1
+            t = start + i * step
+        frames.append(end)
+        return frames
+
+    def animation_range(self):
+        """The frame range to sample, from the scene or the actions."""
+        if (self.config["anim_use_action_range"]):
+            ranges = [s.animation_data.action.frame_range
+                      for s in self.skeletons
+                      if s.animation_data is not None and
+                      s.animation_data.action is not None]
+            if (len(ranges) > 0):
+                return (int(math.floor(min(r[0] for r in ranges))),
+                        int(math.ceil(max(r[1] for r in ranges))))
+        return self.scene.frame_start, self.scene.frame_end
+
+    def bake_parallel(self, plan, frames, pose_buffers, workers):
+        """Sample the animation plan in background Blender processes.
+
+        The file is saved to a temporary snapshot and every worker samples
+        a contiguous slice of frames. Bone samples are written into
+        pose_buffers, morph weights and object matrices are returned per
+        frame. Returns None if any worker failed.
+        """
+        tmpdir = tempfile.mkdtemp(prefix="dos2de_bake_")
+        jobs = []
+        try:
+            blend_path = os.path.join(tmpdir, "snapshot.blend")
+            bpy.ops.wm.save_as_mainfile(filepath=blend_path, copy=True,
+                                        check_existing=False)
+
+            armatures = plan["armatures"]
+            args = [bpy.app.binary_path, "--background", "--factory-startup"]
+            if (bpy.context.user_preferences.system.use_scripts_auto_execute):
+                # Drivers only evaluate like they do here with autoexec on
+                args.append("--enable-autoexec")
+            args += [blend_path, "--python", os.path.join(
+                os.path.dirname(__file__), "anim_bake_worker.py"), "--"]
+
+            for n, indices in enumerate(np.array_split(
+                    np.arange(len(frames)), workers)):
+                job = {
+                    "scene": self.scene.name,
+                    "frames": [frames[i] for i in indices.tolist()],
+                    "armatures": [
+                        [node.name, [p.name for p in
+                                     self.sampling_plans[node]["posebones"]]]
+                        for node in armatures],
+                    "morphs": [[node.name, key_block.name]
+                               for name, node, key_block in plan["morphs"]],
+                    "objects": [
+                        [node.name, node.parent.name
+                         if node.parent in self.valid_nodes else None]
+                        for node, name in plan["objects"]],
+                    "output": os.path.join(tmpdir, "bake{}.npz".format(n)),
+                }
+                job_path = os.path.join(tmpdir, "job{}.json".format(n))
+                with open(job_path, "w") as f:
+                    json.dump(job, f)
+                # A log file per worker, a pipe nobody reads yet could fill
+                # up and stall the worker
+                log_path = os.path.join(tmpdir, "job{}.log".format(n))
+                with open(log_path, "w") as log:
+                    process = subprocess.Popen(
+                        args + [job_path], stdout=subprocess.DEVNULL,
+                        stderr=log)
+                jobs.append((indices, job["output"], process, log_path))
+
+            print("[DOS2DE-Exporter] Baking {} frames in {} processes.".format(
+                len(frames), len(jobs)))
+
+            failed = None
+            for indices, output, process, log_path in jobs:
+                process.wait()
+                if (failed is None and (process.returncode != 0 or
+                                         not os.path.isfile(output))):
+                    with open(log_path, errors="replace") as log:
+                        failed = log.read().strip().splitlines()[-1:]
+                    failed = failed or [
+                        "exit code {}".format(process.returncode)]
+            if (failed is not None):
+                self.operator.report(
+                    {"WARNING"}, "Parallel bake failed ({}), sampling in this "
+                    "process instead.".format(failed[0]))
+                return None
+
+            morph_values = np.empty((len(frames), len(plan["morphs"])))
+            object_matrices = np.empty((len(frames), len(plan["objects"]), 4, 4))
+            for indices, output, process, log_path in jobs:
+                with np.load(output) as baked:
+                    morph_values[indices] = baked["morphs"]
+                    object_matrices[indices] = baked["objects"]
+                    for a, node in enumerate(armatures):
+                        pose, scales = pose_buffers[node]
+                        pose[indices] = baked["pose{}".format(a)]
+                        scales[indices] = baked["scale{}".format(a)]
+            return morph_values, object_matrices
+        finally:
+            for job in jobs:
+                if (job[2].poll() is None):
+                    job[2].kill()
+                    job[2].wait()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def sampling_dependencies(self, nodes):
+        """Objects that must be evaluated to sample nodes: the nodes, their
+        parents, constraint and driver targets and armature deformers."""
+        found = set()
+        pending = list(nodes)
+        while (pending):
+            node = pending.pop()
+            if (node is None or node in found):
+                continue
+            found.add(node)
+            pending.append(node.parent)
+
+            constraints = list(node.constraints)
+            if (node.type == "ARMATURE" and node.pose is not None):
+                for posebone in node.pose.bones:
+                    constraints += list(posebone.constraints)
+            for c in constraints:
+                pending.append(getattr(c, "target", None))
+                pending.append(getattr(c, "pole_target", None))
+
+            for mod in node.modifiers:
+                if (mod.type == "ARMATURE"):
+                    pending.append(mod.object)
+
+            anim_data = [node.animation_data]
+            if (node.type == "MESH" and node.data is not None and
+                    node.data.shape_keys is not None):
+                anim_data.append(node.data.shape_keys.animation_data)
+            for ad in anim_data:
+                if (ad is None):
+                    continue
+                for fcurve in ad.drivers:
+                    for var in fcurve.driver.variables:
+                        for t in var.targets:
+                            if (isinstance(t.id, bpy.types.Object)):
+                                pending.append(t.id)
+        return found
+
+    def create_sampling_scene(self, nodes):
+        """Link only what the animated nodes depend on into a temporary
+        scene, so frame_set skips everything else in the file."""
+        scene = bpy.data.scenes.new("DOS2DE_Export_Sampling")
+        try:
+            scene.render.fps = self.scene.render.fps
+            scene.render.fps_base = self.scene.render.fps_base
+            scene.frame_start = self.scene.frame_start
+            scene.frame_end = self.scene.frame_end
+            objects = self.sampling_dependencies(nodes)
+            for obj in objects:
+                scene.objects.link(obj)
+        except:
+            bpy.data.scenes.remove(scene, do_unlink=True)
+            raise
+        print("[DOS2DE-Exporter] Sampling {} of {} objects in an isolated "
+              "scene.".format(len(objects), len(self.scene.objects)))
+        return scene
+
+    def is_animation_node(self, node, allowed):
+        if (node not in self.valid_nodes):
+            return False
+        if (allowed is not None and not (node in allowed)):
+            if (node.type == "MESH" and node.data is not None and
+                (node in self.armature_for_morph) and (
+                    self.armature_for_morph[node] in allowed)):
+                return True
+            return False
+        return True
+
+    def animation_plan(self, allowed):
+        """Resolve once which nodes contribute tracks to an animation.
+
+        "nodes" holds every animated node, "morphs" (target id, node,
+        key block) for morph weights, "objects" (node, target id) for
+        sampled object transforms and "armatures" the skeletons to sample
+        bone poses from.
+        """
+        plan = {"nodes": [], "morphs": [], "objects": [], "armatures": []}
+        for node in self.objects:
+            if (not self.is_animation_node(node, allowed)):
+                continue
+            plan["nodes"].append(node)
+
+            if (node.type == "MESH" and node.data is not None and
+                    node.data.shape_keys is not None and
+                    node.data in self.mesh_cache):
+                target = self.mesh_cache[node.data]["morph_id"]
+                key_blocks = node.data.shape_keys.key_blocks
+                for i in range(1, len(key_blocks)):
+                    plan["morphs"].append((
+                        "{}-morph-weights({})".format(target, i - 1),
+                        node, key_blocks[i]))
+
+            if (node.type == "MESH" and node.parent and
+                    node.parent.type == "ARMATURE" and
+                    not self.is_unparented(node)):
+                # In Collada, nodes that have skin modifier must not export
+                # animation, animate the skin instead
+                continue
+
+            if (len(node.constraints) > 0 or
+                    node.animation_data is not None and node.type != "ARMATURE"):
+                # If the node has constraints, or animation data, then
+                # export a sampled animation track
+                plan["objects"].append((node, self.validate_id(node.name)))
+
+            if (node.type == "ARMATURE"):
+                plan["armatures"].append(node)
+        return plan
+
+    def evaluate_fcurve_poses(self, frames, plan):
+        """Evaluate action-only bones and shape keys from their F-curves.
+
+        Returns the evaluated poses per armature, the evaluated morph
+        weights by target id and whether frame_set is still needed for
+        bones, morphs or objects that need the depsgraph.
+        """
+        pose_cache = {}
+        morph_cache = {}
+        use_frame_set = len(plan["objects"]) > 0
+        for name, node, key_block in plan["morphs"]:
+            values = anim_eval.shape_key_values(key_block, frames)
+            if (values is None):
+                use_frame_set = True
+            else:
+                morph_cache[name] = values
+        for node in plan["armatures"]:
+            evaluator = anim_eval.FCurvePoseEvaluator(node)
+            pose_cache[node] = evaluator.evaluate(frames)
+            print("[DOS2DE-Exporter] Evaluating {} of {} bones in '{}' "
+                  "from F-curves.".format(len(evaluator.pure),
+                                          len(node.data.bones), node.name))
+            if (len(evaluator.pure) < len(node.data.bones)):
+                use_frame_set = True
+        return pose_cache, morph_cache, use_frame_set
+
+    def pose_sample(self, node, posebone, fi, pose_cache):
+        """Return the armature space matrix and scale of a pose bone."""
+        evaluated = pose_cache.get(node)
+        if (evaluated is not None and posebone.name in evaluated):
+            matrices, scales = evaluated[posebone.name]
+            return matrices[fi], scales[fi]
+        return posebone.matrix, posebone.scale
+
+    def skeleton_sampling_plan(self, node):
+        """Animated bones of an armature, resolved once per export.
+
+        "posebones" holds every pose bone read per frame. "bones" holds
+        (bone id, pose index, parent pose index or -1) for each exported
+        bone, with control bones skipped when finding the parent. With
+        use_anim_relevant_bones only relevant bones are sampled.
+        """
+        plan = self.sampling_plans.get(node)
+        if plan is not None:
+            return plan
+
+        exclude_ctrl = self.config["use_exclude_ctrl_bones"]
+
+        def is_ctrl(bone):
+            return exclude_ctrl and (bone.name.startswith("ctrl") or
+                                     bone.use_deform == False)
+
+        posebones = []
+        pose_index = {}
+
+        def index_of(bone):
+            if (bone.name not in pose_index):
+                pose_index[bone.name] = len(posebones)
+                posebones.append(node.pose.bones[bone.name])
+            return pose_index[bone.name]
+
+        relevant = None
+        if (self.config["use_anim_relevant_bones"]):
+            relevant = self.relevant_bones(node)
+
+        bones = []
+        for bone in node.data.bones:
+            if (is_ctrl(bone)):
+                continue
+            if (relevant is not None and bone.name not in relevant):
+                continue
+            parent_index = -1
+            if (bone.parent):
+                parent = bone.parent
+                while (is_ctrl(parent) and parent.parent):
+                    parent = parent.parent
+                parent_index = index_of(parent)
+            bones.append((self.skeleton_info[node]["bone_ids"][bone],
+                          index_of(bone), parent_index))
+
+        plan = {"posebones": posebones, "bones": bones}
+        self.sampling_plans[node] = plan
+        return plan
+
+    def relevant_bones(self, node):
+        """Names of the bones whose animation affects the export.
+
+        A bone is relevant if it has weights in an exported mesh, has
+        objects parented to it, is in the keep-list, or is an ancestor of a
+        relevant bone. When no exported mesh is skinned to the armature,
+        as with the animation preset, its deform bones stand in for the
+        weighted ones.
+        """
+        si = self.skeleton_info[node]
+        if (si["weighted_bones"]):
+            names = set(name for name, index in si["bone_index"].items()
+                        if index in si["weighted_bones"])
+        else:
+            names = set(b.name for b in node.data.bones if b.use_deform)
+        names.update(n.strip() for n in
+                     self.config["anim_keep_bones"].split(",") if n.strip())
+        for obj in self.objects:
+            if (obj.parent == node and obj.parent_type == "BONE"):
+                names.add(obj.parent_bone)
+
+        relevant = anim_ops.relevant_bone_names(
+            dict((b.name, b.parent.name if b.parent else None)
+                 for b in node.data.bones), names)
+
+        print("[DOS2DE-Exporter] Animating {} of {} bones in '{}'.".format(
+            len(relevant), len(node.data.bones), node.name))
+        return relevant
+
+    def optimize_animation(self, xform_cache, blend_cache):
+        """Drop keys that linear interpolation reproduces, in place."""
+        tolerance = 10.0 ** -self.config["anim_optimize_precision"]
+        keys_before = 0
+        keys_after = 0
+        for cache, matrices in ((xform_cache, True), (blend_cache, False)):
+            for nid in cache:
+                keys = cache[nid]
+                if (matrices):
+                    values = [[c for r in k[1] for c in r] for k in keys]
+                else:
+                    values = [k[1] for k in keys]
+                keep = anim_ops.reduce_keys(
+                    [k[0] for k in keys], values, tolerance)
+                cache[nid] = [keys[i] for i in keep.tolist()]
+                keys_before += len(keys)
+                keys_after += len(keep)
+
+        actions = [s.animation_data.action.name for s in self.skeletons
+                   if s.animation_data is not None and
+                   s.animation_data.action is not None]
+        print("[DOS2DE-Exporter] Optimized keyframes for '{}': {} -> {} "
+              "keys.".format(", ".join(actions) or self.scene.name,
+                             keys_before, keys_after))
+
     def export_animations(self):
-        tmp_mat = []
+        # Channels the action doesn't key are sampled from the rest pose
+        identity = Matrix()
+        poses = []
         for s in self.skeletons:
-            tmp_bone_mat = []
             for bone in s.pose.bones:
-                tmp_bone_mat.append(Matrix(bone.matrix_basis))
-                bone.matrix_basis = Matrix()
-            tmp_mat.append([Matrix(s.matrix_local), tmp_bone_mat])
+                if (bone.matrix_basis != identity):
+                    poses.append((bone, bone.matrix_basis.copy()))
+                    bone.matrix_basis = identity
 
         self.writel(S_ANIM, 0, "<library_animations>")
-        self.export_animation(self.scene.frame_start, self.scene.frame_end)
+        if (self.config["use_anim_clips"] and len(self.skeletons) > 0):
+            clips = []
+            for armature in self.skeletons:
+                clips += self.export_animation_clips(armature)
+            if (len(clips) > 0):
+                self.writel(S_ANIM_CLIPS, 0, "<library_animation_clips>")
+                for clip in clips:
+                    self.write_block(S_ANIM_CLIPS, clip)
+                self.writel(S_ANIM_CLIPS, 0, "</library_animation_clips>")
+        else:
+            start, end = self.animation_range()
+            self.export_animation(start, end)
         self.writel(S_ANIM, 0, "</library_animations>")
 
-    def export(self):
+        for bone, matrix_basis in poses:
+            bone.matrix_basis = matrix_basis
+
+    def armature_actions(self, armature):
+        """Actions that key at least one bone of the armature."""
+        names = set(b.name for b in armature.data.bones)
+        actions = []
+        for action in bpy.data.actions:
+            for fc in action.fcurves:
+                match = anim_eval.BONE_PATH.match(fc.data_path)
+                if (match and match.group(1) in names):
+                    actions.append(action)
+                    break
+        return actions
+
+    def export_animation_clips(self, armature):
+        """Sample every clip of an armature in one pass.
+
+        Existing NLA strips are used as the clips. Without any, the
+        armature's actions are laid out one after another on a temporary
+        NLA track. The active action is cleared while sampling so it isn't
+        layered over the strips. Returns one AnimationClipBlock per clip.
+        """
+        created = armature.animation_data is None
+        if (created):
+            armature.animation_data_create()
+        animation_data = armature.animation_data
+
+        clips = []
+        for track in animation_data.nla_tracks:
+            if (track.mute):
+                continue
+            for strip in track.strips:
+                if (not strip.mute):
+                    clips.append((strip.name, int(math.floor(strip.frame_start)),
+                                  int(math.ceil(strip.frame_end))))
+
+        temp_track = None
+        active_action = animation_data.action
+        if (len(clips) == 0):
+            temp_track = animation_data.nla_tracks.new()
+            temp_track.name = "DOS2DE_Export_Clips"
+            frame = self.scene.frame_start
+            for action in self.armature_actions(armature):
+                length = int(math.ceil(
+                    action.frame_range[1] - action.frame_range[0]))
+                strip = temp_track.strips.new(action.name, frame, action)
+                strip.extrapolation = "NOTHING"
+                clips.append((action.name, frame, frame + length))
+                # Leave a frame between clips so they never blend
+                frame += length + 2
+
+        blocks = []
+        if (len(clips) == 0):
+            self.operator.report(
+                {"WARNING"}, "No actions or NLA strips to export as clips "
+                "for \"{}\".".format(armature.name))
+        else:
+            animation_data.action = None
+            try:
+                start = min(c[1] for c in clips)
+                end = max(c[2] for c in clips)
+                print("[DOS2DE-Exporter] Sampling {} clips of '{}' over "
+                      "frames {}-{}.".format(len(clips), armature.name,
+                                             start, end))
+                anim_ids = self.export_animation(start, end, [armature])
+            finally:
+                animation_data.action = active_action
+                if (temp_track is not None):
+                    animation_data.nla_tracks.remove(temp_track)
+                    temp_track = None
+
+            frame_len = 1.0 / self.scene.render.fps
+            frame_sub = start * frame_len if start > 0 else 0
+            for name, clip_start, clip_end in clips:
+                blocks.append(AnimationClipBlock(
+                    self.new_id("clip"), self.escape(name),
+                    clip_start * frame_len - frame_sub,
+                    clip_end * frame_len - frame_sub, anim_ids))
+
+        if (temp_track is not None):
+            animation_data.nla_tracks.remove(temp_track)
+        if (created):
+            armature.animation_data_clear()
+        return blocks
+
+    def is_animation_only(self):
+        objtypes = self.config["object_types"]
+        return (self.config["use_anim"] and len(objtypes) == 1 and
+                "ARMATURE" in objtypes)
+
+    def export_static(self):
+        """Write every section except library_animations."""
+        if (self.is_animation_only()):
+            # Only the skeleton is needed, skip the geometry, controller and
+            # material libraries entirely
+            print("[DOS2DE-Exporter] Exporting skeleton and animations only.")
+            self.export_asset()
+            self.export_scene()
+            self.purge_empty_nodes()
+            return
+
         self.writel(S_GEOM, 0, "<library_geometries>")
         self.writel(S_CONT, 0, "<library_controllers>")
         if self.can_export_type("MATERIAL"):
@@ -1831,13 +2426,11 @@ class DaeExporter:
 
         # Morphs always go before skin controllers
         if S_MORPH in self.sections:
-            for l in self.sections[S_MORPH]:
-                self.writel(S_CONT, 0, l)
+            self.sections[S_CONT].extend(self.sections[S_MORPH])
             del self.sections[S_MORPH]
 
         if S_SKIN in self.sections:
-            for l in self.sections[S_SKIN]:
-                self.writel(S_CONT, 0, l)
+            self.sections[S_CONT].extend(self.sections[S_SKIN])
             del self.sections[S_SKIN]
 
         self.writel(S_CONT, 0, "</library_controllers>")
@@ -1849,58 +2442,92 @@ class DaeExporter:
 
         self.purge_empty_nodes()
 
+    def write_files(self, path):
+        if not self.write(path):
+            return False
+
+        self.finish_image_staging()
+
+        if (self.config["use_export_cache"]):
+            cache_path = os.path.splitext(path)[0] + ".npz"
+            print("[DOS2DE-Exporter] Saving export cache '{}'.".format(
+                cache_path))
+            self.save_cache(cache_path)
+        return True
+
+    def export(self):
+        self.export_static()
+
         if (self.config["use_anim"]):
             self.export_animations()
 
-        try:
-            f = open(self.path, "wb")
-        except:
-            return False
+        return self.write_files(self.path)
 
-        f.write(bytes("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n", "UTF-8"))
-        f.write(bytes(
-            "<COLLADA xmlns=\"http://www.collada.org/2005/11/COLLADASchema\" "
-            "version=\"1.4.1\">\n", "UTF-8"))
-
-        s = []
-        for x in self.sections.keys():
-            s.append(x)
-        s.sort()
-        for x in s:
-            for l in self.sections[x]:
-                f.write(bytes(l + "\n", "UTF-8"))
-
-        f.write(bytes("<scene>\n", "UTF-8"))
-        f.write(bytes(
-            "\t<instance_visual_scene url=\"#{}\" />\n".format(
-                self.scene_name), "UTF-8"))
-        f.write(bytes("</scene>\n", "UTF-8"))
-        f.write(bytes("</COLLADA>\n", "UTF-8"))
-        return True
+    def export_actions(self, armature, exports):
+        """Export one file per (action, path) pair.
+
+        The scene, skeleton and material sections are prepared once and only
+        library_animations is sampled and written again for each action.
+        Returns a list with the result of each export.
+        """
+        self.export_static()
+        static_sections = dict(
+            (k, list(v)) for k, v in self.sections.items())
+        static_last_id = self.last_id
 
-    __slots__ = ("operator", "scene", "objects", "active_object", "last_id", "scene_name", "sections",
+        results = []
+        active_action = armature.animation_data.action
+        try:
+            for action, path in exports:
+                print("[DOS2DE-Exporter] Setting action to '{}' and exporting "
+                      "as '{}'.".format(action.name, path))
+                self.sections = dict(
+                    (k, list(v)) for k, v in static_sections.items())
+                # Same ids as a separate export of this action
+                self.last_id = static_last_id
+                self.path = path
+                armature.animation_data.action = action
+                self.export_animations()
+                results.append(self.write_files(path))
+        finally:
+            armature.animation_data.action = active_action
+        return results
+
+    __slots__ = ("operator", "scene", "objects", "active_object",
                  "path", "mesh_cache", "curve_cache", "material_cache",
-                 "image_cache", "skeleton_info", "config", "valid_nodes",
+                 "material_fingerprints",
+                 "image_cache", "image_source_cache", "image_stager",
+                 "skeleton_info", "sampling_plans", "valid_nodes",
+                 "node_rest_trs", "up_matrix", "export_worlds",
+                 "up_corrections",
                  "armature_for_morph", "used_bones", "wrongvtx_report",
                  "skeletons", "action_constraints", "temp_meshes")
 
     def __init__(self, path, kwargs, operator, objects):
+        DaeWriter.__init__(self, kwargs)
         self.operator = operator
         self.scene = bpy.context.scene
         self.objects = objects
         self.active_object = self.scene.objects.active
-        self.last_id = 0
         self.scene_name = self.new_id("scene")
-        self.sections = {}
         self.path = path
         self.mesh_cache = {}
         self.temp_meshes = set()
         self.curve_cache = {}
         self.material_cache = {}
+        self.material_fingerprints = {}
         self.image_cache = {}
+        self.image_source_cache = {}
+        self.image_stager = None
         self.skeleton_info = {}
-        self.config = kwargs
-        self.valid_nodes = []
+        self.sampling_plans = {}
+        self.valid_nodes = set()
+        self.node_rest_trs = {}
+        self.up_matrix = None
+        if (self.config["yup_enabled"] == "ROTATE"):
+            self.up_matrix = Matrix.Rotation(math.radians(-90.0), 4, "X")
+        self.export_worlds = {}
+        self.up_corrections = {}
         self.armature_for_morph = {}
         self.used_bones = []
         self.wrongvtx_report = False
@@ -1911,10 +2538,135 @@ class DaeExporter:
         return self
 
     def __exit__(self, *exc):
+        self.finish_image_staging()
         for mesh in self.temp_meshes:
             bpy.data.meshes.remove(mesh)
 
 
+def plain_value(value):
+    """A comparable copy of an RNA value, IDs by name."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, bpy.types.ID):
+        return value.name
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    try:
+        return tuple(plain_value(v) for v in value)
+    except TypeError:
+        return None
+
+
+def rna_values(struct, nested=True):
+    """Every setting of an RNA struct, with collection items one level deep."""
+    values = []
+    for prop in struct.bl_rna.properties:
+        key = prop.identifier
+        if (key == "rna_type"):
+            continue
+        value = getattr(struct, key, None)
+        if (prop.type == "COLLECTION"):
+            if (not nested):
+                continue
+            value = tuple(rna_values(item, False) for item in value)
+        elif (prop.type == "POINTER" and
+                not isinstance(value, bpy.types.ID)):
+            continue
+        else:
+            value = plain_value(value)
+        values.append((key, value))
+    return values
+
+
+def is_driven(obj):
+    return ((obj.animation_data is not None and
+             len(obj.animation_data.drivers) > 0) or
+            (obj.data is not None and
+             getattr(obj.data, "animation_data", None) is not None and
+             len(obj.data.animation_data.drivers) > 0))
+
+
+def has_external_motion(armature, constraints):
+    """True if sampling can pick up motion the fingerprint can't see:
+    drivers, or constraint targets that are animated, driven or
+    constrained themselves, including through their parents."""
+    if (is_driven(armature)):
+        return True
+    for c in constraints:
+        for name in ("target", "pole_target"):
+            obj = getattr(c, name, None)
+            while (obj is not None and obj != armature):
+                if (obj.animation_data is not None or is_driven(obj) or
+                        len(obj.constraints) > 0):
+                    return True
+                obj = obj.parent
+    return False
+
+
+def action_fingerprint(scene, armature, action, options):
+    """Digest of everything an exported action file depends on.
+
+    Returns None when the result also depends on drivers or animated
+    constraint targets, such actions can't be cached.
+    """
+    constraints = list(armature.constraints)
+    for pb in armature.pose.bones:
+        constraints += list(pb.constraints)
+    if (has_external_motion(armature, constraints)):
+        return None
+
+    curves = []
+    for fc in action.fcurves:
+        curves.append((
+            fc.data_path, fc.array_index, fc.mute, fc.extrapolation,
+            [(tuple(k.co), tuple(k.handle_left), tuple(k.handle_right),
+              k.interpolation) for k in fc.keyframe_points],
+            [rna_values(m) for m in fc.modifiers]))
+
+    rig = []
+    for b in armature.data.bones:
+        rig.append((
+            b.name, b.parent.name if b.parent else "", b.use_deform,
+            b.use_connect, b.use_inherit_rotation, b.use_inherit_scale,
+            b.use_local_location, [tuple(r) for r in b.matrix_local]))
+
+    constraint_settings = []
+    for c in armature.constraints:
+        constraint_settings.append(("", rna_values(c)))
+    for pb in armature.pose.bones:
+        for c in pb.constraints:
+            constraint_settings.append((pb.name, rna_values(c)))
+
+    # With the armature modifier excluded the current pose is exported as
+    # the rest pose, by applying it on copies or reading it directly
+    applied_pose = []
+    if (options.get("use_exclude_armature_modifier")):
+        for pb in armature.pose.bones:
+            applied_pose.append((pb.name, [tuple(r) for r in pb.matrix]))
+
+    return anim_cache.fingerprint((
+        tuple(action.frame_range), curves, rig, constraint_settings,
+        applied_pose, [tuple(r) for r in armature.matrix_world],
+        (scene.frame_start, scene.frame_end, scene.render.fps),
+        anim_cache.plain_options(options)))
+
+
+def save_actions(operator, context, armature, exports, **kwargs):
+    """Export each (action, filepath) in exports from a single session.
+
+    Animation data created here to hold the actions is removed again.
+    """
+    created = armature.animation_data is None
+    if created:
+        armature.animation_data_create()
+    try:
+        with DaeExporter(exports[0][1], kwargs, operator, [armature]) as exp:
+            return exp.export_actions(armature, exports)
+    finally:
+        if created:
+            armature.animation_data_clear()
+
+
 def save(operator, context, objects, filepath="", **kwargs):
     with DaeExporter(filepath, kwargs, operator, objects) as exp:
         exp.export()
@@ -0,0 +1,279 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+
+"""
+Array operations on GeometryBlocks.
+
+These work on the extracted vertex buffers only, so meshes can be moved,
+split and merged at export time without touching any Blender datablocks.
+"""
+
+import numpy as np
+
+from .dae_writer import GeometryBlock
+
+VERTEX_ATTRIBUTES = ("positions", "normals", "tangents", "binormals",
+                     "bitangents", "uvs", "colors")
+
+# Attributes that must be present on every merged part to be kept at all.
+TANGENT_ATTRIBUTES = ("tangents", "binormals", "bitangents")
+
+# Matrices with a smaller determinant flatten at least one axis
+SINGULAR_EPSILON = 1e-12
+
+
+def normalize_rows(values):
+    lengths = np.sqrt((values * values).sum(axis=1))
+    lengths[lengths == 0.0] = 1.0
+    return values / lengths[:, None]
+
+
+def flip_winding(counts, indices):
+    """Reverse the vertex order of every polygon in a flat index buffer."""
+    counts = np.asarray(counts, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    poly = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(len(indices)) - starts[poly]
+    return indices[starts[poly] + counts[poly] - 1 - local]
+
+
+def normal_matrix(linear):
+    """Matrix that transforms normals along with a 3x3 linear map.
+
+    This is the cofactor matrix, the inverse transpose up to scale, with
+    the sign kept for mirrors. Unlike the inverse it exists for maps that
+    flatten an axis, turning normals towards the flattened axis.
+    """
+    c0, c1, c2 = linear.T
+    cofactor = np.stack((np.cross(c1, c2), np.cross(c2, c0),
+                         np.cross(c0, c1)), axis=1)
+    if np.linalg.det(linear) < -SINGULAR_EPSILON:
+        cofactor = -cofactor
+    return cofactor
+
+
+def transform_geometry(geometry, matrix):
+    """Move a geometry's vertices by a 4x4 matrix, in place.
+
+    Normals use normal_matrix, and polygon winding is reversed when the
+    matrix mirrors so faces keep pointing outwards.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64).reshape(4, 4)
+    linear = matrix[:3, :3]
+    geometry.positions = geometry.positions.dot(linear.T) + matrix[:3, 3]
+    normals = normal_matrix(linear)
+    geometry.normals = normalize_rows(geometry.normals.dot(normals.T))
+    for name in TANGENT_ATTRIBUTES:
+        values = getattr(geometry, name)
+        if values is not None:
+            setattr(geometry, name, normalize_rows(values.dot(linear.T)))
+
+    if np.linalg.det(linear) < 0.0:
+        geometry.surfaces = [
+            (symbol, counts, flip_winding(counts, indices))
+            for symbol, counts, indices in geometry.surfaces]
+    return geometry
+
+
+def subset_geometry(geometry, geometry_id, name, surfaces):
+    """Build a new geometry holding only the vertices the surfaces use.
+
+    surfaces is a list of (symbol, counts, indices) indexing the source
+    geometry; the indices are remapped to the compacted vertex arrays.
+    """
+    all_indices = [np.asarray(s[2], dtype=np.int64) for s in surfaces]
+    if all_indices:
+        used, remap = np.unique(np.concatenate(all_indices),
+                                return_inverse=True)
+    else:
+        used = remap = np.zeros(0, dtype=np.int64)
+
+    new_surfaces = []
+    start = 0
+    for (symbol, counts, indices), flat in zip(surfaces, all_indices):
+        new_surfaces.append((symbol, counts, remap[start:start + len(flat)]))
+        start += len(flat)
+
+    values = {}
+    for attr in VERTEX_ATTRIBUTES:
+        array = getattr(geometry, attr)
+        values[attr] = array[used] if array is not None else None
+    return GeometryBlock(geometry_id, name, surfaces=new_surfaces,
+                         model_type=geometry.model_type, **values)
+
+
+def split_surfaces(geometry):
+    """Return one compacted single-surface geometry per surface."""
+    return [
+        subset_geometry(geometry, geometry.geometry_id, geometry.name,
+                        [surface])
+        for surface in geometry.surfaces]
+
+
+def merge_geometries(geometry_id, name, geometries, symbol=None,
+                     model_type=""):
+    """Concatenate geometries into one geometry with a single surface.
+
+    Optional attributes missing on some parts are zero filled, except the
+    tangent frame, which is dropped unless every part has one.
+    """
+    values = {}
+    for attr in VERTEX_ATTRIBUTES:
+        present = [getattr(g, attr) is not None for g in geometries]
+        if not any(present):
+            values[attr] = None
+            continue
+        if attr in TANGENT_ATTRIBUTES and not all(present):
+            values[attr] = None
+            continue
+        width = next(getattr(g, attr).shape[1] for g in geometries
+                     if getattr(g, attr) is not None)
+        parts = []
+        for g in geometries:
+            array = getattr(g, attr)
+            if array is None:
+                array = np.zeros((len(g.positions), width))
+            parts.append(array)
+        values[attr] = np.concatenate(parts)
+
+    if any(values[attr] is None for attr in TANGENT_ATTRIBUTES):
+        for attr in TANGENT_ATTRIBUTES:
+            values[attr] = None
+
+    counts = []
+    indices = []
+    offset = 0
+    for g in geometries:
+        for s, c, i in g.surfaces:
+            counts.append(c)
+            indices.append(i + offset)
+        offset += len(g.positions)
+
+    surfaces = [(
+        symbol,
+        np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64),
+        np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64))]
+    return GeometryBlock(geometry_id, name, surfaces=surfaces,
+                         model_type=model_type, **values)
+
+
+def polygon_centroids(geometry, counts, indices):
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sums = np.add.reduceat(geometry.positions[indices], starts, axis=0)
+    return sums / counts[:, None]
+
+
+def unique_rows(keys):
+    """Sorted unique rows of a 2D array and the index of each row in them.
+
+    Same as np.unique(keys, axis=0, return_inverse=True), which older NumPy
+    builds don't have.
+    """
+    order = np.lexsort(keys.T[::-1])
+    ordered = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = np.any(ordered[1:] != ordered[:-1], axis=1)
+    inverse = np.empty(len(keys), dtype=np.int64)
+    inverse[order] = np.cumsum(first) - 1
+    return ordered[first], inverse
+
+
+def partition_geometry(geometry, cell_size):
+    """Split a geometry's polygons into grid cells by polygon centroid.
+
+    Returns a list of (cell, geometry) sorted by cell, where cell is the
+    integer (x, y, z) grid coordinate and geometry holds the compacted
+    polygons of every surface falling in it.
+    """
+    cells = {}
+    for symbol, counts, indices in geometry.surfaces:
+        if len(counts) == 0:
+            continue
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        keys = np.floor(polygon_centroids(geometry, counts, indices) /
+                        cell_size).astype(np.int64)
+        unique, inverse = unique_rows(keys)
+        for c, cell in enumerate(unique.tolist()):
+            polys = np.nonzero(inverse == c)[0]
+            poly_counts = counts[polys]
+            # Flat index positions of the selected polygons
+            offsets = (np.arange(poly_counts.sum()) -
+                       np.repeat(np.cumsum(poly_counts) - poly_counts,
+                                 poly_counts))
+            flat = np.repeat(starts[polys], poly_counts) + offsets
+            cells.setdefault(tuple(cell), []).append(
+                (symbol, poly_counts, indices[flat]))
+
+    chunks = []
+    for i, cell in enumerate(sorted(cells)):
+        chunks.append((cell, subset_geometry(
+            geometry, "{}_chunk{}".format(geometry.geometry_id, i),
+            "{}_chunk{}".format(geometry.name, i), cells[cell])))
+    return chunks
+
+
+def geometry_bounds(geometry):
+    """Return the (min, max) corners of a geometry's positions."""
+    if len(geometry.positions) == 0:
+        return np.zeros(3), np.zeros(3)
+    return geometry.positions.min(axis=0), geometry.positions.max(axis=0)
+
+
+def triangle_count(geometry):
+    return int(sum(np.maximum(counts - 2, 0).sum()
+                   for symbol, counts, indices in geometry.surfaces))
+
+
+def limit_weights(counts, bones, weights, limit=4, normalize=True):
+    """Keep the strongest skin influences of every vertex.
+
+    counts, bones and weights are the flat influence tables of a skin.
+    Each vertex keeps at most limit influences in their original order
+    (0 keeps all), and with normalize its weights are scaled to sum to
+    one. Returns the new counts, bones and weights.
+    """
+    counts = np.asarray(counts, dtype=np.int64).ravel()
+    bones = np.asarray(bones, dtype=np.int64).ravel()
+    weights = np.asarray(weights, dtype=np.float64).ravel()
+    count = len(counts)
+    vertex = np.repeat(np.arange(count), counts)
+
+    if limit > 0 and count and counts.max() > limit:
+        starts = np.cumsum(counts) - counts
+        slot = np.arange(len(weights)) - starts[vertex]
+        table = np.full((count, counts.max()), -1.0)
+        table[vertex, slot] = weights
+        # Stable, so equal weights keep the earlier influence
+        order = np.argsort(-table, axis=1, kind="mergesort")
+        rank = np.empty_like(order)
+        rank[np.arange(count)[:, None], order] = np.arange(table.shape[1])
+        keep = rank[vertex, slot] < limit
+        bones = bones[keep]
+        weights = weights[keep]
+        vertex = vertex[keep]
+        counts = np.bincount(vertex, minlength=count)
+
+    if normalize and len(weights):
+        sums = np.bincount(vertex, weights, minlength=count)
+        scale = np.ones(count)
+        np.divide(1.0, sums, out=scale, where=sums > 0.0)
+        weights = weights * scale[vertex]
+    return counts, bones, weights
+
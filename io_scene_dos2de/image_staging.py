@@ -0,0 +1,155 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""
+Copies texture files into the export images/ folder on a thread pool.
+
+Files are deduplicated by their resolved source path, so several image
+datablocks pointing at the same file are staged once. A destination whose
+size, mtime and content hash already match the source is left alone.
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Linux FICLONE ioctl, clones a file's extents on btrfs/xfs
+FICLONE = 0x40049409
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def source_key(path):
+    return os.path.normcase(os.path.realpath(path))
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def is_up_to_date(src, dst):
+    if not os.path.isfile(dst):
+        return False
+    if os.path.samefile(src, dst):
+        return True
+    src_stat = os.stat(src)
+    dst_stat = os.stat(dst)
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    # copy2 keeps the source mtime, allow for coarse filesystem timestamps
+    if abs(src_stat.st_mtime - dst_stat.st_mtime) > 2.0:
+        return False
+    return file_hash(src) == file_hash(dst)
+
+
+def reflink(src, dst):
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (OSError, IOError):
+        if os.path.isfile(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+class ImageStager:
+    """Stages image files into a folder, see the module docstring."""
+
+    def stage(self, src):
+        """Queue a copy of src and return the file name used in basedir."""
+        key = source_key(src)
+        name = self.staged.get(key)
+        if name is not None:
+            return name
+
+        base, ext = os.path.splitext(os.path.basename(src))
+        name = base + ext
+        i = 1
+        while name.lower() in self.used_names:
+            # Different source files with the same name
+            name = "{}_{}{}".format(base, i, ext)
+            i += 1
+
+        self.used_names.add(name.lower())
+        self.staged[key] = name
+        dst = os.path.join(self.basedir, name)
+        self.jobs.append((src, dst, self.pool.submit(self.stage_file, src, dst)))
+        return name
+
+    def stage_file(self, src, dst):
+        if is_up_to_date(src, dst):
+            return "skipped"
+
+        tmp = "{}.tmp{}".format(dst, os.getpid())
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+        if reflink(src, tmp):
+            result = "reflinked"
+        else:
+            result = None
+            if self.use_hardlinks:
+                try:
+                    os.link(src, tmp)
+                    result = "linked"
+                except (OSError, AttributeError):
+                    pass
+            if result is None:
+                shutil.copy2(src, tmp)
+                result = "copied"
+
+        os.replace(tmp, dst)
+        return result
+
+    def finish(self):
+        """Wait for every queued file. Returns (counts, errors)."""
+        counts = {}
+        errors = []
+        for src, dst, job in self.jobs:
+            try:
+                result = job.result()
+                counts[result] = counts.get(result, 0) + 1
+            except Exception as e:
+                errors.append("Failed to copy '{}' to '{}': {}".format(
+                    src, dst, e))
+        self.jobs = []
+        self.pool.shutdown(wait=True)
+        return counts, errors
+
+    __slots__ = ("basedir", "use_hardlinks", "pool", "jobs", "staged",
+                 "used_names")
+
+    def __init__(self, basedir, use_hardlinks=False, max_workers=None):
+        self.basedir = basedir
+        self.use_hardlinks = use_hardlinks
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs = []
+        self.staged = {}
+        self.used_names = set()
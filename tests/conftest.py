@@ -0,0 +1,16 @@
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import bpy  # noqa: F401
+except ImportError:
+    # The add-on's __init__ needs Blender, the array modules don't. Register
+    # the package without running it so they can be imported on their own.
+    package = types.ModuleType("io_scene_dos2de")
+    package.__path__ = [os.path.join(ROOT, "io_scene_dos2de")]
+    sys.modules.setdefault("io_scene_dos2de", package)
+else:
+    sys.path.insert(0, ROOT)
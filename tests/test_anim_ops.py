@@ -0,0 +1,196 @@
+import numpy as np
+
+from io_scene_dos2de import anim_ops
+
+
+def translation(x, y, z):
+    m = np.eye(4)
+    m[:3, 3] = (x, y, z)
+    return m
+
+
+def test_local_bone_matrices_chain():
+    root = translation(1.0, 0.0, 0.0)
+    child = root.dot(translation(0.0, 2.0, 0.0))
+    pose = np.array([[root, child]])
+    scales = np.ones((1, 2, 3))
+
+    local = anim_ops.local_bone_matrices(pose, scales, [0, 1], [-1, 0])
+
+    np.testing.assert_allclose(local[0, 0], root)
+    np.testing.assert_allclose(local[0, 1], translation(0.0, 2.0, 0.0))
+
+
+def test_local_bone_matrices_zero_scaled_ancestor():
+    root = np.diag([0.0, 0.0, 0.0, 1.0])
+    child = root.dot(translation(0.0, 1.0, 0.0))
+    grandchild = child.dot(translation(0.0, 1.0, 0.0))
+    pose = np.array([[root, child, grandchild]])
+    scales = np.array([[[0.0, 0.0, 0.0], [1.0, 1.0, 1.0], [1.0, 1.0, 1.0]]])
+
+    local = anim_ops.local_bone_matrices(
+        pose, scales, [0, 1, 2], [-1, 0, 1])
+
+    assert np.all(np.isfinite(local))
+    # The zero scaled parent is ignored, the singular one is pseudo-inverted
+    np.testing.assert_allclose(local[0, 1], child)
+    np.testing.assert_allclose(
+        local[0, 2], np.linalg.pinv(child).dot(grandchild))
+
+
+def test_sample_slopes_uneven_times():
+    times = np.array([0.0, 0.5, 2.0, 2.25, 4.0])
+    values = times ** 2
+
+    slopes = anim_ops.sample_slopes(times, values)
+
+    # Exact for a parabola inside, one-sided secants at the ends
+    np.testing.assert_allclose(slopes[1:-1], 2.0 * times[1:-1])
+    np.testing.assert_allclose(slopes[[0, -1]], [0.5, 6.25])
+
+
+def test_relevant_bone_names_armature_only():
+    # Without a skinned mesh the deform bones and keep-list seed the set
+    parents = {"root": None, "spine": "root", "hand": "spine",
+               "hand_ik": None, "prop": "root", "tail": "root"}
+    deform = ["spine", "hand"]
+    keep = ["prop", "missing"]
+
+    relevant = anim_ops.relevant_bone_names(parents, deform + keep)
+
+    assert relevant == set(["root", "spine", "hand", "prop"])
+
+
+def rotation_x(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    m = np.eye(4)
+    m[1:3, 1:3] = [[c, -s], [s, c]]
+    return m
+
+
+def rotation_z(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    m = np.eye(4)
+    m[:2, :2] = [[c, -s], [s, c]]
+    return m
+
+
+def test_local_basis_change_matches_applied_rotation():
+    # The y-up operator turned a root's rotation to R * Rx(-90) and applied
+    # its transform, baking T * R * Rx(-90) * S into the data
+    up = rotation_x(np.radians(-90.0))
+    location = translation(3.0, -1.0, 2.0)
+    rotation = rotation_z(0.7).dot(rotation_x(0.3))
+    scale = np.diag([2.0, 0.5, 1.5, 1.0])
+    world = location.dot(rotation).dot(scale)
+
+    converted = anim_ops.local_basis_change(world, up)
+
+    np.testing.assert_allclose(
+        converted, location.dot(rotation).dot(up).dot(scale), atol=1e-12)
+    # Rotating around the world origin would move the translation
+    assert not np.allclose(up.dot(world)[:3, 3], converted[:3, 3])
+
+
+def test_local_basis_change_zero_scale_axis():
+    up = rotation_x(np.radians(-90.0))
+    location = translation(1.0, 2.0, 3.0)
+    rotation = rotation_z(0.4)
+    scale = np.diag([1.0, 2.0, 0.0, 1.0])
+    world = location.dot(rotation).dot(scale)
+
+    converted = anim_ops.local_basis_change(world, up)
+
+    np.testing.assert_allclose(
+        converted, location.dot(rotation).dot(up).dot(scale), atol=1e-12)
+
+
+def test_yup_data_matrix_mirrors_after_conversion():
+    # The operator passes turned and applied the root first, then mirrored
+    # the applied data: F * T * R * Rx(-90) * S
+    up = rotation_x(np.radians(-90.0))
+    mirror = np.diag([-1.0, 1.0, 1.0, 1.0])
+    location = translation(2.0, 0.5, 0.0)
+    rotation = rotation_z(0.8)
+    scale = np.diag([1.0, 1.5, 2.0, 1.0])
+    world = location.dot(rotation).dot(scale)
+    correction = anim_ops.local_basis_correction(world, up)
+
+    baked = anim_ops.yup_data_matrix(correction, world, mirror)
+
+    expected = mirror.dot(location).dot(rotation).dot(up).dot(scale)
+    np.testing.assert_allclose(baked, expected, atol=1e-12)
+    local_side = location.dot(rotation).dot(up).dot(scale).dot(mirror)
+    assert not np.allclose(baked, local_side)
+
+
+def test_reduce_keys_constant_track():
+    keep = anim_ops.reduce_keys([0.0, 1.0, 2.0], [[1.0], [1.0], [1.0]], 1e-6)
+
+    np.testing.assert_array_equal(keep, [0])
+
+
+def test_reduce_keys_drops_linear_keys():
+    times = np.arange(7.0)
+    values = np.concatenate((times[:4], [3.0, 3.0, 3.0]))
+
+    keep = anim_ops.reduce_keys(times, values, 1e-6)
+
+    np.testing.assert_array_equal(keep, [0, 3, 6])
+
+
+def test_fit_bezier_within_tolerance():
+    times = np.linspace(0.0, 2.0, 41)
+    values = np.sin(times * 2.0)
+    tolerance = 1e-3
+
+    keep, in_tangents, out_tangents = anim_ops.fit_bezier(
+        times, values, tolerance)
+
+    assert 2 <= len(keep) < len(times)
+    assert keep[0] == 0 and keep[-1] == len(times) - 1
+    slopes = anim_ops.sample_slopes(times, values)
+    for start, end in zip(keep[:-1], keep[1:]):
+        curve = anim_ops.hermite_segment(times, values, slopes, start, end)
+        assert np.all(np.abs(curve - values[start + 1:end]) <= tolerance)
+    # Tangents sit a third of the segment away from their key
+    np.testing.assert_allclose(
+        out_tangents[:-1, 0] - times[keep[:-1]],
+        (times[keep[1:]] - times[keep[:-1]]) / 3.0)
+    np.testing.assert_allclose(in_tangents[0, 1] - values[0],
+                               values[0] - out_tangents[0, 1], atol=1e-12)
+
+
+def rotation_y(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    m = np.eye(4)
+    m[0, 0], m[0, 2], m[2, 0], m[2, 2] = c, s, -s, c
+    return m
+
+
+def test_decompose_matrices_round_trip():
+    angles = np.radians([[10.0, -20.0, 30.0], [15.0, -25.0, 170.0]])
+    locations = [[1.0, 2.0, 3.0], [-1.0, 0.5, 2.0]]
+    scales = [[1.0, 2.0, 0.5], [1.5, 1.0, 1.0]]
+    matrices = []
+    for (x, y, z), location, scale in zip(angles, locations, scales):
+        matrices.append(translation(*location).dot(rotation_z(z)).dot(
+            rotation_y(y)).dot(rotation_x(x)).dot(
+                np.diag(list(scale) + [1.0])))
+
+    tracks = dict(anim_ops.trs_tracks(matrices))
+
+    np.testing.assert_allclose(tracks["location"], locations, atol=1e-12)
+    np.testing.assert_allclose(tracks["scale"], scales, atol=1e-12)
+    np.testing.assert_allclose(
+        np.hstack((tracks["rotationX"], tracks["rotationY"],
+                   tracks["rotationZ"])), np.degrees(angles), atol=1e-9)
+
+
+def test_trs_tracks_skips_rest_components():
+    matrices = [translation(0.0, 0.0, float(i)) for i in range(3)]
+    rest = anim_ops.decompose_matrix(matrices[0])
+
+    tracks = anim_ops.trs_tracks(matrices, rest)
+
+    assert [component for component, values in tracks] == ["location"]
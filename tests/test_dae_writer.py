@@ -0,0 +1,65 @@
+import pytest
+
+from io_scene_dos2de.dae_writer import (
+    AnimationBlock, DaeWriter, GeometryBlock, check_cache_options)
+
+
+def block(anim_id):
+    return AnimationBlock(anim_id, "node/transform", [0.0], [1.0],
+                          matrices=False)
+
+
+def test_group_animations_splits_at_clip_starts():
+    items = [block("a0"), block("a1"), block("b0"), block("b1")]
+
+    grouped = DaeWriter.group_animations(items, set(["a0", "b0"]))
+
+    assert [[b.anim_id for b in group] for group in grouped] == [
+        ["a0", "a1"], ["b0", "b1"]]
+
+
+def sample_writer(**config):
+    writer = DaeWriter(dict({"float_precision": 6, "use_tangent": False,
+                             "use_triangles": False}, **config))
+    writer.scene_name = "scene"
+    writer.writel(1, 0, "<library_geometries>")
+    writer.write_block(1, GeometryBlock(
+        "quad-id-1", "quad",
+        [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 0.0], [0.0, 1.0, 0.0]],
+        [[0.0, 0.0, 1.0]] * 4, uvs=[[0.0, 0.0], [1.0, 0.0], [1.0, 1.0],
+                                    [0.0, 1.0]],
+        surfaces=[(None, [4], [0, 1, 2, 3])]))
+    writer.writel(1, 0, "</library_geometries>")
+    writer.writel(2, 0, "<library_animations>")
+    writer.write_block(2, AnimationBlock(
+        "anim-id-2", "quad/transform", [0.0, 1.0], [0.0, 2.5],
+        matrices=False))
+    writer.writel(2, 0, "</library_animations>")
+    return writer
+
+
+def test_cache_round_trip(tmpdir):
+    writer = sample_writer()
+    writer.save_cache(str(tmpdir.join("export.npz")))
+    writer.write(str(tmpdir.join("direct.dae")))
+
+    loaded = DaeWriter.load_cache(str(tmpdir.join("export.npz")))
+    loaded.write(str(tmpdir.join("cached.dae")))
+
+    assert loaded.last_id == writer.last_id
+    assert "quad-id-1" in tmpdir.join("cached.dae").read()
+    assert (tmpdir.join("cached.dae").read() ==
+            tmpdir.join("direct.dae").read())
+
+
+def test_check_cache_options_rejects_missing_data():
+    stored = {"use_tangent": False, "use_triangles": True}
+
+    with pytest.raises(ValueError):
+        check_cache_options(stored, {"use_tangent": True}, "export.npz")
+    with pytest.raises(ValueError):
+        check_cache_options(stored, {"use_triangles": False}, "export.npz")
+    # Dropping data the cache holds, or keeping it, is fine
+    check_cache_options({"use_tangent": True}, {"use_tangent": False},
+                        "export.npz")
+    check_cache_options(stored, {"use_triangles": True}, "export.npz")
@@ -0,0 +1,85 @@
+import numpy as np
+
+from io_scene_dos2de import geometry_ops
+from io_scene_dos2de.dae_writer import GeometryBlock
+
+
+def quad(z=0.0):
+    positions = [[0.0, 0.0, z], [1.0, 0.0, z], [1.0, 1.0, z], [0.0, 1.0, z]]
+    normals = [[0.0, 0.0, 1.0]] * 4
+    return GeometryBlock("quad", "quad", positions, normals,
+                         surfaces=[(None, [4], [0, 1, 2, 3])])
+
+
+def test_transform_geometry_zero_scale_axis():
+    # A flattened object has no inverse, its normals still point along the
+    # flattened axis
+    geometry = quad(z=2.0)
+    geometry.normals = np.array([[0.0, 0.6, 0.8]] * 4)
+    matrix = np.diag([2.0, 3.0, 0.0, 1.0])
+
+    geometry_ops.transform_geometry(geometry, matrix)
+
+    np.testing.assert_allclose(geometry.positions[:, 2], 0.0)
+    np.testing.assert_allclose(geometry.normals, [[0.0, 0.0, 1.0]] * 4)
+
+
+def test_transform_geometry_mirror():
+    geometry = quad()
+    mirror = np.diag([-1.0, 2.0, 1.0, 1.0])
+
+    geometry_ops.transform_geometry(geometry, mirror)
+
+    np.testing.assert_allclose(geometry.normals, [[0.0, 0.0, 1.0]] * 4)
+    np.testing.assert_array_equal(geometry.surfaces[0][2], [3, 2, 1, 0])
+
+
+def test_unique_rows():
+    keys = np.array([[1, 0], [0, 2], [1, 0], [0, 1]])
+
+    unique, inverse = geometry_ops.unique_rows(keys)
+
+    np.testing.assert_array_equal(unique, [[0, 1], [0, 2], [1, 0]])
+    np.testing.assert_array_equal(unique[inverse], keys)
+
+
+def test_partition_geometry():
+    positions = [[x + dx, dy, 0.0] for x in (0.0, 1.5) for dx, dy in
+                 ((0.0, 0.0), (0.4, 0.0), (0.4, 0.4), (0.0, 0.4))]
+    geometry = GeometryBlock(
+        "grid", "grid", positions, [[0.0, 0.0, 1.0]] * 8,
+        surfaces=[("mat", [4, 4], [0, 1, 2, 3, 4, 5, 6, 7])])
+
+    chunks = geometry_ops.partition_geometry(geometry, 1.0)
+
+    assert [cell for cell, chunk in chunks] == [(0, 0, 0), (1, 0, 0)]
+    for (cell, chunk), x in zip(chunks, (0.0, 1.5)):
+        assert len(chunk.positions) == 4
+        np.testing.assert_allclose(chunk.positions[:, 0].min(), x)
+        symbol, counts, indices = chunk.surfaces[0]
+        assert symbol == "mat"
+        np.testing.assert_array_equal(counts, [4])
+        np.testing.assert_array_equal(indices, [0, 1, 2, 3])
+
+
+def test_limit_weights_keeps_strongest():
+    counts = [5, 2]
+    bones = [0, 1, 2, 3, 4, 5, 6]
+    weights = [0.1, 0.4, 0.05, 0.3, 0.15, 0.5, 0.5]
+
+    counts, bones, weights = geometry_ops.limit_weights(
+        counts, bones, weights, limit=3)
+
+    np.testing.assert_array_equal(counts, [3, 2])
+    # Kept influences stay in their original order
+    np.testing.assert_array_equal(bones, [1, 3, 4, 5, 6])
+    np.testing.assert_allclose(
+        weights, [0.4 / 0.85, 0.3 / 0.85, 0.15 / 0.85, 0.5, 0.5])
+
+
+def test_limit_weights_without_normalize():
+    counts, bones, weights = geometry_ops.limit_weights(
+        [2], [0, 1], [0.2, 0.3], limit=1, normalize=False)
+
+    np.testing.assert_array_equal(bones, [1])
+    np.testing.assert_allclose(weights, [0.3])
@@ -0,0 +1,124 @@
+import re
+
+import pytest
+
+bpy = pytest.importorskip("bpy")
+
+
+def setup_module(module):
+    import addon_utils
+    addon_utils.enable("io_scene_dos2de", default_set=True)
+
+
+def build_scene():
+    for collection in (bpy.data.objects, bpy.data.meshes,
+                       bpy.data.armatures, bpy.data.actions):
+        for block in list(collection):
+            collection.remove(block, do_unlink=True)
+    scene = bpy.context.scene
+    scene.frame_start = 1
+    scene.frame_end = 10
+
+    rig = bpy.data.objects.new("Rig", bpy.data.armatures.new("Rig"))
+    rig.location = (1.0, 2.0, 0.0)
+    rig.rotation_euler = (0.0, 0.0, 0.5)
+    scene.objects.link(rig)
+    scene.objects.active = rig
+    bpy.ops.object.mode_set(mode="EDIT")
+    root = rig.data.edit_bones.new("Root")
+    root.tail = (0.0, 0.0, 1.0)
+    arm = rig.data.edit_bones.new("Arm")
+    arm.head = (0.0, 0.0, 1.0)
+    arm.tail = (0.0, 1.0, 1.0)
+    arm.parent = root
+    bpy.ops.object.mode_set(mode="OBJECT")
+
+    bpy.ops.mesh.primitive_cube_add(location=(0.0, 0.0, 1.0))
+    body = scene.objects.active
+    body.name = "Body"
+    body.parent = rig
+    group = body.vertex_groups.new("Arm")
+    group.add(range(len(body.data.vertices)), 1.0, "REPLACE")
+    body.modifiers.new("Armature", "ARMATURE").object = rig
+    body.shape_key_add("Basis")
+    body.shape_key_add("Bulge").value = 0.3
+    body.active_shape_key_index = 1
+
+    bone = rig.pose.bones["Arm"]
+    bone.rotation_mode = "XYZ"
+    for frame, angle in ((1, 0.0), (10, 1.0)):
+        bone.rotation_euler = (angle, 0.0, 0.0)
+        bone.keyframe_insert("rotation_euler", frame=frame)
+    scene.frame_set(5)
+
+
+def scene_state():
+    """Everything an export must leave as it found it."""
+    state = {}
+    for obj in bpy.data.objects:
+        entry = {
+            "parent": obj.parent.name if obj.parent else None,
+            "matrix_world": [tuple(r) for r in obj.matrix_world],
+            "matrix_basis": [tuple(r) for r in obj.matrix_basis],
+            "data": obj.data.name if obj.data else None,
+            "props": sorted(obj.keys()),
+            "action": (obj.animation_data.action.name
+                       if obj.animation_data and obj.animation_data.action
+                       else None),
+        }
+        if obj.type == "ARMATURE":
+            entry["pose_position"] = obj.data.pose_position
+            entry["pose"] = dict(
+                (b.name, [tuple(r) for r in b.matrix_basis])
+                for b in obj.pose.bones)
+        if obj.type == "MESH" and obj.data.shape_keys:
+            entry["shape_keys"] = [
+                (k.name, k.value) for k in obj.data.shape_keys.key_blocks]
+            entry["show_only_shape_key"] = obj.show_only_shape_key
+            entry["active_shape_key_index"] = obj.active_shape_key_index
+        state[obj.name] = entry
+    return state
+
+
+def export(path, **options):
+    build_scene()
+    result = bpy.ops.export_scene.dos2de_collada(
+        filepath=path, use_export_selected=False, use_anim=True, **options)
+    assert result == {"FINISHED"}
+    with open(path) as f:
+        text = f.read()
+    text = re.sub(r"<(created|modified)>[^<]*</\1>", "", text)
+    # Without the export properties add-on copies keep Blender's suffix
+    return re.sub(r"\.\d{3}\b", "", text)
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"use_exclude_armature_modifier": True},
+    {"object_types": {"MESH"}},
+    {"yup_enabled": "ROTATE"},
+])
+def test_nondestructive_matches_copies(tmpdir, options):
+    copied = export(str(tmpdir.join("copied.dae")),
+                    use_nondestructive=False, **options)
+    kept = export(str(tmpdir.join("kept.dae")),
+                  use_nondestructive=True, **options)
+
+    assert kept == copied
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"use_exclude_armature_modifier": True},
+    {"use_anim_clips": True},
+])
+def test_nondestructive_leaves_scene_unchanged(tmpdir, options):
+    build_scene()
+    before = scene_state()
+
+    result = bpy.ops.export_scene.dos2de_collada(
+        filepath=str(tmpdir.join("kept.dae")), use_export_selected=False,
+        use_anim=True, use_nondestructive=True, **options)
+
+    assert result == {"FINISHED"}
+    assert scene_state() == before